@@ -1,19 +1,169 @@
 #include "CustomMagneticField.hh"
 #include "G4SystemOfUnits.hh"
 #include <cmath>
+#include <cstring>
 #include <limits>
 #include <algorithm>
 #include <iostream>
+#include <stdexcept>
 
-CustomMagneticField::CustomMagneticField(const std::map<std::string, std::vector<double>>& ranges, const std::vector<G4ThreeVector>& fields, InterpolationType interpType)
-    : fFields(fields), fInterpType(interpType) {
+namespace {
+// IEEE 754 binary16 <-> binary32 conversions (round to nearest even, saturating at 65504)
+uint16_t FloatToHalf(float value) {
+    uint32_t x;
+    std::memcpy(&x, &value, sizeof(x));
+    const uint32_t sign = (x >> 16) & 0x8000u;
+    x &= 0x7fffffffu;
+    if (x >= 0x477ff000u) {
+        return static_cast<uint16_t>(sign | 0x7bffu);
+    }
+    if (x < 0x38800000u) {
+        float f;
+        std::memcpy(&f, &x, sizeof(f));
+        return static_cast<uint16_t>(sign | static_cast<uint32_t>(std::lrint(f * 16777216.0f)));
+    }
+    const uint32_t rounded = x + 0x0fffu + ((x >> 13) & 1u);
+    return static_cast<uint16_t>(sign | ((rounded - 0x38000000u) >> 13));
+}
+
+inline float HalfToFloat(uint16_t h) {
+    // Re-bias the exponent by a multiplication, which also handles subnormals without branches
+    const uint32_t bits = static_cast<uint32_t>(h & 0x7fffu) << 13;
+    float f;
+    std::memcpy(&f, &bits, sizeof(f));
+    f *= 5.192296858534828e33f; // 2^112
+    uint32_t out;
+    std::memcpy(&out, &f, sizeof(out));
+    out |= static_cast<uint32_t>(h & 0x8000u) << 16;
+    std::memcpy(&f, &out, sizeof(f));
+    return f;
+}
+}
+
+double CustomMagneticField::FieldValues::operator[](size_t i) const {
+    if (rowPitch) {
+        const size_t node = i / 3;
+        i = 3 * ((node / rowNodes) * rowPitch + node % rowNodes) + i % 3;
+    }
+    if (f64) return f64[i];
+    if (f32) return f32[i];
+    return HalfToFloat(f16[i]);
+}
+
+CustomMagneticField::CustomMagneticField(const std::map<std::string, std::vector<double>>& ranges, const std::vector<G4ThreeVector>& fields, InterpolationType interpType, StorageType storageType)
+    : fInterpType(interpType), fStorageType(storageType) {
     // Initialize grid parameters
     initializeGrid(ranges);
+    std::vector<double> flat;
+    flat.reserve(3 * fields.size());
+    for (const auto& B : fields) {
+        flat.push_back(B.x());
+        flat.push_back(B.y());
+        flat.push_back(B.z());
+    }
+    storeFields(FieldValues(flat), 1.0 / tesla);
+}
+
+CustomMagneticField::CustomMagneticField(const std::map<std::string, std::vector<double>>& ranges, const FieldValues& fields, InterpolationType interpType, StorageType storageType)
+    : fInterpType(interpType), fStorageType(storageType) {
+    initializeGrid(ranges);
+    storeFields(fields, 1.0);
+}
+
+CustomMagneticField::CustomMagneticField(const std::map<std::string, std::vector<double>>& ranges, const FieldValues& fields,
+                                         const std::vector<int>& brickIndex, int brickSize, InterpolationType interpType, StorageType storageType)
+    : fInterpType(interpType), fStorageType(storageType), fBrickIndex(brickIndex) {
+    initializeGrid(ranges);
+    if (brickSize <= 0 || (brickSize & (brickSize - 1)) != 0) {
+        throw std::runtime_error("Field map brick size must be a power of two, got " + std::to_string(brickSize));
+    }
+    fBrickShift = 0;
+    while ((1 << fBrickShift) < brickSize) fBrickShift++;
+    fBrickMask = brickSize - 1;
+    nbx = (nx + fBrickMask) >> fBrickShift;
+    nby = (ny + fBrickMask) >> fBrickShift;
+    nbz = (nz + fBrickMask) >> fBrickShift;
+    if (fBrickIndex.size() != static_cast<size_t>(nbx) * nby * nbz) {
+        throw std::runtime_error("Brick index size " + std::to_string(fBrickIndex.size()) + " does not match the grid dimensions.");
+    }
+    storeFields(fields, 1.0);
+    std::cout << "Field map bricks: " << fNodes / (static_cast<size_t>(brickSize) * brickSize * brickSize)
+              << " stored out of " << fBrickIndex.size() << std::endl;
+}
+
+CustomMagneticField::CustomMagneticField(const std::map<std::string, std::vector<double>>& ranges, const FieldValues& fields,
+                                         const std::vector<int>& octree, int octreeCells, int octreeDepth, StorageType storageType)
+    : fInterpType(LINEAR), fStorageType(storageType), fOctree(octree), fOctreeCells(octreeCells), fOctreeDepth(octreeDepth) {
+    initializeGrid(ranges);
+    const int N = 1 << fOctreeDepth;
+    fOctreeScale[0] = N / (x_max - x_min);
+    fOctreeScale[1] = N / (y_max - y_min);
+    fOctreeScale[2] = N / (z_max - z_min);
+    // cells then 8 corner node ids per leaf, with at least one leaf
+    if (fOctreeCells <= 0 || fOctree.size() < static_cast<size_t>(fOctreeCells) + 8
+        || (fOctree.size() - fOctreeCells) % 8 != 0) {
+        throw std::invalid_argument("Invalid octree table of size " + std::to_string(fOctree.size()) + " for "
+                                    + std::to_string(fOctreeCells) + " cells.");
+    }
+    const size_t nLeaves = (fOctree.size() - fOctreeCells) / 8;
+    if (fOctreeDepth < 0 || fOctreeDepth > 30) {
+        throw std::invalid_argument("Invalid octree depth " + std::to_string(fOctreeDepth));
+    }
+    // children come after their parent, within the cells and the depth; leaves within the leaf table
+    std::vector<int> level(fOctreeCells, 0);
+    for (int i = 0; i < fOctreeCells; ++i) {
+        const int entry = fOctree[i];
+        const bool valid = entry >= 0 ? entry > i && entry <= fOctreeCells - 8 && level[i] < fOctreeDepth
+                                      : static_cast<size_t>(-static_cast<long long>(entry) - 1) < nLeaves;
+        if (!valid) {
+            throw std::invalid_argument("Invalid octree cell " + std::to_string(i) + ": " + std::to_string(entry));
+        }
+        if (entry >= 0) std::fill(level.begin() + entry, level.begin() + entry + 8, level[i] + 1);
+    }
+    fNodes = fields.size() / 3;
+    const int maxNode = *std::max_element(fOctree.begin() + fOctreeCells, fOctree.end());
+    const int minNode = *std::min_element(fOctree.begin() + fOctreeCells, fOctree.end());
+    if (minNode < 0 || static_cast<size_t>(maxNode) >= fNodes) {
+        throw std::invalid_argument("Field map size " + std::to_string(fNodes) + " does not match the octree.");
+    }
+    storeFields(fields, 1.0);
+    std::cout << "Field map octree: " << fOctreeCells << " cells, " << nLeaves << " leaves, " << fNodes << " nodes." << std::endl;
+}
+
+CustomMagneticField::CustomMagneticField(const std::map<std::string, std::vector<double>>& ranges, const FieldValues& fields,
+                                         const std::vector<int>& zPlanes, InterpolationType interpType, StorageType storageType)
+    : fInterpType(interpType), fStorageType(storageType), fZPlanes(zPlanes) {
+    initializeGrid(ranges);
+    if (fZPlanes.size() < 2 || fZPlanes.front() != 0 || fZPlanes.back() != nz - 1 ||
+        !std::is_sorted(fZPlanes.begin(), fZPlanes.end()) ||
+        std::adjacent_find(fZPlanes.begin(), fZPlanes.end()) != fZPlanes.end()) {
+        throw std::runtime_error("Invalid list of field map z planes.");
+    }
+    fPlaneBelow.resize(nz - 1);
+    for (size_t p = 0; p + 1 < fZPlanes.size(); ++p) {
+        std::fill(fPlaneBelow.begin() + fZPlanes[p], fPlaneBelow.begin() + fZPlanes[p + 1], static_cast<int>(p));
+    }
+    storeFields(fields, 1.0);
+    std::cout << "Field map z planes: " << fZPlanes.size() << " stored out of " << nz << std::endl;
 }
 
 CustomMagneticField::~CustomMagneticField() {
 }
 
+CustomMagneticField::InterpolationType CustomMagneticField::InterpolationTypeFromString(const std::string& name) {
+    if (name == "nearest") return NEAREST_NEIGHBOR;
+    if (name == "linear") return LINEAR;
+    throw std::runtime_error("Invalid field map interpolation type: " + name);
+}
+
+CustomMagneticField::StorageType CustomMagneticField::StorageTypeFromString(const std::string& name) {
+    if (name == "float32_aos") return FLOAT32_AOS;
+    if (name == "float32_soa") return FLOAT32_SOA;
+    if (name == "float16_aos") return FLOAT16_AOS;
+    if (name == "float16_soa") return FLOAT16_SOA;
+    throw std::runtime_error("Invalid field map storage type: " + name);
+}
+
 void CustomMagneticField::initializeGrid(const std::map<std::string, std::vector<double>>& ranges) {
     x_min = ranges.at("range_x")[0];
     x_max = ranges.at("range_x")[1];
@@ -30,81 +180,366 @@ void CustomMagneticField::initializeGrid(const std::map<std::string, std::vector
     nx = static_cast<int>(std::round((x_max - x_min) * dx_inv))+1;
     ny = static_cast<int>(std::round((y_max - y_min) * dy_inv))+1;
     nz = static_cast<int>(std::round((z_max - z_min) * dz_inv))+1;
+    fRowPitch = nz;
+
+    // (p - p_min) * d_inv + 0.5 folded into a single multiply-add; truncation then rounds to nearest
+    x_off = 0.5 - x_min * dx_inv;
+    y_off = 0.5 - y_min * dy_inv;
+    z_off = 0.5 - z_min * dz_inv;
+    fBrickShift = fBrickMask = 0;
+    nbx = nby = nbz = 0;
+    fCache.Invalidate();
 
     std::cout << "Grid initialized with dimensions: " << nx << " x " << ny << " x " << nz << std::endl;
 }
 
-void CustomMagneticField::GetFieldValueNearestNeighbor(const G4double Point[4], G4double *Bfield) const {
-    // Check if the point is outside the grid
-    if (fabs(Point[0]) > x_max || fabs(Point[1]) > y_max || fabs(Point[2]) > z_max) {
-        Bfield[0] = 0.0;
-        Bfield[1] = 0.0;
-        Bfield[2] = 0.0;
+void CustomMagneticField::GetExtent(G4ThreeVector& lo, G4ThreeVector& hi) const {
+    const double ax = std::max(std::abs(x_min), std::abs(x_max)) + 1.0 / dx_inv;
+    const double ay = std::max(std::abs(y_min), std::abs(y_max)) + 1.0 / dy_inv;
+    lo = G4ThreeVector(-ax, -ay, z_min - 1.0 / dz_inv);
+    hi = G4ThreeVector(ax, ay, z_max + 1.0 / dz_inv);
+}
+
+void CustomMagneticField::storeFields(const FieldValues& fields, double scale) {
+    const size_t nValues = fields.size();
+    fNodes = nValues / 3;
+    const size_t nPlanes = fZPlanes.empty() ? nz : fZPlanes.size();
+    if (fBrickIndex.empty() && fOctree.empty() && fNodes != static_cast<size_t>(nx) * ny * nPlanes) {
+        throw std::runtime_error("Field map size " + std::to_string(fNodes) + " does not match the grid dimensions.");
+    }
+    if (!fBrickIndex.empty()) {
+        const size_t brickNodes = size_t(1) << (3 * fBrickShift);
+        const int maxBrick = *std::max_element(fBrickIndex.begin(), fBrickIndex.end());
+        if (fNodes % brickNodes != 0 || static_cast<size_t>(maxBrick + 1) * brickNodes > fNodes) {
+            throw std::runtime_error("Field map size " + std::to_string(fNodes) + " does not match the brick index.");
+        }
+    }
+    if (fields.rowPitch && (!fBrickIndex.empty() || !fOctree.empty() || !fZPlanes.empty()
+                            || fields.rowNodes != static_cast<size_t>(nz) || fields.rowPitch < fields.rowNodes)) {
+        throw std::invalid_argument("Field map windows are only read as dense grids with rows of nz nodes.");
+    }
+    const bool soa = (fStorageType == FLOAT32_SOA || fStorageType == FLOAT16_SOA);
+    const bool half = (fStorageType == FLOAT16_AOS || fStorageType == FLOAT16_SOA);
+    fField32 = fields.f32;
+    fField16 = fields.f16;
+    if (scale == 1.0 && ((fStorageType == FLOAT32_AOS && fField32) || (fStorageType == FLOAT16_AOS && fField16))) {
+        if (fields.rowPitch) fRowPitch = fields.rowPitch;
+        std::cout << "Field map of " << (half ? 2 : 4) * nValues / (1024 * 1024) << " MB used in place." << std::endl;
         return;
     }
-    // Determine the quadrant of the point
-    int quadrant = 0;
-    if (Point[0] >= 0 && Point[1] >= 0) {
-        quadrant = 1;
-    } else if (Point[0] < 0 && Point[1] >= 0) {
-        quadrant = 2;
-    } else if (Point[0] < 0 && Point[1] < 0) {
-        quadrant = 3;
-    } else if (Point[0] >= 0 && Point[1] < 0) {
-        quadrant = 4;
-    }
-    // Create a copy of Point and give it the value of the corresponding symmetry to the 1st quadrant
-    G4double SymmetricPoint[4] = {Point[0], Point[1], Point[2], Point[3]};
-    if (quadrant == 2) {
-        SymmetricPoint[0] *= -1;
-    } else if (quadrant == 3) {
-        SymmetricPoint[0] *= -1;
-        SymmetricPoint[1] *= -1;
-    } else if (quadrant == 4) {
-        SymmetricPoint[1] *= -1;
-    }
-
-    // Calculate nearest indices using integer arithmetic
-    int i = (int)round((SymmetricPoint[0] - x_min) * dx_inv);
-    int j = (int)round((SymmetricPoint[1] - y_min) * dy_inv);
-    int k = (int)round((SymmetricPoint[2] - z_min) * dz_inv);
-
-    // Check bounds
-    if (i < 0 || i >nx || j < 0 || j >ny || k < 0 || k > nz) {
+    if (half) fData16.resize(nValues);
+    else fData32.resize(nValues);
+    for (size_t n = 0; n < fNodes; ++n) {
+        for (size_t c = 0; c < 3; ++c) {
+            const size_t dst = soa ? c * fNodes + n : 3 * n + c;
+            const float value = static_cast<float>(fields[3 * n + c] * scale);
+            if (half) fData16[dst] = FloatToHalf(value);
+            else fData32[dst] = value;
+        }
+    }
+    fField32 = fData32.data();
+    fField16 = fData16.data();
+    std::cout << "Field map stored using " << (half ? 2 : 4) * nValues / (1024 * 1024) << " MB." << std::endl;
+}
+
+inline void CustomMagneticField::loadNode(size_t idx, double* B) const {
+    switch (fStorageType) {
+        case FLOAT32_AOS: {
+            const float* node = &fField32[3 * idx];
+            B[0] = node[0]; B[1] = node[1]; B[2] = node[2];
+            break;
+        }
+        case FLOAT32_SOA:
+            B[0] = fField32[idx]; B[1] = fField32[fNodes + idx]; B[2] = fField32[2 * fNodes + idx];
+            break;
+        case FLOAT16_AOS: {
+            const uint16_t* node = &fField16[3 * idx];
+            B[0] = HalfToFloat(node[0]); B[1] = HalfToFloat(node[1]); B[2] = HalfToFloat(node[2]);
+            break;
+        }
+        case FLOAT16_SOA:
+            B[0] = HalfToFloat(fField16[idx]);
+            B[1] = HalfToFloat(fField16[fNodes + idx]);
+            B[2] = HalfToFloat(fField16[2 * fNodes + idx]);
+            break;
+    }
+    B[0] *= tesla;
+    B[1] *= tesla;
+    B[2] *= tesla;
+}
+
+inline bool CustomMagneticField::nodeIndex(int i, int j, int k, size_t& idx) const {
+    if (fBrickIndex.empty()) {
+        idx = (static_cast<size_t>(j) * nx + i) * fRowPitch + k; //indexing of the field must match this
+        return true;
+    }
+    const int brick = fBrickIndex[(static_cast<size_t>(j >> fBrickShift) * nbx + (i >> fBrickShift)) * nbz + (k >> fBrickShift)];
+    if (brick < 0) return false;
+    idx = (static_cast<size_t>(brick) << (3 * fBrickShift)) +
+          ((((j & fBrickMask) << fBrickShift) + (i & fBrickMask)) << fBrickShift) + (k & fBrickMask);
+    return true;
+}
+
+inline void CustomMagneticField::loadGridNode(int i, int j, int k, double* B) const {
+    size_t idx;
+    if (nodeIndex(i, j, k, idx)) {
+        loadNode(idx, B);
+    } else {
+        B[0] = B[1] = B[2] = 0.0;
+    }
+}
+
+void CustomMagneticField::interpolateCorners(const double corners[8][3], double fx, double fy, double fz, double* B) {
+    for (int c = 0; c < 3; ++c) {
+        const double b00 = corners[0][c] + fz * (corners[1][c] - corners[0][c]);
+        const double b01 = corners[2][c] + fz * (corners[3][c] - corners[2][c]);
+        const double b10 = corners[4][c] + fz * (corners[5][c] - corners[4][c]);
+        const double b11 = corners[6][c] + fz * (corners[7][c] - corners[6][c]);
+        const double b0 = b00 + fx * (b01 - b00);
+        const double b1 = b10 + fx * (b11 - b10);
+        B[c] = b0 + fy * (b1 - b0);
+    }
+}
+
+thread_local std::unordered_map<const CustomMagneticField*, CustomMagneticField::LookupCache>* CustomMagneticField::tPrivateCaches = nullptr;
+
+void CustomMagneticField::LookupCache::Invalidate() {
+    for (int c = 0; c < 3; ++c) {
+        lo[c] = std::numeric_limits<double>::infinity();
+        hi[c] = -std::numeric_limits<double>::infinity();
+        B[c] = 0.0;
+    }
+}
+
+CustomMagneticField::PrivateCaches::PrivateCaches() : fPrevious(tPrivateCaches) {
+    tPrivateCaches = &fCaches;
+}
+
+CustomMagneticField::PrivateCaches::~PrivateCaches() {
+    tPrivateCaches = fPrevious;
+}
+
+void CustomMagneticField::GetFieldValueNearestNeighbor(const G4double Point[4], G4double *Bfield, LookupCache& cache) const {
+    // The map covers the first quadrant: fold the point onto it and keep the signs to restore
+    // the field symmetry, Bx odd under a single reflection and Bz odd under y -> -y.
+    const double ax = std::fabs(Point[0]);
+    const double ay = std::fabs(Point[1]);
+    const double z = Point[2];
+    const double signX = ((Point[0] < 0) != (Point[1] < 0)) ? -1.0 : 1.0;
+    const double signZ = (Point[1] < 0) ? -1.0 : 1.0;
+
+    if (!(ax >= cache.lo[0] && ax < cache.hi[0] && ay >= cache.lo[1] && ay < cache.hi[1] &&
+          z >= cache.lo[2] && z < cache.hi[2])) {
+        const double ti = ax * dx_inv + x_off;
+        const double tj = ay * dy_inv + y_off;
+        const double tk = z * dz_inv + z_off;
+        // Check if the point is outside the grid
+        if (ax > x_max || ay > y_max || z > z_max || ti < 0 || tj < 0 || tk < 0) {
+            Bfield[0] = Bfield[1] = Bfield[2] = 0.0;
+            return;
+        }
+        const int i = static_cast<int>(ti);
+        const int j = static_cast<int>(tj);
+        const int k = static_cast<int>(tk);
+
+        loadGridNode(i, j, k, cache.B);
+
+        cache.lo[0] = (i - x_off) / dx_inv;
+        cache.hi[0] = std::min((i + 1 - x_off) / dx_inv, x_max);
+        cache.lo[1] = (j - y_off) / dy_inv;
+        cache.hi[1] = std::min((j + 1 - y_off) / dy_inv, y_max);
+        cache.lo[2] = (k - z_off) / dz_inv;
+        cache.hi[2] = std::min((k + 1 - z_off) / dz_inv, z_max);
+    }
+
+    // Apply symmetry to the magnetic field
+    Bfield[0] = signX * cache.B[0];
+    Bfield[1] = cache.B[1];
+    Bfield[2] = signZ * cache.B[2];
+}
+
+void CustomMagneticField::GetFieldValueLinear(const G4double Point[4], G4double *Bfield, LookupCache& cache) const {
+    // Same folding as the nearest neighbour lookup: interpolate in the first quadrant, then restore signs
+    const double ax = std::fabs(Point[0]);
+    const double ay = std::fabs(Point[1]);
+    const double z = Point[2];
+    const double signX = ((Point[0] < 0) != (Point[1] < 0)) ? -1.0 : 1.0;
+    const double signZ = (Point[1] < 0) ? -1.0 : 1.0;
+
+    const double tx = (ax - x_min) * dx_inv;
+    const double ty = (ay - y_min) * dy_inv;
+    const double tz = (z - z_min) * dz_inv;
+    // Check if the point is outside the grid
+    if (ax > x_max || ay > y_max || z > z_max || tx < 0 || ty < 0 || tz < 0) {
         Bfield[0] = Bfield[1] = Bfield[2] = 0.0;
-        return; // Out of bounds
+        return;
     }
+    // Lower corner of the cell, the last node belongs to the cell below it
+    const int i = std::min(static_cast<int>(tx), nx - 2);
+    const int j = std::min(static_cast<int>(ty), ny - 2);
+    const int k = std::min(static_cast<int>(tz), nz - 2);
 
-    // Compute flat index
-    int idx = j*(nx*nz)+i*nz+k; //indexing of the field must match this
+    if (!(ax >= cache.lo[0] && ax < cache.hi[0] && ay >= cache.lo[1] && ay < cache.hi[1] &&
+          z >= cache.lo[2] && z < cache.hi[2])) {
+        for (int c = 0; c < 8; ++c) {
+            loadGridNode(i + ((c >> 1) & 1), j + ((c >> 2) & 1), k + (c & 1), cache.corners[c]);
+        }
+        cache.lo[0] = x_min + i / dx_inv;
+        cache.hi[0] = x_min + (i + 1) / dx_inv;
+        cache.lo[1] = y_min + j / dy_inv;
+        cache.hi[1] = y_min + (j + 1) / dy_inv;
+        cache.lo[2] = z_min + k / dz_inv;
+        cache.hi[2] = z_min + (k + 1) / dz_inv;
+    }
 
-    // Assign the nearest values
-    Bfield[0] = fFields[idx].x();
-    Bfield[1] = fFields[idx].y();
-    Bfield[2] = fFields[idx].z();
+    const double fx = tx - i;
+    const double fy = ty - j;
+    const double fz = tz - k;
+    double B[3];
+    interpolateCorners(cache.corners, fx, fy, fz, B);
 
     // Apply symmetry to the magnetic field
-    if (quadrant == 2 || quadrant == 4) {
-        Bfield[0] = -Bfield[0];
+    Bfield[0] = signX * B[0];
+    Bfield[1] = B[1];
+    Bfield[2] = signZ * B[2];
+}
+
+void CustomMagneticField::GetFieldValueOctree(const G4double Point[4], G4double *Bfield, LookupCache& cache) const {
+    const double ax = std::fabs(Point[0]);
+    const double ay = std::fabs(Point[1]);
+    const double z = Point[2];
+    const double signX = ((Point[0] < 0) != (Point[1] < 0)) ? -1.0 : 1.0;
+    const double signZ = (Point[1] < 0) ? -1.0 : 1.0;
+
+    // Check if the point is outside the grid
+    if (ax > x_max || ay > y_max || z > z_max || ax < x_min || ay < y_min || z < z_min) {
+        Bfield[0] = Bfield[1] = Bfield[2] = 0.0;
+        return;
     }
-    if (quadrant == 3 || quadrant == 4) {
-        Bfield[2] = -Bfield[2];
+
+    if (!(ax >= cache.lo[0] && ax < cache.hi[0] && ay >= cache.lo[1] && ay < cache.hi[1] &&
+          z >= cache.lo[2] && z < cache.hi[2])) {
+        // Descend from the root using the bits of the finest-level cell coordinates
+        const int N = 1 << fOctreeDepth;
+        const int ix = std::min(static_cast<int>((ax - x_min) * fOctreeScale[0]), N - 1);
+        const int iy = std::min(static_cast<int>((ay - y_min) * fOctreeScale[1]), N - 1);
+        const int iz = std::min(static_cast<int>((z - z_min) * fOctreeScale[2]), N - 1);
+        int level = 0;
+        int entry = fOctree[0];
+        while (entry >= 0) {
+            level++;
+            const int shift = fOctreeDepth - level;
+            entry = fOctree[entry + ((((iy >> shift) & 1) << 2) | (((ix >> shift) & 1) << 1) | ((iz >> shift) & 1))];
+        }
+        const size_t leaf = static_cast<size_t>(-entry - 1);
+        for (int c = 0; c < 8; ++c) {
+            loadNode(fOctree[fOctreeCells + 8 * leaf + c], cache.corners[c]);
+        }
+        const int shift = fOctreeDepth - level;
+        const int size = 1 << shift;
+        const int origin[3] = {(ix >> shift) << shift, (iy >> shift) << shift, (iz >> shift) << shift};
+        const double pMin[3] = {x_min, y_min, z_min};
+        for (int c = 0; c < 3; ++c) {
+            cache.lo[c] = pMin[c] + origin[c] / fOctreeScale[c];
+            cache.hi[c] = pMin[c] + (origin[c] + size) / fOctreeScale[c];
+            cache.invSize[c] = fOctreeScale[c] / size;
+        }
     }
-    //debug prints
-    //std::cout << "Evaluating at point: (" << Point[0]/m << ", " << Point[1]/m << ", " << Point[2]/m << ")" << std::endl;
-    //std::cout << "Symmetric point: (" << SymmetricPoint[0]/m << ", " << SymmetricPoint[1]/m << ", " << SymmetricPoint[2]/m << ")" << std::endl;
-    //std::cout << "Nearest neighbor point index: (" << i << ", " << j << ", " << k << ")" << std::endl;
-    //std::cout << "Magnetic field at nearest neighbor: (" << Bfield[0]/tesla << ", " << Bfield[1]/tesla << ", " << Bfield[2]/tesla << ")" << std::endl;
+
+    double B[3];
+    interpolateCorners(cache.corners, (ax - cache.lo[0]) * cache.invSize[0], (ay - cache.lo[1]) * cache.invSize[1],
+                       (z - cache.lo[2]) * cache.invSize[2], B);
+
+    // Apply symmetry to the magnetic field
+    Bfield[0] = signX * B[0];
+    Bfield[1] = B[1];
+    Bfield[2] = signZ * B[2];
 }
 
-void CustomMagneticField::GetFieldValueLinear(const G4double Point[4], G4double *Bfield) const {
-    // TODO
+void CustomMagneticField::GetFieldValueZPlanes(const G4double Point[4], G4double *Bfield, LookupCache& cache) const {
+    const double ax = std::fabs(Point[0]);
+    const double ay = std::fabs(Point[1]);
+    const double z = Point[2];
+    const double signX = ((Point[0] < 0) != (Point[1] < 0)) ? -1.0 : 1.0;
+    const double signZ = (Point[1] < 0) ? -1.0 : 1.0;
+
+    // Check if the point is outside the grid
+    if (ax > x_max || ay > y_max || z > z_max || ax < x_min || ay < y_min || z < z_min) {
+        Bfield[0] = Bfield[1] = Bfield[2] = 0.0;
+        return;
+    }
+
+    if (!(ax >= cache.lo[0] && ax < cache.hi[0] && ay >= cache.lo[1] && ay < cache.hi[1] &&
+          z >= cache.lo[2] && z < cache.hi[2])) {
+        // Cross-section node(s): the 4 corners of the (x, y) cell, or the nearest node repeated
+        int i0, j0, i1, j1;
+        if (fInterpType == LINEAR) {
+            i0 = std::min(static_cast<int>((ax - x_min) * dx_inv), nx - 2);
+            j0 = std::min(static_cast<int>((ay - y_min) * dy_inv), ny - 2);
+            i1 = i0 + 1;
+            j1 = j0 + 1;
+            cache.lo[0] = x_min + i0 / dx_inv;
+            cache.hi[0] = x_min + i1 / dx_inv;
+            cache.lo[1] = y_min + j0 / dy_inv;
+            cache.hi[1] = y_min + j1 / dy_inv;
+            cache.invSize[0] = dx_inv;
+            cache.invSize[1] = dy_inv;
+        } else {
+            i0 = i1 = static_cast<int>(ax * dx_inv + x_off);
+            j0 = j1 = static_cast<int>(ay * dy_inv + y_off);
+            cache.lo[0] = (i0 - x_off) / dx_inv;
+            cache.hi[0] = std::min((i0 + 1 - x_off) / dx_inv, x_max);
+            cache.lo[1] = (j0 - y_off) / dy_inv;
+            cache.hi[1] = std::min((j0 + 1 - y_off) / dy_inv, y_max);
+            cache.invSize[0] = cache.invSize[1] = 0.0;
+        }
+        // Span of stored planes around z
+        const int k = std::min(static_cast<int>((z - z_min) * dz_inv), nz - 2);
+        int p0 = fPlaneBelow[k];
+        int p1 = p0 + 1;
+        const int k0 = fZPlanes[p0];
+        const int k1 = fZPlanes[p1];
+        if (fInterpType == NEAREST_NEIGHBOR && k1 - k0 == 1) {
+            // Fully resolved slab: nearest plane, restricted to the span so the neighbouring spans keep their own rule
+            const int kn = static_cast<int>(z * dz_inv + z_off);
+            if (kn == k1) p0 = p1;
+            else p1 = p0;
+            cache.lo[2] = z_min + std::max(kn - 0.5, static_cast<double>(k0)) / dz_inv;
+            cache.hi[2] = z_min + std::min(kn + 0.5, static_cast<double>(k1)) / dz_inv;
+            cache.invSize[2] = 0.0;
+        } else {
+            cache.lo[2] = z_min + k0 / dz_inv;
+            cache.hi[2] = z_min + k1 / dz_inv;
+            cache.invSize[2] = dz_inv / (k1 - k0);
+        }
+        const size_t planeNodes = static_cast<size_t>(nx) * ny;
+        for (int c = 0; c < 8; ++c) {
+            const size_t plane = (c & 1) ? p1 : p0;
+            const int i = ((c >> 1) & 1) ? i1 : i0;
+            const int j = ((c >> 2) & 1) ? j1 : j0;
+            loadNode(plane * planeNodes + static_cast<size_t>(j) * nx + i, cache.corners[c]);
+        }
+    }
+
+    double B[3];
+    interpolateCorners(cache.corners, (ax - cache.lo[0]) * cache.invSize[0], (ay - cache.lo[1]) * cache.invSize[1],
+                       (z - cache.lo[2]) * cache.invSize[2], B);
+
+    // Apply symmetry to the magnetic field
+    Bfield[0] = signX * B[0];
+    Bfield[1] = B[1];
+    Bfield[2] = signZ * B[2];
 }
 
 void CustomMagneticField::GetFieldValue(const G4double Point[4], G4double *Bfield) const {
-    if (fInterpType == NEAREST_NEIGHBOR) {
-        GetFieldValueNearestNeighbor(Point, Bfield);
+    LookupCache& cache = tPrivateCaches ? (*tPrivateCaches)[this] : fCache;
+    if (!fOctree.empty()) {
+        GetFieldValueOctree(Point, Bfield, cache);
+    } else if (!fZPlanes.empty()) {
+        GetFieldValueZPlanes(Point, Bfield, cache);
+    } else if (fInterpType == NEAREST_NEIGHBOR) {
+        GetFieldValueNearestNeighbor(Point, Bfield, cache);
     } else {
-        GetFieldValueLinear(Point, Bfield);
+        GetFieldValueLinear(Point, Bfield, cache);
     }
-}
\ No newline at end of file
+}
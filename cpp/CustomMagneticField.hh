@@ -1,27 +1,149 @@
+#ifndef CUSTOMMAGNETICFIELD_HH
+#define CUSTOMMAGNETICFIELD_HH
+
 #include <vector>
 #include <map>
+#include <string>
+#include <cstdint>
+#include <unordered_map>
 #include "G4ThreeVector.hh"
 #include "G4MagneticField.hh"
 
 class CustomMagneticField : public G4MagneticField {
 public:
     enum InterpolationType { NEAREST_NEIGHBOR, LINEAR };
-    CustomMagneticField(const std::map<std::string, std::vector<double>>& ranges, const std::vector<G4ThreeVector>& fields, InterpolationType interpType);
+    // Memory layout of the field grid: float32 or float16 (IEEE half) nodes, stored either
+    // interleaved per node (AoS, one cache line per lookup) or as three component planes (SoA).
+    enum StorageType { FLOAT32_AOS, FLOAT32_SOA, FLOAT16_AOS, FLOAT16_SOA };
+    // Read-only node values in tesla, a flat (Bx, By, Bz) sequence in double, float32 or float16 (IEEE half bits).
+    // A float32 buffer given to a FLOAT32_AOS map, or a float16 one to a FLOAT16_AOS map, is used in place without a
+    // copy (e.g. a memory-mapped field map shared by several processes) and must then outlive the field.
+    // A window (see Window) reads a dense map out of a larger one, e.g. a z slab of the global map, without copying it.
+    struct FieldValues {
+        const double* f64 = nullptr;
+        const float* f32 = nullptr;
+        const uint16_t* f16 = nullptr;
+        size_t count = 0;
+        // Window: the nodes come in (j, i) rows of rowNodes nodes, rowPitch nodes apart in the buffer; 0 if contiguous
+        size_t rowNodes = 0, rowPitch = 0;
+        FieldValues() = default;
+        FieldValues(const std::vector<double>& values) : f64(values.data()), count(values.size()) {}
+        FieldValues(const double* values, size_t count) : f64(values), count(count) {}
+        FieldValues(const float* values, size_t count) : f32(values), count(count) {}
+        FieldValues(const uint16_t* values, size_t count) : f16(values), count(count) {}
+        // The same buffer read as count values in rows of rowNodes nodes, rowPitch nodes apart
+        FieldValues Window(size_t windowCount, size_t windowRowNodes, size_t windowRowPitch) const {
+            FieldValues window = *this;
+            window.count = windowCount;
+            window.rowNodes = windowRowNodes;
+            window.rowPitch = windowRowPitch;
+            return window;
+        }
+        size_t size() const { return count; }
+        double operator[](size_t i) const;
+    };
+    // Last visited cell (in first-quadrant coordinates) and its unsigned field value, or its corner nodes for the
+    // interpolating lookups. Geant4 queries the field several times per step at nearby points, so most calls hit it.
+    struct LookupCache {
+        double lo[3], hi[3];
+        double B[3];
+        // The 8 corner nodes of the cell, ordered (dj, di, dk) as in the flat index
+        double corners[8][3];
+        double invSize[3];
+        LookupCache() { Invalidate(); }
+        void Invalidate();
+    };
+    // While alive, the lookups of every map on the constructing thread use caches of their own instead of the one of
+    // the map, so that thread can query fields shared with the tracking on another one (e.g. query_field without the GIL).
+    class PrivateCaches {
+    public:
+        PrivateCaches();
+        ~PrivateCaches();
+        PrivateCaches(const PrivateCaches&) = delete;
+        PrivateCaches& operator=(const PrivateCaches&) = delete;
+    private:
+        std::unordered_map<const CustomMagneticField*, LookupCache> fCaches;
+        std::unordered_map<const CustomMagneticField*, LookupCache>* fPrevious;
+        friend class CustomMagneticField;
+    };
+    CustomMagneticField(const std::map<std::string, std::vector<double>>& ranges, const std::vector<G4ThreeVector>& fields, InterpolationType interpType, StorageType storageType = FLOAT32_AOS);
+    // fields given in tesla, one (Bx, By, Bz) triplet per node
+    CustomMagneticField(const std::map<std::string, std::vector<double>>& ranges, const FieldValues& fields, InterpolationType interpType, StorageType storageType = FLOAT32_AOS);
+    // Block-sparse map: the grid is split in bricks of brickSize^3 nodes (power of two). brickIndex has one entry per
+    // brick, ordered (bj, bi, bk) like the nodes, giving its position in fields or -1 for an all-zero brick.
+    // Nodes inside a brick are ordered (j, i, k) as well.
+    CustomMagneticField(const std::map<std::string, std::vector<double>>& ranges, const FieldValues& fields,
+                        const std::vector<int>& brickIndex, int brickSize, InterpolationType interpType, StorageType storageType = FLOAT32_AOS);
+    // Adaptive octree map over the grid box: octree holds one entry per cell, the id of its first child (8 consecutive
+    // children ordered (dy, dx, dz)) or -(leaf+1), followed by the 8 corner node ids of every leaf (same order).
+    // fields holds the node values; the field is interpolated trilinearly inside the leaves. Throws std::invalid_argument
+    // if the table is inconsistent.
+    CustomMagneticField(const std::map<std::string, std::vector<double>>& ranges, const FieldValues& fields,
+                        const std::vector<int>& octree, int octreeCells, int octreeDepth, StorageType storageType = FLOAT32_AOS);
+    // z-factorized map for long magnets: only the (x, y) cross-sections at the grid planes listed in zPlanes (sorted
+    // z node indices, first and last included) are stored, ordered (plane, j, i). The field is interpolated linearly in z
+    // between consecutive stored planes; where they are adjacent the regular grid lookup applies.
+    CustomMagneticField(const std::map<std::string, std::vector<double>>& ranges, const FieldValues& fields,
+                        const std::vector<int>& zPlanes, InterpolationType interpType, StorageType storageType = FLOAT32_AOS);
     ~CustomMagneticField();
 
     void GetFieldValue(const G4double Point[4], G4double *Bfield) const override;
-    void GetFieldValueNearestNeighbor(const G4double Point[4], G4double *Bfield) const;
-    void GetFieldValueLinear(const G4double Point[4], G4double *Bfield) const;
+    void GetFieldValueNearestNeighbor(const G4double Point[4], G4double *Bfield, LookupCache& cache) const;
+    void GetFieldValueLinear(const G4double Point[4], G4double *Bfield, LookupCache& cache) const;
+    void GetFieldValueOctree(const G4double Point[4], G4double *Bfield, LookupCache& cache) const;
+    void GetFieldValueZPlanes(const G4double Point[4], G4double *Bfield, LookupCache& cache) const;
+
+    // Box outside which the field is zero (both quadrants unfolded), padded by one grid cell
+    void GetExtent(G4ThreeVector& lo, G4ThreeVector& hi) const;
+
+    static InterpolationType InterpolationTypeFromString(const std::string& name);
+    static StorageType StorageTypeFromString(const std::string& name);
 
 private:
-    std::vector<G4ThreeVector> fFields;
     InterpolationType fInterpType;
+    StorageType fStorageType;
+    size_t fNodes;
+    std::vector<float> fData32;
+    std::vector<uint16_t> fData16;
+    // Node values read by the lookups: fData32 / fData16, or the caller's buffer when used in place
+    const float* fField32;
+    const uint16_t* fField16;
 
     // Grid parameters
     double x_min, x_max, dx_inv;
     double y_min, y_max, dy_inv;
     double z_min, z_max, dz_inv;
+    double x_off, y_off, z_off;
     int nx, ny, nz;
+    // Nodes between consecutive (j, i) rows of a dense grid: nz, or the row pitch of a window used in place
+    size_t fRowPitch;
+
+    // Brick table, empty for a dense grid
+    std::vector<int> fBrickIndex;
+    int fBrickShift, fBrickMask;
+    int nbx, nby, nbz;
+
+    // Octree table, empty for a regular grid
+    std::vector<int> fOctree;
+    int fOctreeCells, fOctreeDepth;
+    double fOctreeScale[3];
+
+    // Stored cross-section planes of a z-factorized map, empty otherwise. fPlaneBelow maps every grid
+    // cell along z to the stored plane starting its span.
+    std::vector<int> fZPlanes;
+    std::vector<int> fPlaneBelow;
+
+    // Cache of the lookups, not thread-safe: one instance per worker, as with the sequential G4RunManager. Other threads
+    // querying the map use their own (see PrivateCaches).
+    mutable LookupCache fCache;
+    static thread_local std::unordered_map<const CustomMagneticField*, LookupCache>* tPrivateCaches;
 
     void initializeGrid(const std::map<std::string, std::vector<double>>& ranges);
-};
\ No newline at end of file
+    void storeFields(const FieldValues& fields, double scale);
+    void loadNode(size_t idx, double* B) const;
+    bool nodeIndex(int i, int j, int k, size_t& idx) const;
+    void loadGridNode(int i, int j, int k, double* B) const;
+    static void interpolateCorners(const double corners[8][3], double fx, double fy, double fz, double* B);
+};
+
+#endif //CUSTOMMAGNETICFIELD_HH
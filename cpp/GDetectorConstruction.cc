@@ -29,6 +29,7 @@
 #include "G4VPhysicalVolume.hh"
 #include "G4VisAttributes.hh"
 #include "G4FieldManager.hh"
+#include "MapRegionFieldManager.hh"
 #include "G4TransportationManager.hh"
 #include "G4ChordFinder.hh"
 #include "G4MagIntegratorStepper.hh"
@@ -41,9 +42,113 @@
 #include "CustomMagneticField.hh"
 //#include "CavernConstruction.hh"
 
+#include <algorithm>
+#include <array>
 #include <iostream>
+#include <map>
 #include <G4Trap.hh>
+#include <G4Trd.hh>
 #include <G4GeometryTolerance.hh>
+#include <stdexcept>
+
+namespace {
+// Field map of the global_field_map entry of the detector JSON, with B_vector in tesla (converted to the compact
+// storage directly, or used in place, see CustomMagneticField::FieldValues) and B_index the layout table.
+G4MagneticField* BuildFieldMap(const Json::Value& fieldMap, const CustomMagneticField::FieldValues& B_vector,
+                               const std::vector<int>& B_index) {
+    std::map<std::string, std::vector<double>> ranges;
+    ranges["range_x"] = {fieldMap["range_x"][0].asDouble() * m, fieldMap["range_x"][1].asDouble() * m, fieldMap["range_x"][2].asDouble() * m};
+    ranges["range_y"] = {fieldMap["range_y"][0].asDouble() * m, fieldMap["range_y"][1].asDouble() * m, fieldMap["range_y"][2].asDouble() * m};
+    ranges["range_z"] = {fieldMap["range_z"][0].asDouble() * m, fieldMap["range_z"][1].asDouble() * m, fieldMap["range_z"][2].asDouble() * m};
+
+    // Determine the interpolation type
+    CustomMagneticField::InterpolationType interpType = CustomMagneticField::InterpolationTypeFromString(
+            fieldMap.get("interpolation", "nearest").asString());
+    CustomMagneticField::StorageType storageType = CustomMagneticField::StorageTypeFromString(
+            fieldMap.get("storage", "float32_aos").asString());
+    G4MagneticField* field;
+    if (fieldMap.isMember("octree_depth")) {
+        int octreeCells = fieldMap["octree_nodes"].asInt();
+        int octreeDepth = fieldMap["octree_depth"].asInt();
+        field = new CustomMagneticField(ranges, B_vector, B_index, octreeCells, octreeDepth, storageType);
+    } else if (fieldMap.isMember("n_z_planes")) {
+        field = new CustomMagneticField(ranges, B_vector, B_index, interpType, storageType);
+    } else if (fieldMap.isMember("brick_size")) {
+        int brickSize = fieldMap["brick_size"].asInt();
+        field = new CustomMagneticField(ranges, B_vector, B_index, brickSize, interpType, storageType);
+    } else {
+        field = new CustomMagneticField(ranges, B_vector, interpType, storageType);
+    }
+    return field;
+}
+
+// Cheapest Geant4 solid equal to the Arb8 n of geometry (see ShieldGeometry::Specialize), with the (x, y) offset of
+// its placement. shapeCounts counts the solids built of every shape.
+G4VSolid* CreateArb8Solid(const G4String& name, const ShieldGeometry& geometry, size_t n, G4ThreeVector& offset,
+                          std::array<int, 4>& shapeCounts) {
+    double vertices[8][3], xyOffset[2];
+    const ShieldGeometry::SolidShape shape = geometry.Specialize(n, vertices, xyOffset);
+    shapeCounts[shape]++;
+    const G4double dz = geometry.dz[n] * m;
+    offset = G4ThreeVector(0, 0, 0);
+    if (shape == ShieldGeometry::GENERIC_TRAP) {
+        std::vector<G4TwoVector> corners_two;
+        const double* corners = &geometry.corners[16 * n];
+        for (int i = 0; i < 8; ++i) {
+            corners_two.push_back(G4TwoVector (corners[i*2] * m, corners[i*2+1] * m));
+        }
+        return new G4GenericTrap(name, dz, corners_two);
+    }
+    offset = G4ThreeVector(xyOffset[0] * m, xyOffset[1] * m, 0);
+    if (shape == ShieldGeometry::BOX)
+        return new G4Box(name, vertices[1][0] * m, vertices[2][1] * m, dz);
+    if (shape == ShieldGeometry::TRD)
+        return new G4Trd(name, vertices[1][0] * m, vertices[5][0] * m, vertices[2][1] * m, vertices[6][1] * m, dz);
+    G4ThreeVector pt[8];
+    for (int i = 0; i < 8; ++i) pt[i] = G4ThreeVector(vertices[i][0] * m, vertices[i][1] * m, i < 4 ? -dz : dz);
+    return new G4Trap(name, pt);
+}
+
+// Field of the local maps outside the magnet volumes (world), so the fringe field in the gaps and apertures around the
+// magnets is kept: every point takes the map whose z range holds it. The maps are slices of one global map, so where
+// the ranges of neighbouring magnets overlap both give the same field.
+class LocalMapsField : public G4MagneticField {
+public:
+    void Add(const CustomMagneticField* map, double zMin, double zMax) { fMaps.push_back({map, zMin, zMax}); }
+    bool Empty() const { return fMaps.empty(); }
+    void GetFieldValue(const G4double Point[4], G4double* Bfield) const override {
+        for (const auto& map : fMaps) {
+            if (Point[2] >= map.zMin && Point[2] <= map.zMax) {
+                map.field->GetFieldValue(Point, Bfield);
+                return;
+            }
+        }
+        Bfield[0] = Bfield[1] = Bfield[2] = 0.0;
+    }
+    // Box holding the extents of all the maps (see CustomMagneticField::GetExtent)
+    void GetExtent(G4ThreeVector& lo, G4ThreeVector& hi) const {
+        for (size_t n = 0; n < fMaps.size(); ++n) {
+            G4ThreeVector mapLo, mapHi;
+            fMaps[n].field->GetExtent(mapLo, mapHi);
+            if (n == 0) { lo = mapLo; hi = mapHi; continue; }
+            for (int c = 0; c < 3; ++c) {
+                lo[c] = std::min(lo[c], mapLo[c]);
+                hi[c] = std::max(hi[c], mapHi[c]);
+            }
+        }
+    }
+private:
+    struct LocalMap { const CustomMagneticField* field; double zMin, zMax; };
+    std::vector<LocalMap> fMaps;
+};
+
+G4FieldManager* CreateFieldManager(G4MagneticField* field) {
+    auto fieldManager = new G4FieldManager();
+    fieldManager->SetDetectorField(field);
+    fieldManager->CreateChordFinder(field);
+    return fieldManager;
+}
+}
 
 G4VPhysicalVolume *GDetectorConstruction::Construct() {
     //#include <chrono>
@@ -86,26 +191,6 @@ G4VPhysicalVolume *GDetectorConstruction::Construct() {
     logicWorld->SetUserLimits(userLimits2);
     
     G4VPhysicalVolume* physWorld = new G4PVPlacement(0, G4ThreeVector(0, 0, 0), logicWorld, "WorldZ", 0, false, 0, true);
-    if (detectorData.isMember("cavern")) {
-        const Json::Value caverns = detectorData["cavern"];
-        for (const auto& cavern : caverns){
-            G4double z_center = cavern["z_center"].asDouble() * m;
-            G4double dz = cavern["dz"].asDouble() * m;
-            Json::Value cavern_blocks = cavern["components"];
-            G4Material* boxMaterial = nist->FindOrBuildMaterial(cavern["material"].asString());
-            for (auto block: cavern_blocks){
-                std::vector<G4TwoVector> corners;
-                for (int i = 0; i < 8; ++i) {
-                corners.push_back(G4TwoVector (block[i*2].asDouble() * m, block[i*2+1].asDouble() * m));
-                    }
-                auto genericV = new G4GenericTrap(G4String("cavern_block"), dz, corners);
-                auto logicG = new G4LogicalVolume(genericV, boxMaterial, "cavern_log");
-                new G4PVPlacement(0, G4ThreeVector(0, 0, z_center), logicG, "cavern", logicWorld, false, 0, true);
-                logicG->SetUserLimits(userLimits2);
-            }
-        
-        }
-    }
     if (detectorData.isMember("target")) {
         const Json::Value targets = detectorData["target"];
         int i = 0;
@@ -126,98 +211,103 @@ G4VPhysicalVolume *GDetectorConstruction::Construct() {
         }
     }
     // Process the magnets from the JSON variable
-    Json::Value field_value = detectorData["global_field_map"];
-    const Json::Value magnets = detectorData["magnets"];
-
     G4MagneticField* GlobalmagField = nullptr;
     if (!B_vector.empty()) {
-        std::map<std::string, std::vector<double>> ranges;
-        std::vector<G4ThreeVector> fields;
-        ranges["range_x"] = {detectorData["global_field_map"]["range_x"][0].asDouble() * m, detectorData["global_field_map"]["range_x"][1].asDouble() * m, detectorData["global_field_map"]["range_x"][2].asDouble() * m};
-        ranges["range_y"] = {detectorData["global_field_map"]["range_y"][0].asDouble() * m, detectorData["global_field_map"]["range_y"][1].asDouble() * m, detectorData["global_field_map"]["range_y"][2].asDouble() * m};
-        ranges["range_z"] = {detectorData["global_field_map"]["range_z"][0].asDouble() * m, detectorData["global_field_map"]["range_z"][1].asDouble() * m, detectorData["global_field_map"]["range_z"][2].asDouble() * m};
-
-        for (size_t i = 0; i < B_vector.size(); i += 3) {
-            fields.emplace_back(B_vector[i] * tesla, B_vector[i + 1] * tesla, B_vector[i + 2] * tesla);
-        }
-        // Determine the interpolation type
-        CustomMagneticField::InterpolationType interpType = CustomMagneticField::NEAREST_NEIGHBOR;
-        // Define the custom magnetic field
-        GlobalmagField = new CustomMagneticField(ranges, fields, interpType);
+        GlobalmagField = BuildFieldMap(detectorData["global_field_map"], B_vector, B_index);
+        // converted to the compact storage, the copies given to the constructor are no longer needed
+        std::vector<double>().swap(B_vector);
+        std::vector<int>().swap(B_index);
     }
+    // The map is still being simulated: the components of the global profile get it in attachGlobalField
+    const bool deferField = !GlobalmagField && detectorData["global_field_map"].get("deferred", false).asBool();
+    globalMagField = GlobalmagField;
     //const Json::Value fields = detectorData["field_map"];
+    if (geometry.size() == 0) geometry = ShieldGeometry::FromJson(detectorData);
+    geometry.Check();
+    std::vector<G4Material*> materials;
+    for (const auto& materialName : geometry.materials) materials.push_back(nist->FindOrBuildMaterial(materialName));
+    std::cout<<"Adding "<<geometry.size()<<" solids"<<std::endl;
+    // Field managers (with their chord finder) are shared by all the components with the same field: one per uniform
+    // field value, one per local map and one for the global map
+    std::map<std::array<double, 3>, G4FieldManager*> uniformFieldManagers;
+    std::map<int, G4FieldManager*> localFieldManagers;
+    LocalMapsField localMapsField;
+    G4FieldManager* globalFieldManager = nullptr;
+    int nFieldComponents = 0;
+    std::array<int, 4> shapeCounts = {0, 0, 0, 0};
     double totalWeight = 0;
-    for (const auto& magnet : magnets) {
-
-        std::cout<<"Adding box"<<std::endl;
-        // Get the material for the magnet
-        std::string materialName = magnet["material"].asString();
-        G4Material* boxMaterial = nist->FindOrBuildMaterial(materialName);
-
-        G4double z_center = magnet["z_center"].asDouble() * m;
-        G4double dz = magnet["dz"].asDouble() * m;
-
-        Json::Value arb8s = magnet["components"];
-        for (auto arb8: arb8s) {
-            std::vector<G4TwoVector> corners_two;
-            Json::Value corners = arb8["corners"];
-            
-            for (int i = 0; i < 8; ++i) {
-                corners_two.push_back(G4TwoVector (corners[i*2].asDouble() * m, corners[i*2+1].asDouble() * m));
-            }
-            Json::Value field_value = arb8["field"];
-            G4double fieldX;
-            G4double fieldY;
-            G4double fieldZ;
-            G4ThreeVector fieldValue;
-            G4MagneticField* magField = nullptr;
-            if (arb8["field_profile"].asString() == "global") {
-                magField = GlobalmagField;
-            } else if (arb8["field_profile"].asString() == "uniform"){
-                fieldX = field_value[0].asDouble();
-                fieldY = field_value[1].asDouble();
-                fieldZ = field_value[2].asDouble();
-                fieldValue = G4ThreeVector(fieldX * tesla, fieldY * tesla, fieldZ * tesla);
+    for (size_t n = 0; n < geometry.size(); ++n) {
+        G4Material* boxMaterial = materials[geometry.material[n]];
+        G4double z_center = geometry.zCenter[n] * m;
+        const int fieldProfile = geometry.fieldProfile[n];
+        G4ThreeVector offset;
+        if (fieldProfile == ShieldGeometry::NO_FIELD) {
+            auto genericV = CreateArb8Solid(G4String("cavern_block"), geometry, n, offset, shapeCounts);
+            auto logicG = new G4LogicalVolume(genericV, boxMaterial, "cavern_log");
+            new G4PVPlacement(0, offset + G4ThreeVector(0, 0, z_center), logicG, "cavern", logicWorld, false, 0, true);
+            logicG->SetUserLimits(userLimits2);
+            continue;
+        }
+        G4FieldManager* FieldManager = nullptr;
+        if (fieldProfile == ShieldGeometry::GLOBAL) {
+            // magnets without a FEM map use the uniform or local profiles, a global one needs the map
+            if (!GlobalmagField && !deferField)
+                throw std::runtime_error("Magnet component with a global field profile but no global field map.");
+            if (GlobalmagField && !globalFieldManager) globalFieldManager = CreateFieldManager(GlobalmagField);
+            FieldManager = globalFieldManager;
+        } else if (fieldProfile == ShieldGeometry::UNIFORM) {
+            const double* field = &geometry.field[3 * n];
+            G4FieldManager*& uniformFieldManager = uniformFieldManagers[{field[0], field[1], field[2]}];
+            if (!uniformFieldManager) {
+                G4ThreeVector fieldValue = G4ThreeVector(field[0] * tesla, field[1] * tesla, field[2] * tesla);
                 // Create and set the uniform magnetic field for the box
-                magField = new G4UniformMagField(fieldValue);
-            } else {
-                std::map<std::string, std::vector<double>> ranges;
-                std::vector<G4ThreeVector> fields;
-                //const Json::Value& pointsData = field_value[0];
-                //const Json::Value& fieldsData = field_value[1];
-                ranges["range_x"] = {field_value["range_x"][0].asDouble() * m, field_value["range_x"][1].asDouble() * m, field_value["range_x"][2].asDouble() * m};
-                ranges["range_y"] = {field_value["range_y"][0].asDouble() * m, field_value["range_y"][1].asDouble() * m, field_value["range_y"][2].asDouble() * m};
-                ranges["range_z"] = {field_value["range_z"][0].asDouble() * m, field_value["range_z"][1].asDouble() * m, field_value["range_z"][2].asDouble() * m};
-
-                const Json::Value& fieldsData = field_value["B"];
-                for (Json::ArrayIndex i = 0; i < fieldsData.size(); ++i) {
-                    //points.emplace_back(pointsData[i][0].asDouble() * m, pointsData[i][1].asDouble() * m, pointsData[i][2].asDouble() * m);
-                    fields.emplace_back(fieldsData[i][0].asDouble() * tesla, fieldsData[i][1].asDouble() * tesla, fieldsData[i][2].asDouble() * tesla);
-                }
-                // Determine the interpolation type
-                CustomMagneticField::InterpolationType interpType = CustomMagneticField::NEAREST_NEIGHBOR;
-                // Define the custom magnetic field
-                magField = new CustomMagneticField(ranges, fields, interpType);
+                uniformFieldManager = CreateFieldManager(new G4UniformMagField(fieldValue));
             }
-            
-            auto FieldManager = new G4FieldManager();
-            FieldManager->SetDetectorField(magField);
-            FieldManager->CreateChordFinder(magField);
-            auto genericV = new G4GenericTrap(G4String("sdf"), dz, corners_two);
-            auto logicG = new G4LogicalVolume(genericV, boxMaterial, "gggvl");
-            double volArb = boxMaterial->GetDensity() /(kg/m3)  * genericV->GetCubicVolume()/(m3);
-            totalWeight += volArb;
-            logicG->SetFieldManager(FieldManager, true);
-            new G4PVPlacement(0, G4ThreeVector(0, 0, z_center), logicG, "BoxZ", logicWorld, false, 0, true);
-            logicG->SetUserLimits(userLimits2);
+            FieldManager = uniformFieldManager;
+        } else if (localFieldManagers.count(geometry.localField[n])) {
+            FieldManager = localFieldManagers[geometry.localField[n]];
+        } else {
+            const int k = geometry.localField[n];
+            const double* range = &geometry.localRanges[9 * k];
+            std::map<std::string, std::vector<double>> ranges;
+            ranges["range_x"] = {range[0] * m, range[1] * m, range[2] * m};
+            ranges["range_y"] = {range[3] * m, range[4] * m, range[5] * m};
+            ranges["range_z"] = {range[6] * m, range[7] * m, range[8] * m};
+            // Determine the interpolation type
+            CustomMagneticField::InterpolationType interpType = CustomMagneticField::InterpolationTypeFromString(geometry.localInterpolation[k]);
+            CustomMagneticField::StorageType storageType = CustomMagneticField::StorageTypeFromString(geometry.localStorage[k]);
+            // Define the custom magnetic field, reading the values in place where the storage allows it
+            auto localField = new CustomMagneticField(ranges, geometry.LocalField(k), interpType, storageType);
+            localMapsField.Add(localField, ranges["range_z"][0], ranges["range_z"][1]);
+            FieldManager = localFieldManagers[k] = CreateFieldManager(localField);
+        }
+        ++nFieldComponents;
 
+        auto genericV = CreateArb8Solid(G4String("sdf"), geometry, n, offset, shapeCounts);
+        auto logicG = new G4LogicalVolume(genericV, boxMaterial, "gggvl");
+        double volArb = boxMaterial->GetDensity() /(kg/m3)  * genericV->GetCubicVolume()/(m3);
+        totalWeight += volArb;
+        if (FieldManager) {
+            logicG->SetFieldManager(FieldManager, true);
+        } else {
+            deferredFieldVolumes.push_back(logicG);
         }
+        new G4PVPlacement(0, offset + G4ThreeVector(0, 0, z_center), logicG, "BoxZ", logicWorld, false, 0, true);
+        logicG->SetUserLimits(userLimits2);
     }
+    std::cout<<uniformFieldManagers.size() + localFieldManagers.size() + (globalFieldManager || !deferredFieldVolumes.empty() ? 1 : 0)
+             <<" field managers for "<<nFieldComponents<<" magnet components"<<std::endl;
+    std::cout<<"Solids specialized: "<<shapeCounts[ShieldGeometry::BOX]<<" G4Box, "<<shapeCounts[ShieldGeometry::TRD]<<" G4Trd, "
+             <<shapeCounts[ShieldGeometry::TRAP]<<" G4Trap, "<<shapeCounts[ShieldGeometry::GENERIC_TRAP]<<" left as G4GenericTrap"<<std::endl;
+    // The solids are built, release the arrays as the field map
+    geometry = ShieldGeometry();
+    worldLogical = logicWorld;
     if (GlobalmagField) {
-        auto fieldManager = new G4FieldManager();
-        fieldManager->SetDetectorField(GlobalmagField);
-        fieldManager->CreateChordFinder(GlobalmagField);
-        logicWorld->SetFieldManager(fieldManager, true);
+        attachWorldField(GlobalmagField);
+    } else if (!localMapsField.Empty()) {
+        G4ThreeVector lo, hi;
+        localMapsField.GetExtent(lo, hi);
+        attachWorldField(new LocalMapsField(localMapsField), lo, hi);
     }
 
 
@@ -253,9 +343,42 @@ G4VPhysicalVolume *GDetectorConstruction::Construct() {
 
 
 
-GDetectorConstruction::GDetectorConstruction(Json::Value detector_data, const std::vector<double>& B_vector)
-    : detectorData(detector_data), B_vector(B_vector) {
+GDetectorConstruction::GDetectorConstruction(Json::Value detector_data, const std::vector<double>& B_vector, const std::vector<int>& B_index,
+                                             ShieldGeometry geometry)
+    : detectorData(detector_data), geometry(std::move(geometry)), B_vector(B_vector), B_index(B_index) {
     detectorWeightTotal = 0;
+    globalMagField = nullptr;
+    worldLogical = nullptr;
+}
+
+void GDetectorConstruction::attachWorldField(G4MagneticField* field) {
+    G4ThreeVector lo, hi;
+    static_cast<CustomMagneticField*>(field)->GetExtent(lo, hi);
+    attachWorldField(field, lo, hi);
+}
+
+void GDetectorConstruction::attachWorldField(G4MagneticField* field, const G4ThreeVector& lo, const G4ThreeVector& hi) {
+    // The map only covers the magnets: the world field is switched off for tracks that cannot reach it,
+    // so the drift through air and cavern is transported in straight lines
+    auto fieldManager = new MapRegionFieldManager(field, lo, hi);
+    // only passed to the daughters without a field manager: the magnets keep their own
+    worldLogical->SetFieldManager(fieldManager, false);
+}
+
+void GDetectorConstruction::attachGlobalField(const Json::Value& fieldMap, const CustomMagneticField::FieldValues& B,
+                                              const std::vector<int>& index) {
+    if (globalMagField)
+        throw std::runtime_error("The detector already has a global field map.");
+    if (!worldLogical)
+        throw std::runtime_error("The detector must be constructed before attaching its field map.");
+    globalMagField = BuildFieldMap(fieldMap, B, index);
+    // shared by all the components of the global profile, as in Construct
+    G4FieldManager* fieldManager = deferredFieldVolumes.empty() ? nullptr : CreateFieldManager(globalMagField);
+    for (auto logical : deferredFieldVolumes) {
+        logical->SetFieldManager(fieldManager, true);
+    }
+    deferredFieldVolumes.clear();
+    attachWorldField(globalMagField);
 }
 
 void GDetectorConstruction::setMagneticFieldValue(double strength, double theta, double phi) {
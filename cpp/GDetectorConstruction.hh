@@ -8,22 +8,40 @@
 #include "DetectorConstruction.hh"
 #include "json/json.h"
 #include "SlimFilmSensitiveDetector.hh"
+#include "ShieldGeometry.hh"
+#include "CustomMagneticField.hh"
 
 class GDetectorConstruction : public DetectorConstruction {
 public:
     virtual G4VPhysicalVolume *Construct();
     SlimFilmSensitiveDetector* slimFilmSensitiveDetector;
+    // Field map of the whole shield (nullptr without one), kept for direct field queries
+    G4MagneticField* globalMagField;
+    // Builds the global field map of a detector constructed with a deferred one ("deferred" in global_field_map)
+    // and gives it to the components of the global profile and to the world. B may be used in place (see
+    // CustomMagneticField::FieldValues), the caller then keeps it alive with the detector.
+    void attachGlobalField(const Json::Value& fieldMap, const CustomMagneticField::FieldValues& B, const std::vector<int>& index);
 public:
-    GDetectorConstruction(Json::Value detector_data, const std::vector<double>& B_vector);
+    // The solids are taken from geometry, or from the "cavern" and "magnets" of detector_data if it is empty
+    GDetectorConstruction(Json::Value detector_data, const std::vector<double>& B_vector, const std::vector<int>& B_index = {},
+                          ShieldGeometry geometry = ShieldGeometry());
 protected:
     Json::Value detectorData;
+    ShieldGeometry geometry;
     std::vector<double> B_vector;
+    std::vector<int> B_index;
 public:
     void ConstructSDandField() override;
 
 protected:
     double detectorWeightTotal;
     G4LogicalVolume* sensitiveLogical;
+    G4LogicalVolume* worldLogical;
+    // Components of the global profile waiting for a deferred field map
+    std::vector<G4LogicalVolume*> deferredFieldVolumes;
+    // Field of the world outside the magnets, switched off outside the box [lo, hi] (by default the extent of the map)
+    void attachWorldField(G4MagneticField* field);
+    void attachWorldField(G4MagneticField* field, const G4ThreeVector& lo, const G4ThreeVector& hi);
 public:
     double getDetectorWeight() override;
     void setMagneticFieldValue(double strength, double theta, double phi) override;
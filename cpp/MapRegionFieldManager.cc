@@ -0,0 +1,34 @@
+#include "MapRegionFieldManager.hh"
+#include "G4Track.hh"
+#include "G4MagneticField.hh"
+#include <algorithm>
+#include <cmath>
+#include <limits>
+
+MapRegionFieldManager::MapRegionFieldManager(G4MagneticField* field, const G4ThreeVector& lo, const G4ThreeVector& hi)
+    : G4FieldManager(field), fMapField(field), fLo(lo), fHi(hi) {
+    CreateChordFinder(field);
+}
+
+void MapRegionFieldManager::ConfigureForTrack(const G4Track* track) {
+    G4Field* field = LineCrossesRegion(track->GetPosition(), track->GetMomentumDirection()) ? fMapField : nullptr;
+    if (field != GetDetectorField()) SetDetectorField(field);
+}
+
+bool MapRegionFieldManager::LineCrossesRegion(const G4ThreeVector& p, const G4ThreeVector& d) const {
+    // slab test of the half line p + t*d, t >= 0, against the box
+    double tMin = 0., tMax = std::numeric_limits<double>::max();
+    for (int a = 0; a < 3; ++a) {
+        if (std::abs(d[a]) < 1e-12) {
+            if (p[a] < fLo[a] || p[a] > fHi[a]) return false;
+            continue;
+        }
+        double t1 = (fLo[a] - p[a]) / d[a];
+        double t2 = (fHi[a] - p[a]) / d[a];
+        if (t1 > t2) std::swap(t1, t2);
+        tMin = std::max(tMin, t1);
+        tMax = std::min(tMax, t2);
+        if (tMin > tMax) return false;
+    }
+    return true;
+}
@@ -0,0 +1,30 @@
+#ifndef MAPREGIONFIELDMANAGER_HH
+#define MAPREGIONFIELDMANAGER_HH
+
+#include "G4FieldManager.hh"
+#include "G4ThreeVector.hh"
+
+class G4Field;
+class G4MagneticField;
+class G4Track;
+
+// Field manager of a volume much larger than its field map (the world). Before every step, the field is switched off
+// when the track is outside the box [lo, hi] where the map is non-zero and its straight line does not cross it, so the
+// step is transported as a straight line instead of being integrated through a zero field. As soon as the line points
+// into the box the field is switched back on.
+class MapRegionFieldManager : public G4FieldManager {
+public:
+    MapRegionFieldManager(G4MagneticField* field, const G4ThreeVector& lo, const G4ThreeVector& hi);
+
+    void ConfigureForTrack(const G4Track* track) override;
+    // Field of the map, whether or not it is switched on for the current track
+    G4Field* GetMapField() const { return fMapField; }
+
+private:
+    G4Field* fMapField;
+    G4ThreeVector fLo, fHi;
+
+    bool LineCrossesRegion(const G4ThreeVector& p, const G4ThreeVector& d) const;
+};
+
+#endif //MAPREGIONFIELDMANAGER_HH
@@ -23,6 +23,12 @@
 #include "GDetectorConstruction.hh"
 #include "SlimFilm.hh"
 #include "json/json.h"
+#include "G4Navigator.hh"
+#include "G4TransportationManager.hh"
+#include "G4FieldManager.hh"
+#include "MapRegionFieldManager.hh"
+#include "G4MagneticField.hh"
+#include "G4SystemOfUnits.hh"
 #include <iostream>
 #include <sstream>
 #include <stdexcept> // For standard exceptions like std::runtime_error
@@ -170,6 +176,106 @@ py::dict collect() {
     return d;
 }
 
+py::array_t<double> query_field(py::array_t<double, py::array::c_style | py::array::forcecast> points, bool use_navigator) {
+    // Field (T) seen by Geant4 at the given points (m). With use_navigator, each point is located in the geometry and the
+    // field manager of its volume is queried, as during tracking; otherwise the global field map is called directly.
+    auto detector2 = dynamic_cast<GDetectorConstruction*>(detector);
+    if (detector2 == nullptr || ui_manager == nullptr) {
+        throw std::runtime_error("Field queries need an initialized GDetectorConstruction.");
+    }
+    if (points.ndim() != 2 || points.shape(1) != 3) {
+        throw std::runtime_error("Points must be an array of shape (N, 3).");
+    }
+    if (!use_navigator && detector2->globalMagField == nullptr) {
+        throw std::runtime_error("The detector has no global field map.");
+    }
+    const size_t n = points.shape(0);
+    py::array_t<double> fields({n, static_cast<size_t>(3)});
+    const double* p = points.data();
+    double* B = fields.mutable_data();
+    {
+        // Private navigator and lookup caches, so the state of the tracking is left untouched and other Python threads
+        // (e.g. running simulate_muon) can go on while the points are looked up
+        CustomMagneticField::PrivateCaches caches;
+        py::gil_scoped_release release;
+        G4Navigator navigator;
+        navigator.SetWorldVolume(G4TransportationManager::GetTransportationManager()->GetNavigatorForTracking()->GetWorldVolume());
+        bool relative = false;
+        for (size_t i = 0; i < n; ++i) {
+            const G4double point[4] = {p[3 * i] * m, p[3 * i + 1] * m, p[3 * i + 2] * m, 0.};
+            G4double value[6] = {0., 0., 0., 0., 0., 0.};
+            const G4Field* field = detector2->globalMagField;
+            if (use_navigator) {
+                G4VPhysicalVolume* volume = navigator.LocateGlobalPointAndSetup(G4ThreeVector(point[0], point[1], point[2]), nullptr, relative, true);
+                relative = true;
+                G4FieldManager* fieldManager = volume ? volume->GetLogicalVolume()->GetFieldManager() : nullptr;
+                field = fieldManager ? fieldManager->GetDetectorField() : nullptr;
+                // the world field is switched on and off per track, query the map itself
+                if (auto regionManager = dynamic_cast<MapRegionFieldManager*>(fieldManager)) field = regionManager->GetMapField();
+            }
+            if (field) field->GetFieldValue(point, value);
+            B[3 * i] = value[0] / tesla;
+            B[3 * i + 1] = value[1] / tesla;
+            B[3 * i + 2] = value[2] / tesla;
+        }
+    }
+    return fields;
+}
+
+template <typename T>
+std::vector<T> geometry_array(const py::dict& geometry, const char* key) {
+    auto a = geometry[key].cast<py::array_t<T, py::array::c_style | py::array::forcecast>>();
+    return std::vector<T>(a.data(), a.data() + a.size());
+}
+
+CustomMagneticField::FieldValues local_field_view(const py::array& B) {
+    // A float32 or float16 local map of shape (ny, nx, nz, 3) with contiguous nodes and evenly strided (j, i) rows, e.g.
+    // a z slab of the memory-mapped global map (see local_field_map in ship_muon_shield_customfield.py), as a window
+    // of its buffer. Empty for the other arrays, which are copied.
+    const bool f32 = py::isinstance<py::array_t<float>>(B);
+    const bool f16 = B.dtype().kind() == 'f' && B.itemsize() == 2;
+    if (!(f32 || f16) || B.ndim() != 4 || B.shape(3) != 3) return CustomMagneticField::FieldValues();
+    const py::ssize_t item = B.itemsize();
+    const py::ssize_t rowPitch = B.strides(1) / (3 * item);
+    if (B.strides(3) != item || B.strides(2) != 3 * item || B.strides(1) != 3 * item * rowPitch
+        || B.strides(0) != B.shape(1) * B.strides(1) || rowPitch < B.shape(2))
+        return CustomMagneticField::FieldValues();
+    CustomMagneticField::FieldValues values = f32 ? CustomMagneticField::FieldValues(static_cast<const float*>(B.data()), 0)
+                                                  : CustomMagneticField::FieldValues(static_cast<const uint16_t*>(B.data()), 0);
+    return values.Window(B.size(), B.shape(2), rowPitch);
+}
+
+ShieldGeometry geometry_from_dict(const py::dict& geometry) {
+    // Arrays of pack_geometry (ship_muon_shield_customfield.py), see ShieldGeometry
+    ShieldGeometry shieldGeometry;
+    shieldGeometry.materials = geometry["materials"].cast<std::vector<std::string>>();
+    shieldGeometry.corners = geometry_array<double>(geometry, "corners");
+    shieldGeometry.dz = geometry_array<double>(geometry, "dz");
+    shieldGeometry.zCenter = geometry_array<double>(geometry, "z_center");
+    shieldGeometry.material = geometry_array<int>(geometry, "material");
+    shieldGeometry.fieldProfile = geometry_array<int>(geometry, "field_profile");
+    shieldGeometry.field = geometry_array<double>(geometry, "field");
+    shieldGeometry.localField = geometry_array<int>(geometry, "local_field");
+    shieldGeometry.localRanges = geometry_array<double>(geometry, "local_ranges");
+    for (auto item : geometry["local_B"].cast<py::list>()) {
+        auto B = py::reinterpret_borrow<py::array>(item);
+        shieldGeometry.localValues.push_back(local_field_view(B));
+        if (shieldGeometry.localValues.back().size()) {
+            // read in place by the detector, for as long as the module is loaded
+            B.inc_ref();
+            shieldGeometry.localB.emplace_back();
+        } else {
+            auto B_double = py::array_t<double, py::array::c_style | py::array::forcecast>::ensure(B);
+            if (!B_double) throw std::invalid_argument("The local field maps must be numeric arrays.");
+            shieldGeometry.localB.emplace_back(B_double.data(), B_double.data() + B_double.size());
+        }
+    }
+    shieldGeometry.localInterpolation = geometry["local_interpolation"].cast<std::vector<std::string>>();
+    shieldGeometry.localStorage = geometry["local_storage"].cast<std::vector<std::string>>();
+    shieldGeometry.Check();
+    return shieldGeometry;
+}
+
 void set_field_value(double strength, double theta, double phi) {
     detector->setMagneticFieldValue(strength, theta, phi);
 }
@@ -179,7 +285,8 @@ void set_kill_momenta(double kill_momenta) {
 }
 
 std::string initialize( int rseed_0,
-                 int rseed_1, int rseed_2, int rseed_3, std::string detector_specs, py::array_t<double> B) {
+                 int rseed_1, int rseed_2, int rseed_3, std::string detector_specs, py::array_t<double> B,
+                 py::array_t<int, py::array::c_style | py::array::forcecast> B_index, py::object geometry) {
     randomEngine = new CLHEP::MTwistEngine(rseed_0);
     //#include <chrono>
     //auto start = std::chrono::high_resolution_clock::now(); 
@@ -196,9 +303,12 @@ std::string initialize( int rseed_0,
     // Convert numpy array to std::vector
     std::vector<double> B_map(B.size());
     std::memcpy(B_map.data(), B.data(), B.size() * sizeof(double));
+    // Brick table of a block-sparse field map (empty for a dense map)
+    std::vector<int> B_index_map(B_index.data(), B_index.data() + B_index.size());
 
 
     bool applyStepLimiter = false;
+    bool deferredField = false;
     bool storeAll = false;
     bool storePrimary = true;
     
@@ -223,6 +333,7 @@ std::string initialize( int rseed_0,
         
 
         int type = detectorData["type"].asInt();
+        deferredField = detectorData["global_field_map"].get("deferred", false).asBool();
         applyStepLimiter = (detectorData["limits"]["max_step_length"].asDouble() > 0);
         if (type==3) {
             detector = new DetectorConstruction(detectorData);
@@ -232,7 +343,8 @@ std::string initialize( int rseed_0,
         else if (type == 4)
             detector = new ToyDetectorConstruction(detectorData, B_map);
         else if (type == 1)
-            detector = new GDetectorConstruction(detectorData, B_map);
+            detector = new GDetectorConstruction(detectorData, B_map, B_index_map,
+                                                 geometry.is_none() ? ShieldGeometry() : geometry_from_dict(geometry.cast<py::dict>()));
         else if (type == 2) {
             detector = new SlimFilm(detectorData);
         } else
@@ -284,6 +396,11 @@ std::string initialize( int rseed_0,
 
     ui_manager->ApplyCommand(std::string("/run/initialize"));
     std::cout<<"Run initialized"<<std::endl;
+    if (deferredField) {
+        // Build the physics tables now, while the field map is still being simulated
+        ui_manager->ApplyCommand(std::string("/run/beamOn 0"));
+        std::cout<<"Physics tables built, waiting for the field map"<<std::endl;
+    }
     ui_manager->ApplyCommand(std::string("/run/printProgress 100"));
 
     std::cout<<"Initialized"<<std::endl;
@@ -299,6 +416,40 @@ std::string initialize( int rseed_0,
     return output;
 }
 
+void attach_field_map(std::string field_map_specs, py::array B,
+                      py::array_t<int, py::array::c_style | py::array::forcecast> B_index) {
+    auto detector2 = dynamic_cast<GDetectorConstruction*>(detector);
+    if (detector2 == nullptr) {
+        throw std::runtime_error("Field maps can only be attached to an initialized GDetectorConstruction.");
+    }
+    Json::Value fieldMap;
+    Json::CharReaderBuilder readerBuilder;
+    std::string errs;
+    std::istringstream iss(field_map_specs);
+    if (!Json::parseFromStream(readerBuilder, iss, &fieldMap, &errs)) {
+        throw std::runtime_error("Failed to parse the field map JSON: " + errs);
+    }
+    // A C-contiguous float32 or float16 map (e.g. memory-mapped from the field map file) is used in place by the
+    // storage of the same precision, so the processes attaching the same file share its pages instead of each holding
+    // a copy. Other arrays are converted to double, then to the storage.
+    CustomMagneticField::FieldValues values;
+    py::array_t<double, py::array::c_style | py::array::forcecast> B_double;
+    if (py::isinstance<py::array_t<float, py::array::c_style>>(B)) {
+        values = CustomMagneticField::FieldValues(static_cast<const float*>(B.data()), B.size());
+    } else if (B.dtype().kind() == 'f' && B.itemsize() == 2 && (B.flags() & py::array::c_style)) {
+        values = CustomMagneticField::FieldValues(static_cast<const uint16_t*>(B.data()), B.size());
+    } else {
+        B_double = py::array_t<double, py::array::c_style | py::array::forcecast>::ensure(B);
+        if (!B_double) throw std::invalid_argument("The field map B must be a numeric array.");
+        values = CustomMagneticField::FieldValues(B_double.data(), B_double.size());
+    }
+    std::vector<int> B_index_map(B_index.data(), B_index.data() + B_index.size());
+    detector2->attachGlobalField(fieldMap, values, B_index_map);
+    // the detector may keep referencing B, for as long as the module is loaded
+    B.inc_ref();
+    std::cout<<"Field map attached"<<std::endl;
+}
+
 void kill_secondary_tracks(bool do_kill) {
     steppingAction->setKillSecondary(do_kill);
 }
@@ -328,10 +479,16 @@ void visualize() {
 PYBIND11_MODULE(muon_slabs, m) {
     m.def("add", &add, "A function which adds two numbers");
     m.def("simulate_muon", &simulate_muon, "A function which simulates a muon through geant4 and returns the steps");
-    m.def("initialize", &initialize, "Initialize geant4 stuff");
+    m.def("initialize", &initialize, "Initialize geant4 stuff",
+          py::arg("rseed_0"), py::arg("rseed_1"), py::arg("rseed_2"), py::arg("rseed_3"),
+          py::arg("detector_specs"), py::arg("B"), py::arg("B_index") = py::array_t<int>(), py::arg("geometry") = py::none());
     m.def("collect", &collect, "Collect back the data");
     m.def("collect_from_sensitive", &collect_from_sensitive, "Collect back the data from the sensitive film placed");
     m.def("set_field_value", &set_field_value, "Set the magnetic field value");
+    m.def("query_field", &query_field, "Field (T) seen by Geant4 at an (N, 3) array of points (m)",
+          py::arg("points"), py::arg("use_navigator") = true);
+    m.def("attach_field_map", &attach_field_map, "Attach the global field map to a detector initialized with a deferred one",
+          py::arg("field_map_specs"), py::arg("B"), py::arg("B_index") = py::array_t<int>());
     m.def("set_kill_momenta", &set_kill_momenta, "Set the kill momenta");
     m.def("kill_secondary_tracks", &kill_secondary_tracks, "Kill all tracks from resulting cascade");
     m.def("visualize", &visualize, "Visualize");
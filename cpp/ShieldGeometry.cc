@@ -0,0 +1,170 @@
+#include "ShieldGeometry.hh"
+#include <algorithm>
+#include <cmath>
+#include <stdexcept>
+#include <utility>
+
+namespace {
+int MaterialIndex(std::vector<std::string>& materials, const std::string& name) {
+    auto it = std::find(materials.begin(), materials.end(), name);
+    if (it != materials.end()) return static_cast<int>(it - materials.begin());
+    materials.push_back(name);
+    return static_cast<int>(materials.size()) - 1;
+}
+
+// Corners closer than this (m) are taken as equal, well within the G4Trap planarity tolerance
+const double kShapeTolerance = 1e-10;
+
+// Largest distance of the 4 points a, b, c, d of a face to the plane through them (normal from the diagonals)
+double NonPlanarity(const double* a, const double* b, const double* c, const double* d) {
+    double u[3], v[3], normal[3];
+    for (int i = 0; i < 3; ++i) { u[i] = c[i] - a[i]; v[i] = d[i] - b[i]; }
+    normal[0] = u[1] * v[2] - u[2] * v[1];
+    normal[1] = u[2] * v[0] - u[0] * v[2];
+    normal[2] = u[0] * v[1] - u[1] * v[0];
+    const double norm = std::sqrt(normal[0] * normal[0] + normal[1] * normal[1] + normal[2] * normal[2]);
+    if (norm == 0.) return HUGE_VAL;
+    double lo = HUGE_VAL, hi = -HUGE_VAL;
+    for (const double* p : {a, b, c, d}) {
+        const double distance = (p[0] * normal[0] + p[1] * normal[1] + p[2] * normal[2]) / norm;
+        lo = std::min(lo, distance);
+        hi = std::max(hi, distance);
+    }
+    return hi - lo;
+}
+
+// Whether the (x, y) corners of a solid, in G4Trap order, are the corners c of an Arb8 with the same lateral edges:
+// every corner i of the -dz face is a corner r of the solid and corner i + 4 of the +dz face is its corner r + 4
+bool SameCorners(const double* c, const double solid[8][2]) {
+    bool used[4] = {false, false, false, false};
+    auto equal = [c, solid](int i, int r) {
+        return std::fabs(solid[r][0] - c[2 * i]) <= kShapeTolerance && std::fabs(solid[r][1] - c[2 * i + 1]) <= kShapeTolerance;
+    };
+    for (int i = 0; i < 4; ++i) {
+        int r = 0;
+        while (r < 4 && (used[r] || !equal(i, r) || !equal(i + 4, r + 4))) ++r;
+        if (r == 4) return false;
+        used[r] = true;
+    }
+    return true;
+}
+}
+
+void ShieldGeometry::Check() const {
+    const size_t n = size();
+    if (corners.size() != 16 * n || zCenter.size() != n || material.size() != n || fieldProfile.size() != n
+        || field.size() != 3 * n || localField.size() != n)
+        throw std::runtime_error("Inconsistent array sizes in the detector geometry.");
+    const size_t nLocal = localInterpolation.size();
+    if (localRanges.size() != 9 * nLocal || localStorage.size() != nLocal || localValues.size() != nLocal
+        || localB.size() != nLocal)
+        throw std::runtime_error("Inconsistent local field maps in the detector geometry.");
+    for (size_t i = 0; i < n; ++i) {
+        if (material[i] < 0 || material[i] >= static_cast<int>(materials.size()))
+            throw std::runtime_error("Invalid material index in the detector geometry.");
+        if (fieldProfile[i] == LOCAL && (localField[i] < 0 || localField[i] >= static_cast<int>(nLocal)))
+            throw std::runtime_error("Invalid local field map index in the detector geometry.");
+    }
+}
+
+ShieldGeometry ShieldGeometry::FromJson(const Json::Value& detectorData) {
+    ShieldGeometry geometry;
+    auto addSolid = [&geometry](const Json::Value& corners, double dz, double zCenter, int material, int profile) {
+        for (int i = 0; i < 16; ++i) geometry.corners.push_back(corners[i].asDouble());
+        geometry.dz.push_back(dz);
+        geometry.zCenter.push_back(zCenter);
+        geometry.material.push_back(material);
+        geometry.fieldProfile.push_back(profile);
+    };
+    for (const auto& cavern : detectorData["cavern"]) {
+        int material = MaterialIndex(geometry.materials, cavern["material"].asString());
+        for (const auto& block : cavern["components"]) {
+            addSolid(block, cavern["dz"].asDouble(), cavern["z_center"].asDouble(), material, NO_FIELD);
+            geometry.field.insert(geometry.field.end(), {0., 0., 0.});
+            geometry.localField.push_back(-1);
+        }
+    }
+    for (const auto& magnet : detectorData["magnets"]) {
+        int material = MaterialIndex(geometry.materials, magnet["material"].asString());
+        for (const auto& arb8 : magnet["components"]) {
+            const Json::Value& fieldValue = arb8["field"];
+            const std::string profile = arb8["field_profile"].asString();
+            if (profile == "global") {
+                addSolid(arb8["corners"], magnet["dz"].asDouble(), magnet["z_center"].asDouble(), material, GLOBAL);
+                geometry.field.insert(geometry.field.end(), {0., 0., 0.});
+                geometry.localField.push_back(-1);
+            } else if (profile == "uniform") {
+                addSolid(arb8["corners"], magnet["dz"].asDouble(), magnet["z_center"].asDouble(), material, UNIFORM);
+                for (int i = 0; i < 3; ++i) geometry.field.push_back(fieldValue[i].asDouble());
+                geometry.localField.push_back(-1);
+            } else {
+                addSolid(arb8["corners"], magnet["dz"].asDouble(), magnet["z_center"].asDouble(), material, LOCAL);
+                geometry.field.insert(geometry.field.end(), {0., 0., 0.});
+                geometry.localField.push_back(static_cast<int>(geometry.localInterpolation.size()));
+                for (const char* range : {"range_x", "range_y", "range_z"})
+                    for (int i = 0; i < 3; ++i) geometry.localRanges.push_back(fieldValue[range][i].asDouble());
+                const Json::Value& fieldsData = fieldValue["B"];
+                std::vector<double> B;
+                for (Json::ArrayIndex i = 0; i < fieldsData.size(); ++i)
+                    for (int c = 0; c < 3; ++c) B.push_back(fieldsData[i][c].asDouble());
+                geometry.localB.push_back(std::move(B));
+                geometry.localValues.emplace_back();
+                geometry.localInterpolation.push_back(fieldValue.get("interpolation", "nearest").asString());
+                geometry.localStorage.push_back(fieldValue.get("storage", "float32_aos").asString());
+            }
+        }
+    }
+    return geometry;
+}
+
+ShieldGeometry::SolidShape ShieldGeometry::Specialize(size_t n, double vertices[8][3], double offset[2]) const {
+    const double* c = &corners[16 * n];
+    int order[2][4];
+    for (int face = 0; face < 2; ++face) {
+        // lower edge then upper edge, each from -x to +x
+        int* o = order[face];
+        for (int i = 0; i < 4; ++i) o[i] = 4 * face + i;
+        std::sort(o, o + 4, [c](int a, int b) { return c[2 * a + 1] < c[2 * b + 1]; });
+        if (c[2 * o[0]] > c[2 * o[1]]) std::swap(o[0], o[1]);
+        if (c[2 * o[2]] > c[2 * o[3]]) std::swap(o[2], o[3]);
+        const double yLow = c[2 * o[0] + 1], yHigh = c[2 * o[2] + 1];
+        if (std::fabs(c[2 * o[1] + 1] - yLow) > kShapeTolerance || std::fabs(c[2 * o[3] + 1] - yHigh) > kShapeTolerance
+            || c[2 * o[2] + 1] - c[2 * o[1] + 1] <= kShapeTolerance
+            || c[2 * o[1]] - c[2 * o[0]] <= kShapeTolerance || c[2 * o[3]] - c[2 * o[2]] <= kShapeTolerance)
+            return GENERIC_TRAP;
+        for (int i = 0; i < 4; ++i) {
+            vertices[4 * face + i][0] = c[2 * o[i]];
+            // the vertices of an edge get exactly the same y, as G4Trap requires
+            vertices[4 * face + i][1] = i < 2 ? (c[2 * o[0] + 1] + c[2 * o[1] + 1]) / 2 : (c[2 * o[2] + 1] + c[2 * o[3] + 1]) / 2;
+            vertices[4 * face + i][2] = face ? dz[n] : -dz[n];
+        }
+    }
+    // the lateral edges join corner i to corner i + 4
+    for (int i = 0; i < 4; ++i)
+        if (order[1][i] != order[0][i] + 4) return GENERIC_TRAP;
+    if (NonPlanarity(vertices[0], vertices[4], vertices[5], vertices[1]) > kShapeTolerance
+        || NonPlanarity(vertices[2], vertices[3], vertices[7], vertices[6]) > kShapeTolerance
+        || NonPlanarity(vertices[0], vertices[2], vertices[6], vertices[4]) > kShapeTolerance
+        || NonPlanarity(vertices[1], vertices[5], vertices[7], vertices[3]) > kShapeTolerance)
+        return GENERIC_TRAP;
+    offset[0] = offset[1] = 0.;
+    for (int i = 0; i < 8; ++i) { offset[0] += vertices[i][0] / 8; offset[1] += vertices[i][1] / 8; }
+    for (int i = 0; i < 8; ++i) { vertices[i][0] -= offset[0]; vertices[i][1] -= offset[1]; }
+    auto equal = [](double a, double b) { return std::fabs(a - b) <= kShapeTolerance; };
+    const double (*v)[3] = vertices;
+    const bool rectangles = equal(v[0][0], v[2][0]) && equal(v[1][0], v[3][0]) && equal(v[4][0], v[6][0]) && equal(v[5][0], v[7][0]);
+    const bool centred = equal(v[0][0], -v[1][0]) && equal(v[4][0], -v[5][0]) && equal(v[0][1], -v[2][1]) && equal(v[4][1], -v[6][1]);
+    SolidShape shape = TRAP;
+    if (rectangles && centred)
+        shape = equal(v[0][0], v[4][0]) && equal(v[1][0], v[5][0]) && equal(v[0][1], v[4][1]) && equal(v[2][1], v[6][1]) ? BOX : TRD;
+    // Corners of the solid built from the parameters CreateArb8Solid takes for the shape, placed at the offset: a
+    // box or a trd only keeps the half widths of vertices 1, 2 (and 5, 6), so it must give back the 8 corners of the Arb8
+    double solid[8][2];
+    for (int i = 0; i < 8; ++i) {
+        const int face = shape == BOX ? 0 : 4 * (i / 4);
+        solid[i][0] = (shape == TRAP ? v[i][0] : (i % 2 ? v[face + 1][0] : -v[face + 1][0])) + offset[0];
+        solid[i][1] = (shape == TRAP ? v[i][1] : (i % 4 < 2 ? -v[face + 2][1] : v[face + 2][1])) + offset[1];
+    }
+    if (!SameCorners(c, solid)) return GENERIC_TRAP;
+    return shape;
+}
@@ -0,0 +1,51 @@
+#ifndef SHIELDGEOMETRY_HH
+#define SHIELDGEOMETRY_HH
+
+#include "json/json.h"
+#include "CustomMagneticField.hh"
+#include <cstddef>
+#include <string>
+#include <vector>
+
+// Solids of a GDetectorConstruction (the cavern blocks and the magnet components, all Arb8) in flat arrays, one entry
+// per solid. Passed from Python as numpy arrays (see pack_geometry in ship_muon_shield_customfield.py), so neither the
+// corners nor the local field maps go through the detector JSON; detectors given as JSON only are converted by FromJson.
+// Lengths are in m and fields in T.
+struct ShieldGeometry {
+    enum FieldProfile { NO_FIELD = -1, UNIFORM = 0, GLOBAL = 1, LOCAL = 2 };
+    enum SolidShape { GENERIC_TRAP = 0, BOX = 1, TRD = 2, TRAP = 3 };
+
+    std::vector<std::string> materials;
+    std::vector<double> corners;        // 8 (x, y) corners per solid
+    std::vector<double> dz;             // half length
+    std::vector<double> zCenter;
+    std::vector<int> material;          // index in materials
+    std::vector<int> fieldProfile;      // FieldProfile, NO_FIELD for the cavern blocks
+    std::vector<double> field;          // 3 components per solid, used by the uniform profile
+    std::vector<int> localField;        // index of the local field map of the local profile, -1 otherwise
+
+    // Local field maps: range_x, range_y and range_z (9 values) and the node values of every map, either read in place
+    // from a buffer the caller keeps alive with the detector (localValues, e.g. a z slab of a memory-mapped global map,
+    // see CustomMagneticField::FieldValues) or owned here (localB, empty where localValues is used)
+    std::vector<double> localRanges;
+    std::vector<CustomMagneticField::FieldValues> localValues;
+    std::vector<std::vector<double>> localB;
+    std::vector<std::string> localInterpolation;
+    std::vector<std::string> localStorage;
+
+    size_t size() const { return dz.size(); }
+    // Node values of the local field map k
+    CustomMagneticField::FieldValues LocalField(size_t k) const {
+        return localB[k].empty() ? localValues[k] : CustomMagneticField::FieldValues(localB[k]);
+    }
+    // Throws std::runtime_error if the arrays do not describe the same solids
+    void Check() const;
+    // Simplest solid equal to the Arb8 of solid n: a box or a trd (rectangular faces, centred on the same line), a trap
+    // (faces with edges parallel to x and planar sides) or the generic trap. For the first three, vertices is filled in
+    // the G4Trap order (-x-y, +x-y, -x+y, +x+y at -dz, then at +dz), relative to the (x, y) offset of the solid. A shape
+    // is only returned if the solid built from it has the 8 corners and lateral edges of the Arb8, else the generic trap.
+    SolidShape Specialize(size_t n, double vertices[8][3], double offset[2]) const;
+    static ShieldGeometry FromJson(const Json::Value& detectorData);
+};
+
+#endif //SHIELDGEOMETRY_HH
@@ -0,0 +1,105 @@
+"""Field map resolution scan.
+
+Coarsens an existing field map by keeping every n-th node and reports, for each stride and interpolation
+mode, the field error with respect to the full map, the map memory and the Geant4 tracking throughput.
+"""
+import json
+import gzip
+import pickle
+import numpy as np
+import multiprocessing as mp
+from time import time
+from lib.ship_muon_shield_customfield import get_design_from_params, initialize_geant4
+from lib.field_sampler import sample_field
+
+
+def grid_shape(field_map):
+    '''Number of nodes (ny, nx, nz) of a field map, same convention as CustomMagneticField.'''
+    n = [int(round((r[1] - r[0]) / r[2])) + 1 for r in (field_map['range_y'], field_map['range_x'], field_map['range_z'])]
+    return tuple(n)
+
+def grid_axes(field_map):
+    '''Node coordinates (y, x, z) of a field map.'''
+    return tuple(r[0] + r[2] * np.arange(n) for r, n in zip((field_map['range_y'], field_map['range_x'], field_map['range_z']), grid_shape(field_map)))
+
+def coarsen_field_map(field_map, stride):
+    '''Keeps every stride-th node of the grid in each direction (stride given as (sx, sy, sz)).'''
+    sx, sy, sz = stride
+    B = np.asarray(field_map['B']).reshape(*grid_shape(field_map), 3)[::sy, ::sx, ::sz]
+    coarse = dict(field_map)
+    for key, s, n in zip(('range_y', 'range_x', 'range_z'), (sy, sx, sz), B.shape[:3]):
+        r = field_map[key]
+        coarse[key] = [r[0], r[0] + (n - 1) * r[2] * s, r[2] * s]
+    coarse['B'] = np.ascontiguousarray(B).reshape(-1, 3)
+    return coarse
+
+def field_error(field_map, coarse_map, interpolation = 'linear', n_samples:int = 200000, B_min:float = 0.05, seed:int = 0):
+    '''Compares the coarse map, sampled at random nodes of the full map with the Geant4 lookup (see field_sampler), against
+    the full map. Returns the RMS and maximum error (T) over nodes with |B| > B_min.'''
+    rng = np.random.default_rng(seed)
+    B = np.asarray(field_map['B'], dtype=np.float32)
+    shape = grid_shape(field_map)
+    idx = rng.integers(0, B.shape[0], size=min(n_samples, B.shape[0]))
+    j, i, k = np.unravel_index(idx, shape)
+    axes = grid_axes(field_map)
+    points = np.column_stack((axes[1][i], axes[0][j], axes[2][k]))
+    diff = np.linalg.norm(sample_field(coarse_map, points, interpolation) - B[idx], axis=1)
+    mask = np.linalg.norm(B[idx], axis=1) > B_min
+    return np.sqrt(np.mean(diff[mask]**2)), diff[mask].max()
+
+def tracking_throughput(detector, muons, seed = 1):
+    '''Tracks the muons in a fresh Geant4 instance, returns (muons per second, number of hits in the sensitive film).'''
+    from muon_slabs import simulate_muon, kill_secondary_tracks, collect_from_sensitive
+    initialize_geant4(detector, seed)
+    kill_secondary_tracks(True)
+    px, py, pz, x, y, z, charge = muons[:, :7].T
+    if (np.abs(charge) == 13).all(): charge = charge/(-13)
+    z = np.minimum(z, -0.9)
+    n_hits = 0
+    t1 = time()
+    for n in range(len(px)):
+        simulate_muon(px[n], py[n], pz[n], int(charge[n]), x[n], y[n], z[n])
+        data_s = collect_from_sensitive()
+        n_hits += int(len(data_s['px']) > 0 and 13 in np.abs(data_s['pdg_id']))
+    return len(px)/(time() - t1), n_hits
+
+
+if __name__ == '__main__':
+    import argparse
+    from copy import deepcopy
+    from lib.reference_designs.params import sc_v6
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-params", type=str, default='sc_v6', help="Magnet parameters configuration - name or file path")
+    parser.add_argument("-field_file", type=str, default='data/outputs/fields_mm.npy', help="Field map at full resolution (simulated if it does not exist)")
+    parser.add_argument("-strides", type=str, default='1,2,3,4', help="Comma separated list of strides applied in x, y and z")
+    parser.add_argument("-z_only", action='store_true', help="Coarsen only along z")
+    parser.add_argument("--f", type=str, default='data/muons/subsample_4M.pkl', help="Input file (gzip .pkl) path containing muon data")
+    parser.add_argument("--n", type=int, default=2000, help="Number of muons tracked per configuration, 0 skips the tracking")
+    parser.add_argument("-warm", dest="SC_mag", action='store_false', help="Use warm magnets instead of hybrid")
+    parser.add_argument("--c", type=int, default=8, help="Number of CPU cores for the FEM, if the field map has to be simulated")
+    args = parser.parse_args()
+
+    if args.params == 'sc_v6': params = sc_v6
+    else:
+        with open(args.params, "r") as txt_file:
+            params = np.array([float(line.strip()) for line in txt_file])
+    detector = get_design_from_params(np.asarray(params), args.SC_mag, field_map_file = args.field_file, cores_field = args.c)
+    field_map = detector['global_field_map']
+    if args.n > 0:
+        with gzip.open(args.f, 'rb') as f:
+            muons = pickle.load(f)[:args.n]
+
+    print('stride | interpolation | memory [MB] | RMS error [T] | max error [T] | muons/s | hits')
+    for s in [int(s) for s in args.strides.split(',')]:
+        stride = (1, 1, s) if args.z_only else (s, s, s)
+        coarse_map = coarsen_field_map(field_map, stride)
+        memory = coarse_map['B'].size * 4 / 1024**2
+        for interpolation in ['nearest', 'linear']:
+            rms, max_err = field_error(field_map, coarse_map, interpolation)
+            rate, n_hits = np.nan, -1
+            if args.n > 0:
+                coarse_detector = deepcopy(detector)
+                coarse_detector['global_field_map'] = dict(coarse_map, interpolation = interpolation)
+                with mp.Pool(1) as pool:
+                    rate, n_hits = pool.apply(tracking_throughput, (coarse_detector, muons))
+            print(f'{stride} | {interpolation} | {memory:.1f} | {rms:.4f} | {max_err:.4f} | {rate:.1f} | {n_hits}')
@@ -1,6 +1,6 @@
 import json
 import numpy as np
-from lib.ship_muon_shield_customfield import get_design_from_params, initialize_geant4
+from lib.ship_muon_shield_customfield import get_design_from_params, initialize_geant4, attach_field_map, deferred_design_cost
 from muon_slabs import simulate_muon, collect, kill_secondary_tracks, collect_from_sensitive
 from plot_magnet import plot_magnet
 from time import time
@@ -22,6 +22,14 @@ def run(muons,
     extra_magnet = False,
     NI_from_B = True,
     use_diluted = False,
+    field_storage = 'float32_aos',
+    field_interpolation = 'nearest',
+    fem_magnets = None,
+    sampling_tol = None,
+    field_backend = 'snoopy',
+    field_rom_dir = None,
+    field_rom_tol = 0.01,
+    field_map_ready = None,
     kwargs_plot = {}):
     """
     Simulates the passage of muons through the muon shield and collects the resulting data.
@@ -49,6 +57,16 @@ def run(muons,
     add_target (bool, optional): Include target geometry in simulation. Defaults to True.
     keep_tracks_of_hits (bool, optional): Store full tracks of muons that hit the sensitive film. Defaults to False.
     extra_magnet (bool, optional): Add an additional small magnet to the configuration. Defaults to False.
+    field_storage (str, optional): Memory layout of the field map in Geant4 ('float32_aos', 'float32_soa', 'float16_aos'
+                     or 'float16_soa'). Defaults to 'float32_aos'.
+    field_interpolation (str, optional): Field map lookup in Geant4, 'nearest' or 'linear' (trilinear). Defaults to 'nearest'.
+    fem_magnets (list, optional): Magnets ('HA', 'M1', ..., 'M6') taking their field from the field map, the others get uniform
+                     fields. All if None (default).
+    sampling_tol (float, optional): Tolerance (T) of the per-magnet node spacing selection the field map was simulated with.
+    field_backend (str, optional): Backend the field map was simulated with, 'snoopy' (FEM, default) or 'analytic'.
+    field_rom_dir, field_rom_tol (optional): Reduced-order model the field map was simulated with and its error bound (T).
+    field_map_ready (Event, optional): Pipelined mode: Geant4 is initialized with a deferred field map while it is being
+                     simulated, and the map is attached from field_map_file once this multiprocessing Event is set.
     kwargs_plot (dict, optional): Additional keyword arguments for plotting.
     
     Returns:
@@ -70,16 +88,32 @@ def run(muons,
                       add_target = add_target,
                       extra_magnet=extra_magnet,
                       NI_from_B = NI_from_B,
-                      use_diluted = use_diluted)
+                      use_diluted = use_diluted,
+                      field_storage = field_storage,
+                      field_interpolation = field_interpolation,
+                      fem_magnets = fem_magnets,
+                      sampling_tol = sampling_tol,
+                      field_backend = field_backend,
+                      field_rom_dir = field_rom_dir,
+                      field_rom_tol = field_rom_tol,
+                      defer_field_map = field_map_ready is not None)
     cost = detector['cost']
     length = detector['dz']
 
     detector["store_primary"] = sensitive_film_params is None or keep_tracks_of_hits
     detector["store_all"] = False
     t1 = time()
+    field_map_specs = detector['global_field_map']
     output_data = initialize_geant4(detector, seed)
     if not draw_magnet: del detector #save memory?
     print('Time to initialize', time()-t1)
+    if field_map_ready is not None:
+        field_map_ready.wait()
+        t1 = time()
+        attach_field_map(field_map_specs)
+        print('Time to attach the field map', time()-t1)
+        #the FEM cost of the map, as without the pipeline
+        cost = deferred_design_cost(field_map_specs)
     output_data = json.loads(output_data)    
 
     # set_field_value(1,0,0)
@@ -176,9 +210,23 @@ if __name__ == '__main__':
     parser.add_argument("-return_nan", action='store_true', help="Return zeros for muons that don't hit the sensitive film")
     parser.add_argument("-use_diluted", action = 'store_true', help="Use diluted field map")
     parser.add_argument("-keep_tracks_of_hits", action='store_true', help="Store full tracks of muons that hit the sensitive film")
-    parser.add_argument("-use_B_goal", action='store_true', help="Use B goal for the field map")
+    parser.add_argument("-use_B_goal", action='store_true', help="Use B goal for the field map, solving the NI of every magnet. The solves are kept across runs only if the NI_CACHE_DIR environment variable is set (off by default)")
     parser.add_argument("-expanded_sens_plane", action='store_true', help="Use big sensitive plane")
     parser.add_argument("-extra_magnet", action='store_true', help="Add an additional small magnet to the configuration (old designs)")
+    parser.add_argument("-field_storage", type=str, default='float32_aos', choices=['float32_aos', 'float32_soa', 'float16_aos', 'float16_soa'], help="Memory layout of the field map inside Geant4")
+    parser.add_argument("-field_interpolation", type=str, default='nearest', choices=['nearest', 'linear'], help="Interpolation of the field map inside Geant4")
+    parser.add_argument("-field_brick_size", type=int, default=None, help="Store the simulated field map block-sparse, with bricks of this size (power of 2)")
+    parser.add_argument("-field_octree_tol", type=float, default=None, help="Build the simulated field map as an adaptive octree with this error bound (T)")
+    parser.add_argument("-field_z_planes_tol", type=float, default=None, help="Store the simulated field map factorized along z, within this error bound (T)")
+    parser.add_argument("-field_encoding", type=str, default='float16', choices=['float16', 'float32', 'int16'], help="Encoding of the simulated field map on disk (int16: quantized with per-block scales)")
+    parser.add_argument("-field_compression", type=str, default=None, choices=['zstd', 'blosc'], help="Compression of the simulated field map on disk")
+    parser.add_argument("-fem_cache", type=str, default=None, help="Directory of the per-magnet FEM field cache, reused across designs")
+    parser.add_argument("-pipeline_fem", action='store_true', help="Initialize the Geant4 workers while the field map is simulated, attaching it when ready")
+    parser.add_argument("-fem_magnets", type=str, nargs='+', default=None, choices=['HA', 'M1', 'M2', 'M3', 'M4', 'M5', 'M6'], help="Magnets taking their field from the FEM map (default all), the others get uniform fields")
+    parser.add_argument("-sampling_tol", type=float, default=None, help="Keep the field of every magnet at the coarsest node spacing that reproduces it within this (T rms), from a single solve")
+    parser.add_argument("-field_backend", type=str, default='snoopy', choices=['snoopy', 'analytic'], help="Solver of the simulated field map: snoopy FEM or the fast analytic model")
+    parser.add_argument("-field_rom", type=str, default=None, help="Directory of the reduced-order field model, trained from the FEM runs and used instead of the FEM when accurate enough")
+    parser.add_argument("-field_rom_tol", type=float, default=0.01, help="Largest estimated rms error (T) of a reduced-order model field")
     parser.add_argument("-angle", type=float, default=90, help="Azimuthal viewing angle for 3D plot")
     parser.add_argument("-elev", type=float, default=90, help="Elevation viewing angle for 3D plot")
 
@@ -214,12 +262,20 @@ if __name__ == '__main__':
         sensitive_film_params = {'dz': 0.01, 'dx': 4, 'dy': 6, 'position':args.sens_plane}
     t1_fem = time()
     detector = None
+    field_map_ready = None
     if not args.real_fields:
         args.field_file = None
+    elif args.pipeline_fem:
+        #the map is simulated in the background, the workers wait for it after the Geant4 initialization
+        core_fields = 8
+        field_map_ready = mp.Manager().Event()
+        fem_process = mp.Process(target = get_design_from_params, args = (np.asarray(params), args.SC_mag, False,True, args.field_file, sensitive_film_params, False, True),
+                                 kwargs = dict(cores_field=core_fields, extra_magnet=args.extra_magnet, NI_from_B=args.use_B_goal, use_diluted = args.use_diluted, field_brick_size = args.field_brick_size, field_octree_tol = args.field_octree_tol, field_z_planes_tol = args.field_z_planes_tol, field_encoding = args.field_encoding, field_compression = args.field_compression, fem_cache_dir = args.fem_cache, fem_magnets = args.fem_magnets, sampling_tol = args.sampling_tol, field_backend = args.field_backend, field_rom_dir = args.field_rom, field_rom_tol = args.field_rom_tol))
+        fem_process.start()
     else:
          
         core_fields = 8
-        detector = get_design_from_params(np.asarray(params), args.SC_mag, False,True, args.field_file, sensitive_film_params, False, True, cores_field=core_fields, extra_magnet=args.extra_magnet, NI_from_B=args.use_B_goal, use_diluted = args.use_diluted)
+        detector = get_design_from_params(np.asarray(params), args.SC_mag, False,True, args.field_file, sensitive_film_params, False, True, cores_field=core_fields, extra_magnet=args.extra_magnet, NI_from_B=args.use_B_goal, use_diluted = args.use_diluted, field_brick_size = args.field_brick_size, field_octree_tol = args.field_octree_tol, field_z_planes_tol = args.field_z_planes_tol, field_encoding = args.field_encoding, field_compression = args.field_compression, fem_cache_dir = args.fem_cache, fem_magnets = args.fem_magnets, sampling_tol = args.sampling_tol, field_backend = args.field_backend, field_rom_dir = args.field_rom, field_rom_tol = args.field_rom_tol)
     t2_fem = time()
 
     with gzip.open(input_file, 'rb') as f:
@@ -249,9 +305,26 @@ if __name__ == '__main__':
                               add_target=True, 
                               keep_tracks_of_hits=args.keep_tracks_of_hits, 
                               extra_magnet=args.extra_magnet,
-                              use_diluted = args.use_diluted)
+                              use_diluted = args.use_diluted,
+                              field_storage = args.field_storage,
+                              field_interpolation = args.field_interpolation,
+                              fem_magnets = args.fem_magnets,
+                              sampling_tol = args.sampling_tol,
+                              field_backend = args.field_backend,
+                              field_rom_dir = args.field_rom,
+                              field_rom_tol = args.field_rom_tol,
+                              field_map_ready = field_map_ready)
 
-        result = pool.map(run_partial, workloads)
+        if field_map_ready is not None:
+            result = pool.map_async(run_partial, workloads)
+            fem_process.join()
+            t2_fem = time()
+            if fem_process.exitcode != 0:
+                pool.terminate()
+                raise RuntimeError('Field map simulation failed (exit code {})'.format(fem_process.exitcode))
+            field_map_ready.set()
+            result = result.get()
+        else: result = pool.map(run_partial, workloads)
         cost = 0
         t2 = time()
     print(f"Time to FEM: {t2_fem - t1_fem:.2f} seconds.")
@@ -279,7 +352,17 @@ if __name__ == '__main__':
             pickle.dump(all_results, f)
         print("Data saved to ", data_file)
     if args.plot_magnet:
-        if args.real_fields: plot_fields(np.load(args.field_file.replace('fields', 'points')), detector['global_field_map']['B'])
+        if args.real_fields and detector is None:
+            detector = get_design_from_params(np.asarray(params), args.SC_mag, False, False, args.field_file, sensitive_film_params, False, True, extra_magnet=args.extra_magnet, NI_from_B=args.use_B_goal, use_diluted = args.use_diluted, fem_magnets = args.fem_magnets, sampling_tol = args.sampling_tol, field_backend = args.field_backend, field_rom_dir = args.field_rom, field_rom_tol = args.field_rom_tol)
+        if args.real_fields and 'octree_depth' not in detector['global_field_map']:
+            from lib.magnet_simulations import from_bricks, from_z_planes, construct_grid
+            field_map = detector['global_field_map']
+            points = construct_grid(limits = tuple(zip(*[field_map[k][:2] for k in ('range_x', 'range_y', 'range_z')])),
+                                    resol = [field_map[k][2] for k in ('range_x', 'range_y', 'range_z')])
+            if 'z_planes' in field_map: B = from_z_planes(field_map['B'], field_map['z_planes'], points[0].shape)
+            elif 'brick_index' in field_map: B = from_bricks(field_map['B'], field_map['brick_index'], points[0].shape, field_map['brick_size'])
+            else: B = field_map['B']
+            plot_fields(np.column_stack([p.ravel() for p in points]), B)
         all_results = all_results[:3000]
         if sensitive_film_params is None: sensitive_film_params = {'dz': 0.01, 'dx': 4, 'dy': 6, 'position': 82}
         if False:#detector is not None:
@@ -0,0 +1,83 @@
+'''Analytic field backend: a fast, vectorized stand-in for the snoopy FEM solves.
+
+The iron of every magnet is split as in the Geant4 geometry (see create_magnet): the core, the return yoke and the
+corner piece joining them, with mitred boundaries, the dimensions varying linearly from the entrance (1) to the exit (2).
+Each piece carries a uniform field: By in the core and the return yoke, Bx in the corner piece, with the flux of the core
+conserved through the others. The core field is set from NI(A) by Ampere's law along the mean flux path, with the B-H
+curve of the yoke material. The field is zero in the air and outside the magnets, so fringe fields are not modelled.
+The output has the format of the snoopy solvers: a rectilinear first quadrant point cloud over the FEM domain and B.'''
+import os
+import json
+import numpy as np
+
+
+def load_bh_curve(materials_dir:str, material:str):
+    '''B (T) and H (A/m) arrays of the B-H curve of a material file of data/materials.'''
+    with open(os.path.join(materials_dir, material)) as f:
+        bh = json.load(f)['BH_data']
+    return np.asarray(bh['B(T)'], dtype=np.float64), np.asarray(bh['H(A/m)'], dtype=np.float64)
+
+def core_field(NI, lengths, ratios, bh_curve, iterations:int = 60):
+    '''Core field (T) for which sum_i lengths[i]*H(ratios[i]*B) = |NI|, by bisection. The arguments can be arrays (one
+    entry per z slice), lengths and ratios are sequences over the pieces of the flux path.'''
+    B_curve, H_curve = bh_curve
+    lo = np.zeros(np.broadcast(NI, *lengths, *ratios).shape)
+    hi = lo + B_curve[-1]/max(np.max(r) for r in ratios)
+    for _ in range(iterations):
+        mid = (lo + hi)/2
+        ampere_turns = sum(l*np.interp(r*mid, B_curve, H_curve) for l, r in zip(lengths, ratios))
+        below = ampere_turns < np.abs(NI)
+        lo = np.where(below, mid, lo)
+        hi = np.where(below, hi, mid)
+    return (lo + hi)/2
+
+def magnet_field(params:dict, i:int, x:np.array, y:np.array, z:np.array, bh_curve):
+    '''Field (T) of the magnet in row i of params (dict of lists) on the first quadrant grid with axes x, y and z (m), as
+    an (nx, ny, nz, 3) array. The core field is solved once per z node.'''
+    p = {k: v[i] for k, v in params.items()}
+    B = np.zeros((len(x), len(y), len(z), 3))
+    t = (z - p['Z_pos(m)'])/p['Z_len(m)']
+    inside = (t >= 0) & (t <= 1)
+    t = t[inside]
+    def dim(name):
+        return (1 - t)*p[name + '1(m)'] + t*p[name + '2(m)']
+    x_gap, x_core, x_void, x_yoke = dim('Xmgap'), dim('Xcore'), dim('Xvoid'), dim('Xyoke')
+    y_void, y_yoke = dim('Yvoid'), dim('Yyoke')
+    w_core = np.maximum(x_core - x_gap, 1e-6)
+    w_yoke = np.maximum(x_yoke - x_void, 1e-6)
+    h_top = np.maximum(y_yoke - y_void, 1e-6)
+    #mean flux path: up the core, across the corner piece, down the return yoke and back
+    leg = y_void + y_yoke
+    span = (x_void + x_yoke)/2 - (x_gap + x_core)/2
+    B_core = core_field(p['NI(A)'], (leg, leg, 2*span), (1., w_core/w_yoke, w_core/h_top), bh_curve)
+    #the coils of the Mag3 yokes are on the return yokes, reversing the core field
+    B_core *= np.sign(p['NI(A)'])*(-1. if p['yoke_type'] == 'Mag3' else 1.)
+    X, Y = x[:, None, None], y[None, :, None]
+    in_iron = (X >= x_gap) & (X <= x_yoke) & (Y <= y_yoke) & ~((X > x_core) & (X < x_void) & (Y < y_void))
+    core = in_iron & (X <= x_core) & (Y <= y_void + (x_core - X)/w_core*h_top)
+    yoke = in_iron & (X >= x_void) & (Y <= y_void + (X - x_void)/w_yoke*h_top)
+    top = in_iron & ~core & ~yoke
+    B_in = np.zeros((len(x), len(y), len(t), 3))
+    B_in[..., 1] = np.where(core, B_core, 0.) - np.where(yoke, B_core*w_core/w_yoke, 0.)
+    B_in[..., 0] = np.where(top, B_core*w_core/h_top, 0.)
+    B[:, :, inside] = B_in
+    return B
+
+def get_vector_field(magn_params:dict, materials_dir:str, use_diluted = False):
+    '''Analytic counterpart of the snoopy get_vector_field_* solvers for the magnets of magn_params (dict of lists,
+    solved together). The points span the FEM domain of the magnets (Xyoke, Yyoke and Z_len extended by delta_x, delta_y
+    and delta_z) with the resolution resol_x, resol_y and resol_z of the first one. use_diluted is not modelled.
+    Returns the (N, 3) points and B, rounded and stored as float16 as the FEM fields.'''
+    rows = range(len(magn_params['yoke_type']))
+    x_max = max(max(magn_params['Xyoke1(m)'][i], magn_params['Xyoke2(m)'][i]) + magn_params['delta_x(m)'][i] for i in rows)
+    y_max = max(max(magn_params['Yyoke1(m)'][i], magn_params['Yyoke2(m)'][i]) + magn_params['delta_y(m)'][i] for i in rows)
+    z_min = min(magn_params['Z_pos(m)'][i] - magn_params['delta_z(m)'][i] for i in rows)
+    z_max = max(magn_params['Z_pos(m)'][i] + magn_params['Z_len(m)'][i] + magn_params['delta_z(m)'][i] for i in rows)
+    r_x, r_y, r_z = (magn_params[k][0] for k in ('resol_x(m)', 'resol_y(m)', 'resol_z(m)'))
+    x, y, z = np.arange(0., x_max + r_x/2, r_x), np.arange(0., y_max + r_y/2, r_y), np.arange(z_min, z_max + r_z/2, r_z)
+    B = np.zeros((len(x), len(y), len(z), 3))
+    for i in rows:
+        B += magnet_field(magn_params, i, x, y, z, load_bh_curve(materials_dir, magn_params['material'][i]))
+    X, Y, Z = np.meshgrid(x, y, z, indexing='ij')
+    points = np.column_stack((X.ravel(), Y.ravel(), Z.ravel()))
+    return points.round(4).astype(np.float16), B.reshape(-1, 3).round(4).astype(np.float16)
@@ -0,0 +1,67 @@
+'''Content-addressed cache of per-magnet FEM fields.
+
+Each entry is the field of one FEM run (a magnet, or the magnets solved together) gridded on a local block, with z
+relative to the magnet position. The key hashes the magnet parameters without 'Z_pos(m)', so a magnet that only moves
+along z is found in the cache and its block is shifted into the global grid. Entries are evicted least recently used
+first once the cache exceeds its size budget.'''
+import os
+import json
+import hashlib
+import numpy as np
+
+
+def magnet_key(magn_params:dict, z_phase:float, resol, use_diluted:bool = False, sampling_tol:float = None, field_backend:str = 'snoopy'):
+    '''Cache key of the field block of magn_params (dict of lists, one entry per magnet solved together) gridded with
+    resol and the z nodes at z_phase + n*resol[2] from the first magnet position, with the node spacing chosen for
+    sampling_tol if given (see adaptive_sampling), computed by field_backend.'''
+    params = {k: list(v) for k, v in magn_params.items() if k != 'Z_pos(m)'}
+    z_pos = magn_params['Z_pos(m)']
+    params['Z_rel(m)'] = [round(float(z) - float(z_pos[0]), 6) for z in z_pos]
+    key = {'params': params, 'z_phase': round(float(z_phase), 6), 'resol': [float(r) for r in resol], 'use_diluted': bool(use_diluted)}
+    if sampling_tol is not None: key['sampling_tol'] = float(sampling_tol)
+    if field_backend != 'snoopy': key['field_backend'] = field_backend
+    return hashlib.sha1(json.dumps(key, sort_keys=True, default=float).encode()).hexdigest()
+
+def load_block(cache_dir:str, key:str):
+    '''Cached block for key ({'B', 'm0'}, 'sampling_resol' if it was chosen adaptively and the FEM 'cost' components if
+    computed) or None. A hit refreshes the entry for the LRU eviction.'''
+    file_name = os.path.join(cache_dir, key + '.npz')
+    if not os.path.exists(file_name): return None
+    try:
+        with np.load(file_name) as f:
+            block = {'B': f['B'], 'm0': int(f['m0'])}
+            if 'sampling_resol' in f: block['sampling_resol'] = tuple(f['sampling_resol'].tolist())
+            if 'cost' in f: block['cost'] = json.loads(str(f['cost']))
+    except (OSError, ValueError, KeyError):
+        return None #entry being evicted or partially written by another process
+    os.utime(file_name)
+    return block
+
+def store_block(cache_dir:str, key:str, block:dict, max_size_gb:float = 10.):
+    '''Adds a block to the cache, then evicts the least recently used entries beyond max_size_gb.'''
+    os.makedirs(cache_dir, exist_ok=True)
+    file_name = os.path.join(cache_dir, key + '.npz')
+    tmp_file = os.path.join(cache_dir, '{}.{}.tmp.npz'.format(key, os.getpid()))
+    arrays = {k: block[k] for k in ('B', 'm0', 'sampling_resol') if k in block}
+    if 'cost' in block: arrays['cost'] = json.dumps(block['cost'])
+    np.savez(tmp_file, **arrays)
+    os.replace(tmp_file, file_name)
+    evict(cache_dir, max_size_gb)
+
+def evict(cache_dir:str, max_size_gb:float):
+    entries = []
+    for name in os.listdir(cache_dir):
+        if not name.endswith('.npz') or '.tmp.' in name: continue
+        try:
+            st = os.stat(os.path.join(cache_dir, name))
+        except FileNotFoundError:
+            continue
+        entries.append((st.st_mtime, st.st_size, name))
+    total = sum(e[1] for e in entries)
+    for _, size, name in sorted(entries):
+        if total <= max_size_gb*1024**3: break
+        try:
+            os.remove(os.path.join(cache_dir, name))
+        except FileNotFoundError:
+            pass
+        total -= size
@@ -0,0 +1,204 @@
+'''Self-describing field map container.
+
+A field map is stored as a single file: an 8 byte magic, the header length (uint32), a JSON header and the raw arrays,
+each aligned to 64 bytes. The header holds the grid ranges as read by CustomMagneticField, the requested d_space and
+resolution, the symmetry convention, the hash of the design the map was simulated for, the layout parameters (bricks,
+octree or z planes) and the dtype, shape and offset of every array, so the arrays can be opened with np.memmap without
+reading the file.
+
+B can be stored as float16, float32 or int16 quantized with a scale and offset per block of nodes and component, and
+the arrays can be compressed (zstd or blosc, if installed). Compressed or quantized maps are decoded into memory at load.'''
+import os
+import json
+import hashlib
+import numpy as np
+
+MAGIC = b'FIELDMAP'
+VERSION = 1
+ALIGNMENT = 64
+HEADER_SLACK = 1024 #room left after the header for in-place updates (see update_header)
+SYMMETRY = 'first quadrant; Bx odd under a single reflection x -> -x or y -> -y, By even, Bz odd under y -> -y'
+LAYOUT_ARRAYS = ('brick_index', 'octree', 'z_planes')
+LAYOUT_SCALARS = ('brick_size', 'octree_nodes', 'octree_depth')
+ENCODINGS = ('float16', 'float32', 'int16')
+COMPRESSIONS = (None, 'zstd', 'blosc')
+QUANTIZATION_BLOCK = 4096
+
+
+def design_hash(params, **options):
+    '''Hash of the magnet parameters and simulation options a field map was computed for.'''
+    h = hashlib.sha1(np.round(np.asarray(params, dtype=np.float64), 2).tobytes())
+    h.update(json.dumps(options, sort_keys=True, default=str).encode())
+    return h.hexdigest()
+
+def field_map_dict(fields:dict, d_space, resol):
+    '''Field map dict passed to Geant4 ('B', 'range_x', 'range_y', 'range_z' in m and the layout entries) from the
+    output of simulate_field.'''
+    field_map = {'B': fields['B'],
+                 'range_x': [0, d_space[0], resol[0]],
+                 'range_y': [0, d_space[1], resol[1]],
+                 'range_z': [d_space[2][0], d_space[2][1], resol[2]]}
+    if 'octree' in fields: #step of the finest octree level
+        for k in ('range_x', 'range_y', 'range_z'):
+            x0, x1, _ = field_map[k]
+            field_map[k] = [x0, x1, (x1 - x0)/2**fields['octree_depth']]
+    field_map.update({k: fields[k] for k in LAYOUT_ARRAYS + LAYOUT_SCALARS if k in fields})
+    if 'z_planes' in fields: field_map['n_z_planes'] = len(fields['z_planes'])
+    return field_map
+
+def _aligned(n:int):
+    return -(-n // ALIGNMENT) * ALIGNMENT
+
+def _blocks(B:np.array, block_nodes:int):
+    n_blocks = -(-len(B) // block_nodes)
+    return np.pad(B, ((0, n_blocks*block_nodes - len(B)), (0, 0)), mode='edge').reshape(n_blocks, block_nodes, 3)
+
+def quantize(B:np.array, block_nodes:int = QUANTIZATION_BLOCK):
+    '''int16 quantization of an (N, 3) field array, with a float32 scale and offset per block of block_nodes consecutive
+    nodes and component. The error is at most half a scale step of the block.
+    Returns the (N, 3) quantized array, the (n_blocks, 3) scales and offsets.'''
+    n_nodes = len(B)
+    B = _blocks(np.asarray(B, dtype=np.float32).reshape(-1, 3), block_nodes)
+    lo, hi = B.min(axis=1), B.max(axis=1)
+    offset = ((hi + lo)/2).astype(np.float32)
+    scale = ((hi - lo)/65534).astype(np.float32)
+    scale[scale == 0] = 1.
+    q = np.clip(np.rint((B - offset[:, None])/scale[:, None]), -32767, 32767).astype(np.int16)
+    return q.reshape(-1, 3)[:n_nodes], scale, offset
+
+def dequantize(q:np.array, scale:np.array, offset:np.array, block_nodes:int = QUANTIZATION_BLOCK):
+    '''Inverse of quantize, returns the (N, 3) float32 field array.'''
+    B = _blocks(np.asarray(q), block_nodes)*scale[:, None] + offset[:, None]
+    return B.reshape(-1, 3)[:len(q)].astype(np.float32)
+
+def _compress(data:np.array, compression:str):
+    if compression == 'zstd':
+        import zstandard
+        return zstandard.ZstdCompressor(level=10).compress(data.tobytes())
+    if compression == 'blosc':
+        import blosc
+        return blosc.compress(data.tobytes(), typesize=data.dtype.itemsize, cname='zstd', clevel=5, shuffle=blosc.SHUFFLE)
+    return data.tobytes()
+
+def _decompress(data:bytes, compression:str):
+    if compression == 'zstd':
+        import zstandard
+        return zstandard.ZstdDecompressor().decompress(data)
+    if compression == 'blosc':
+        import blosc
+        return blosc.decompress(data)
+    return data
+
+def save_field_map(file_name:str, field_map:dict, d_space, resol, design_hash:str = None, encoding:str = 'float16', compression:str = None,
+                   design:dict = None):
+    '''Writes a field map dict (see field_map_dict) to file_name. B is stored with the given encoding (float16, float32 or
+    int16, see quantize), the layout tables as int32, optionally compressed. The error of the encoding with respect to
+    the float32 field is printed and kept in the header, with the design (parameters and options) if given. The file is written next to the target and moved in place, so
+    readers never see a partial map.'''
+    if encoding not in ENCODINGS: raise ValueError('Invalid field map encoding: {}'.format(encoding))
+    if compression not in COMPRESSIONS: raise ValueError('Invalid field map compression: {}'.format(compression))
+    B = np.asarray(field_map['B'], dtype=np.float32).reshape(-1, 3)
+    if encoding == 'int16':
+        #quantization blocks follow the bricks of a block-sparse map
+        block_nodes = int(field_map['brick_size'])**3 if 'brick_size' in field_map else QUANTIZATION_BLOCK
+        q, scale, offset = quantize(B, block_nodes)
+        arrays = {'B': q, 'B_scale': scale, 'B_offset': offset}
+        error = np.abs(dequantize(q, scale, offset, block_nodes) - B)
+    else:
+        block_nodes = None
+        arrays = {'B': np.ascontiguousarray(B, dtype=encoding)}
+        error = np.abs(arrays['B'].astype(np.float32) - B)
+    arrays.update({k: np.ascontiguousarray(field_map[k], dtype=np.int32) for k in LAYOUT_ARRAYS if k in field_map})
+    max_error = float(error.max(initial=0.))
+    rms_error = float(np.sqrt(np.mean(error**2))) if error.size else 0.
+    print('Field map encoding {}: max error {:.2e} T, rms error {:.2e} T'.format(encoding, max_error, rms_error))
+    stored = {name: _compress(a, compression) if compression else None for name, a in arrays.items()}
+    header = {'version': VERSION,
+              'range_x': [float(v) for v in field_map['range_x']],
+              'range_y': [float(v) for v in field_map['range_y']],
+              'range_z': [float(v) for v in field_map['range_z']],
+              'd_space': [float(d_space[0]), float(d_space[1]), [float(d_space[2][0]), float(d_space[2][1])]],
+              'resol': [float(r) for r in resol],
+              'symmetry': SYMMETRY,
+              'design_hash': design_hash,
+              'design': design,
+              'layout': {k: int(field_map[k]) for k in LAYOUT_SCALARS if k in field_map},
+              'encoding': {'type': encoding, 'block_nodes': block_nodes, 'max_error': max_error, 'rms_error': rms_error},
+              'compression': compression,
+              'arrays': {}}
+    #offsets depend on the header length, which depends on the offsets: reserve room for the largest possible ones
+    for name, a in arrays.items():
+        nbytes = a.nbytes if stored[name] is None else len(stored[name])
+        header['arrays'][name] = {'dtype': a.dtype.str, 'shape': list(a.shape), 'offset': 10**15, 'nbytes': nbytes}
+    data_start = _aligned(len(MAGIC) + 4 + len(json.dumps(header).encode()) + HEADER_SLACK)
+    offset = data_start
+    for name in arrays:
+        header['arrays'][name]['offset'] = offset
+        offset = _aligned(offset + header['arrays'][name]['nbytes'])
+    header_bytes = json.dumps(header).encode()
+    tmp_file = file_name + '.tmp'
+    with open(tmp_file, 'wb') as f:
+        f.write(MAGIC)
+        f.write(np.uint32(len(header_bytes)).tobytes())
+        f.write(header_bytes)
+        for name, a in arrays.items():
+            f.seek(header['arrays'][name]['offset'])
+            f.write(a.tobytes() if stored[name] is None else stored[name])
+        f.truncate(offset)
+    os.replace(tmp_file, file_name)
+
+def is_field_map(file_name:str):
+    '''True if file_name is a field map container (older maps are plain .npy files).'''
+    with open(file_name, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+def read_header(file_name:str):
+    with open(file_name, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError('{} is not a field map file.'.format(file_name))
+        n = int(np.frombuffer(f.read(4), dtype=np.uint32)[0])
+        header = json.loads(f.read(n))
+    if header['version'] > VERSION:
+        raise ValueError('Field map {} has version {}, only up to {} is supported.'.format(file_name, header['version'], VERSION))
+    return header
+
+def update_header(file_name:str, **entries):
+    '''Rewrites header entries in place. The new header must fit before the first array.'''
+    header = read_header(file_name)
+    header.update(entries)
+    header_bytes = json.dumps(header).encode()
+    room = min(a['offset'] for a in header['arrays'].values()) - len(MAGIC) - 4
+    if len(header_bytes) > room:
+        raise ValueError('Field map {}: the updated header does not fit in the file.'.format(file_name))
+    with open(file_name, 'r+b') as f:
+        f.seek(len(MAGIC))
+        f.write(np.uint32(room).tobytes())
+        f.write(header_bytes.ljust(room))
+
+def load_field_map(file_name:str, d_space = None, resol = None, design_hash:str = None):
+    '''Opens a field map container as a field map dict, with the arrays memory-mapped.
+    If d_space or resol are given, they must match the ones the map was simulated with. A different design hash is
+    reported, since a map may be reused on purpose for a close design.'''
+    header = read_header(file_name)
+    if d_space is not None and not np.allclose(np.hstack(header['d_space']).astype(float), np.hstack(d_space).astype(float)):
+        raise ValueError('Field map {} covers d_space {}, {} was requested.'.format(file_name, header['d_space'], d_space))
+    if resol is not None and not np.allclose(header['resol'], resol):
+        raise ValueError('Field map {} has resolution {}, {} was requested.'.format(file_name, header['resol'], resol))
+    if design_hash is not None and header['design_hash'] not in (None, design_hash):
+        print('WARNING: field map {} was simulated for a different design.'.format(file_name))
+    field_map = {k: header[k] for k in ('range_x', 'range_y', 'range_z')}
+    compression = header.get('compression')
+    with open(file_name, 'rb') as f:
+        for name, a in header['arrays'].items():
+            if np.prod(a['shape']) == 0:
+                field_map[name] = np.zeros(a['shape'], dtype=np.dtype(a['dtype']))
+            elif compression is None:
+                field_map[name] = np.memmap(file_name, dtype=np.dtype(a['dtype']), mode='r', offset=a['offset'], shape=tuple(a['shape']))
+            else:
+                f.seek(a['offset'])
+                field_map[name] = np.frombuffer(_decompress(f.read(a['nbytes']), compression), dtype=np.dtype(a['dtype'])).reshape(a['shape'])
+    if header.get('encoding', {}).get('type') == 'int16':
+        field_map['B'] = dequantize(field_map['B'], field_map.pop('B_scale'), field_map.pop('B_offset'), header['encoding']['block_nodes'])
+    field_map.update(header['layout'])
+    if 'z_planes' in field_map: field_map['n_z_planes'] = len(field_map['z_planes'])
+    return field_map
@@ -0,0 +1,160 @@
+'''Reduced-order model of the per-magnet FEM fields, trained from the FEM runs of earlier designs.
+
+Every FEM run (a magnet, or the magnets solved together, see split_magnet_params) is stored as a sample: its 14 magnet
+parameters (FEATURES, the dict counterpart of new_parametrization) and its field block resampled on a reference grid of
+ROM_SHAPE nodes spanning the FEM domain. For each model key (yoke types and simulation options), the samples are
+reduced to a POD basis (SVD of the snapshots) and the mode coefficients are regressed on the parameters with a thin plate
+spline RBF. A prediction comes with an error estimate (rms, T) built from the leave-one-out errors of the nearest
+samples, the POD truncation and the resampling error, and is infinite outside the parameter range of the samples, so
+the caller can fall back to the FEM.'''
+import os
+import numpy as np
+from scipy.interpolate import RBFInterpolator
+
+FEATURES = ('Z_len(m)', 'Xmgap1(m)', 'Xmgap2(m)', 'Xcore1(m)', 'Xcore2(m)', 'Xvoid1(m)', 'Xvoid2(m)', 'Xyoke1(m)', 'Xyoke2(m)',
+            'Ycore1(m)', 'Ycore2(m)', 'Yyoke1(m)', 'Yyoke2(m)', 'NI(A)')
+ROM_SHAPE = (128, 128, 160) #reference grid nodes along y, x and z
+POD_ENERGY = 1 - 1e-6 #fraction of the snapshot energy kept by the POD basis
+MAX_MODES = 64
+N_NEIGHBOURS = 3
+
+_MODELS = {}
+
+
+def model_key(params:dict, use_diluted:bool = False, field_backend:str = 'snoopy'):
+    '''Name of the model the FEM run of params (dict of lists) belongs to: its yoke types and the simulation options.'''
+    key = '+'.join(params['yoke_type'])
+    if use_diluted: key += '_diluted'
+    if field_backend != 'snoopy': key += '_' + field_backend
+    return key
+
+def magnet_features(params:dict):
+    '''Parameter vector of the FEM run of params: FEATURES of every magnet and the z offsets of the magnets after the first.'''
+    z0 = params['Z_pos(m)'][0]
+    return np.array([params[k][i] for i in range(len(params['yoke_type'])) for k in FEATURES]
+                    + [z - z0 for z in params['Z_pos(m)'][1:]], dtype=np.float64)
+
+def field_domain(params:dict):
+    '''FEM domain of params in the block frame: x and y extents, z range relative to the first magnet Z_pos (m).'''
+    rows = range(len(params['yoke_type']))
+    z0 = params['Z_pos(m)'][0]
+    return (max(max(params['Xyoke1(m)'][i], params['Xyoke2(m)'][i]) + params['delta_x(m)'][i] for i in rows),
+            max(max(params['Yyoke1(m)'][i], params['Yyoke2(m)'][i]) + params['delta_y(m)'][i] for i in rows),
+            min(params['Z_pos(m)'][i] - params['delta_z(m)'][i] for i in rows) - z0,
+            max(params['Z_pos(m)'][i] + params['Z_len(m)'][i] + params['delta_z(m)'][i] for i in rows) - z0)
+
+def _gather(B:np.array, j:np.array, i:np.array, k:np.array):
+    out = np.zeros((len(j), len(i), len(k), 3), dtype=np.float32)
+    vj, vi, vk = (j >= 0) & (j < B.shape[0]), (i >= 0) & (i < B.shape[1]), (k >= 0) & (k < B.shape[2])
+    out[np.ix_(vj, vi, vk)] = B[np.ix_(j[vj], i[vi], k[vk])]
+    return out
+
+def to_reference(block:dict, params:dict, z_phase:float, resol):
+    '''Nearest neighbour resampling of a local field block (see simulate_local_block) on the reference grid.'''
+    x_ext, y_ext, z_min, z_max = field_domain(params)
+    i = np.rint(np.linspace(0., x_ext, ROM_SHAPE[1])/resol[0]).astype(int)
+    j = np.rint(np.linspace(0., y_ext, ROM_SHAPE[0])/resol[1]).astype(int)
+    k = np.rint((np.linspace(z_min, z_max, ROM_SHAPE[2]) - z_phase)/resol[2]).astype(int) - block['m0']
+    return _gather(block['B'], j, i, k)
+
+def from_reference(B_ref:np.array, params:dict, z_phase:float, resol):
+    '''Local field block of params (as simulate_local_block) from its field on the reference grid.'''
+    x_ext, y_ext, z_min, z_max = field_domain(params)
+    nx = int(np.floor(x_ext/resol[0] + 1e-6)) + 1
+    ny = int(np.floor(y_ext/resol[1] + 1e-6)) + 1
+    m0 = int(np.ceil((z_min - z_phase)/resol[2] - 1e-6))
+    m1 = int(np.floor((z_max - z_phase)/resol[2] + 1e-6))
+    i = np.rint(np.arange(nx)*resol[0]/x_ext*(ROM_SHAPE[1] - 1)).astype(int)
+    j = np.rint(np.arange(ny)*resol[1]/y_ext*(ROM_SHAPE[0] - 1)).astype(int)
+    k = np.rint((z_phase + np.arange(m0, m1 + 1)*resol[2] - z_min)/(z_max - z_min)*(ROM_SHAPE[2] - 1)).astype(int)
+    return {'B': _gather(B_ref, j, i, k).astype(np.float16), 'm0': m0}
+
+def _rms(a:np.array):
+    return float(np.sqrt(np.mean(np.square(a, dtype=np.float64)))) if a.size else 0.
+
+def store_sample(rom_dir:str, key:str, params:dict, block:dict, z_phase:float, resol, name:str):
+    '''Adds the FEM block of params to the samples of the model name, under key (see fem_cache.magnet_key).'''
+    sample_dir = os.path.join(rom_dir, name)
+    file_name = os.path.join(sample_dir, key + '.npz')
+    if os.path.exists(file_name): return
+    os.makedirs(sample_dir, exist_ok=True)
+    B_ref = to_reference(block, params, z_phase, resol)
+    b = from_reference(B_ref, params, z_phase, resol)
+    n = [min(s1, s2) for s1, s2 in zip(b['B'].shape[:2], block['B'].shape[:2])]
+    k0 = max(b['m0'], block['m0'])
+    k1 = min(b['m0'] + b['B'].shape[2], block['m0'] + block['B'].shape[2])
+    resample_error = _rms(b['B'][:n[0], :n[1], k0 - b['m0']:k1 - b['m0']].astype(np.float32)
+                          - block['B'][:n[0], :n[1], k0 - block['m0']:k1 - block['m0']].astype(np.float32))
+    tmp_file = os.path.join(sample_dir, '{}.{}.tmp.npz'.format(key, os.getpid()))
+    np.savez(tmp_file, features = magnet_features(params), B_ref = B_ref.astype(np.float16), resample_error = resample_error)
+    os.replace(tmp_file, file_name)
+
+def fit_model(rom_dir:str, name:str):
+    '''POD basis and RBF regression of the samples of the model name, None if there are too few samples for the number
+    of independent parameters. The model is kept and refitted when samples are added.'''
+    sample_dir = os.path.join(rom_dir, name)
+    files = sorted(f for f in os.listdir(sample_dir) if f.endswith('.npz') and '.tmp.' not in f) if os.path.isdir(sample_dir) else []
+    cached = _MODELS.get((rom_dir, name))
+    if cached is not None and cached[0] == files: return cached[1]
+    X, S, resample_error = [], [], []
+    for f in files:
+        with np.load(os.path.join(sample_dir, f)) as d:
+            X.append(d['features'])
+            S.append(d['B_ref'].astype(np.float32).ravel())
+            resample_error.append(float(d['resample_error']))
+    model, rank, X = None, 0, np.array(X)
+    if len(X):
+        #standardized parameters, whitened along their principal directions: dependent or constant ones drop out
+        x_mean, x_std = X.mean(axis=0), X.std(axis=0)
+        x_std[x_std == 0] = 1.
+        _, s_x, Vt_x = np.linalg.svd((X - x_mean)/x_std, full_matrices=False)
+        rank = int((s_x > 1e-6*s_x[0]).sum()) if s_x[0] > 0 else 0
+        x_basis, x_scale = Vt_x[:rank].T, s_x[:rank]/np.sqrt(len(X))
+    if 0 < rank <= len(X) - 2: #thin plate spline with a linear polynomial term
+        Xn = ((X - x_mean)/x_std) @ x_basis/x_scale
+        #POD by the method of snapshots: eigenvectors of the (n_samples, n_samples) correlation matrix
+        S = np.array(S)
+        S_mean = S.mean(axis=0)
+        S -= S_mean
+        K = (S @ S.T).astype(np.float64)
+        w, U = np.linalg.eigh(K)
+        w, U = np.maximum(w[::-1], 0.), U[:, ::-1]
+        energy = np.cumsum(w)/max(np.sum(w), 1e-30)
+        n_modes = min(int(np.searchsorted(energy, POD_ENERGY)) + 1, MAX_MODES, int((w > 0).sum()))
+        s = np.sqrt(w[:n_modes])
+        A = U[:, :n_modes]*s
+        modes = (U[:, :n_modes].T.astype(np.float32) @ S)/s[:, None].astype(np.float32)
+        truncation = np.sqrt(np.maximum(np.diag(K) - np.sum(A**2, axis=1), 0.)/S.shape[1])
+        loo = np.empty(len(X))
+        for n in range(len(X)):
+            others = np.arange(len(X)) != n
+            a = RBFInterpolator(Xn[others], A[others], kernel='thin_plate_spline', degree=1)(Xn[n:n + 1])[0]
+            loo[n] = np.sqrt(np.sum((a - A[n])**2)/S.shape[1])
+        distances = np.linalg.norm(Xn[:, None] - Xn[None], axis=2)
+        np.fill_diagonal(distances, np.inf)
+        model = {'x_mean': x_mean, 'x_std': x_std, 'x_basis': x_basis, 'x_scale': x_scale,
+                 'x_min': Xn.min(axis=0), 'x_max': Xn.max(axis=0), 'X': Xn,
+                 'S_mean': S_mean, 'modes': modes, 'rbf': RBFInterpolator(Xn, A, kernel='thin_plate_spline', degree=1),
+                 'error': np.sqrt(loo**2 + truncation**2 + np.array(resample_error)**2), 'spacing': distances.min(axis=1)}
+        print('Field ROM {}: {} samples, {} modes, leave-one-out rms error {:.2e} T'.format(name, len(X), n_modes, np.median(model['error'])))
+    _MODELS[(rom_dir, name)] = (files, model)
+    return model
+
+def predict_block(rom_dir:str, params:dict, z_phase:float, resol, name:str):
+    '''Local field block of params (as simulate_local_block) predicted by the model name, and its estimated rms error (T):
+    the largest error of the N_NEIGHBOURS nearest samples, scaled up with the distance to them. The block is None and
+    the error infinite without a model or outside the parameter range of the samples.'''
+    model = fit_model(rom_dir, name)
+    if model is None: return None, np.inf
+    x = magnet_features(params)
+    if x.shape != model['x_mean'].shape: return None, np.inf
+    x = (x - model['x_mean'])/model['x_std']
+    projection = x @ model['x_basis']
+    if np.linalg.norm(x - model['x_basis'] @ projection) > 1e-3: return None, np.inf #off the span of the samples
+    x = projection/model['x_scale']
+    if (x < model['x_min'] - 1e-9).any() or (x > model['x_max'] + 1e-9).any(): return None, np.inf
+    distances = np.linalg.norm(model['X'] - x, axis=1)
+    nearest = np.argsort(distances)[:N_NEIGHBOURS]
+    error = model['error'][nearest].max()*max(1., distances[nearest[0]]/max(model['spacing'][nearest].mean(), 1e-12))
+    B_ref = model['S_mean'] + model['rbf'](x[None])[0] @ model['modes']
+    return from_reference(B_ref.reshape(*ROM_SHAPE, 3), params, z_phase, resol), float(error)
@@ -0,0 +1,94 @@
+'''Numba field map sampler reproducing the CustomMagneticField lookup on the regular grids saved by simulate_field.
+
+The map covers the first quadrant (x, y >= 0) and is stored as a flat (ny*nx*nz, 3) array with node (i, j, k) at
+j*(nx*nz) + i*nz + k. Points are folded onto the quadrant, Bx flips sign under a single reflection and Bz under y -> -y.
+Points outside the map get a zero field, as in Geant4.'''
+import pickle
+import numpy as np
+from numba import njit, prange
+from lib import field_map_io
+
+
+def grid_parameters(field_map):
+    '''(min, max, step, number of nodes) along x, y and z of a field map dict with 'range_x', 'range_y' and 'range_z' (m).
+    The max is the one of the range, as in CustomMagneticField, not the last node when the step does not divide it.'''
+    params = []
+    for key in ('range_x', 'range_y', 'range_z'):
+        x0, x1, step = field_map[key]
+        params.append((x0, x1, step, int(round((x1 - x0)/step)) + 1))
+    return tuple(np.array([p[i] for p in params]) for i in range(3)) + (np.array([p[3] for p in params], dtype=np.int64),)
+
+@njit(cache=True)
+def _fold(x, y):
+    sign_x = -1. if (x < 0) != (y < 0) else 1.
+    sign_z = -1. if y < 0 else 1.
+    return abs(x), abs(y), sign_x, sign_z
+
+@njit(parallel=True, cache=True)
+def _sample_nearest(B, p_min, p_max, step, n, points, out):
+    nx, ny, nz = n[0], n[1], n[2]
+    for m in prange(points.shape[0]):
+        ax, ay, sign_x, sign_z = _fold(points[m, 0], points[m, 1])
+        z = points[m, 2]
+        ti = (ax - p_min[0])/step[0] + 0.5
+        tj = (ay - p_min[1])/step[1] + 0.5
+        tk = (z - p_min[2])/step[2] + 0.5
+        if ax > p_max[0] or ay > p_max[1] or z > p_max[2] or ti < 0 or tj < 0 or tk < 0:
+            out[m, 0] = out[m, 1] = out[m, 2] = 0.
+            continue
+        idx = int(tj)*(nx*nz) + int(ti)*nz + int(tk)
+        out[m, 0] = sign_x*B[idx, 0]
+        out[m, 1] = B[idx, 1]
+        out[m, 2] = sign_z*B[idx, 2]
+
+@njit(parallel=True, cache=True)
+def _sample_linear(B, p_min, p_max, step, n, points, out):
+    nx, ny, nz = n[0], n[1], n[2]
+    for m in prange(points.shape[0]):
+        ax, ay, sign_x, sign_z = _fold(points[m, 0], points[m, 1])
+        z = points[m, 2]
+        tx = (ax - p_min[0])/step[0]
+        ty = (ay - p_min[1])/step[1]
+        tz = (z - p_min[2])/step[2]
+        if ax > p_max[0] or ay > p_max[1] or z > p_max[2] or tx < 0 or ty < 0 or tz < 0:
+            out[m, 0] = out[m, 1] = out[m, 2] = 0.
+            continue
+        #lower corner of the cell, the last node belongs to the cell below it
+        i = min(int(tx), nx - 2)
+        j = min(int(ty), ny - 2)
+        k = min(int(tz), nz - 2)
+        fx, fy, fz = tx - i, ty - j, tz - k
+        for c in range(3):
+            b = 0.
+            for dj in range(2):
+                for di in range(2):
+                    for dk in range(2):
+                        w = (fy if dj else 1. - fy)*(fx if di else 1. - fx)*(fz if dk else 1. - fz)
+                        b += w*B[(j + dj)*(nx*nz) + (i + di)*nz + k + dk, c]
+            out[m, c] = b
+        out[m, 0] *= sign_x
+        out[m, 2] *= sign_z
+
+def sample_field(field_map, points, interpolation:str = 'nearest'):
+    '''Field (T) of a dense field map dict (as returned by get_field with only_grid_params) at an (N, 3) array of points (m).
+    interpolation is 'nearest' or 'linear', with the same conventions as CustomMagneticField.'''
+    if any(k in field_map for k in ('brick_index', 'octree', 'z_planes')):
+        raise ValueError('Only dense field maps can be sampled, densify the map first.')
+    p_min, p_max, step, n = grid_parameters(field_map)
+    B = np.asarray(field_map['B']).reshape(-1, 3).astype(np.float32) #same precision as the default map storage in Geant4
+    if B.shape[0] != np.prod(n):
+        raise ValueError('Field map size {} does not match the grid dimensions {}.'.format(B.shape[0], tuple(n)))
+    points = np.ascontiguousarray(points, dtype=np.float64).reshape(-1, 3)
+    out = np.empty_like(points)
+    if interpolation == 'nearest': _sample_nearest(B, p_min, p_max, step, n, points, out)
+    elif interpolation == 'linear': _sample_linear(B, p_min, p_max, step, n, points, out)
+    else: raise ValueError('Invalid interpolation type: ' + interpolation)
+    return out
+
+def load_field_map(file_name:str, resol = None):
+    '''Loads a field map saved by simulate_field as a field map dict, memory-mapped. resol is only needed for plain .npy
+    maps saved before the field map container, which are read with their d_space pickle.'''
+    if field_map_io.is_field_map(file_name): return field_map_io.load_field_map(file_name)
+    with open(file_name.replace('fields', 'd_space'), 'rb') as f:
+        d_space = pickle.load(f)
+    return field_map_io.field_map_dict({'B': np.load(file_name, mmap_mode='r')}, d_space, resol)
@@ -10,14 +10,19 @@ from time import time
 from scipy.interpolate import griddata
 import pandas as pd
 from scipy.spatial import cKDTree
-import gzip, pickle
+import gzip, pickle, json, hashlib, queue
 #import roxie_evaluator
 import snoopy
 import multiprocessing as mp
 from lib.reference_designs.params import new_parametrization
+from lib import field_map_io, fem_cache, analytic_field, field_rom, ni_cache
 
 SC_Ymgap = 0.15
+SC_COST_FACTOR = 4. #rough ratio of the superconducting magnet solve time to a warm magnet with as many nodes
 RESOL_DEF = (0.02,0.02,0.05)
+#persistent memo of the NI solves (see ni_cache); without NI_CACHE_DIR the solves are only memoized in the process
+NI_CACHE_DIR = os.environ.get('NI_CACHE_DIR', '')
+NI_SURROGATE_TOL = 0.05 #T, largest distance of B_goal to the solved points of a magnet for interpolating NI
 def get_fixed_params(yoke_type = 'Mag1'):
     SC = (yoke_type == 'Mag2')
     return {
@@ -85,7 +90,7 @@ def get_magnet_params(params,
         if d['yoke_type'] == 'Mag3': 
             d['yoke_type'] = 'Mag1'
             temp = 1
-        d['NI(A)'] = snoopy.get_NI(B_goal, pd.DataFrame([d]),0, materials_directory = materials_directory)[0]
+        d['NI(A)'] = solve_NI(B_goal, d, materials_directory)
         if temp:
             d['yoke_type'] = 'Mag3'
             temp = 0
@@ -97,6 +102,15 @@ def get_magnet_params(params,
             w.writerow(d)
     return d
 
+def solve_NI(B_goal:float, magn_params:dict, materials_directory:str):
+    '''NI(A) giving B_goal (T) for the magnet magn_params (snoopy.get_NI), memoized in NI_CACHE_DIR (see ni_cache).'''
+    key = ni_cache.ni_key(magn_params, materials_directory)
+    NI = ni_cache.lookup(NI_CACHE_DIR, key, B_goal, NI_SURROGATE_TOL)
+    if NI is None:
+        NI = snoopy.get_NI(B_goal, pd.DataFrame([magn_params]),0, materials_directory = materials_directory)[0]
+        ni_cache.store(NI_CACHE_DIR, key, B_goal, NI)
+    return NI
+
 def get_melvin_params(params,
               fSC_mag:bool = False,
               z_gap = 0.1,
@@ -242,25 +256,208 @@ def construct_grid(limits = ((0., 0., -5.),(2.5, 3.5, 5.)),
     #Z[Z == max_z] = max_z #- eps
     return X, Y, Z
 
-def get_grid_data(points: np.array, B: np.array, new_points: tuple):
-    '''Interpolates the magnetic field data to a new grid.'''
+def get_grid_data(points: np.array, B: np.array, new_points: tuple, chunk_size:int = 2**20, workers:int = None):
+    '''Interpolates (nearest neighbour) the FEM field to the grid new_points of construct_grid. Returns the (ny*nx*nz, 3) field.'''
     t1 = time()
-    '''Bx_out = griddata(points, B[:, 0], new_points, method='nearest', fill_value=0.0).ravel()
-    By_out = griddata(points, B[:, 1], new_points, method='nearest', fill_value=0.0).ravel()
-    Bz_out = griddata(points, B[:, 2], new_points, method='nearest', fill_value=0.0).ravel()'''
-    new_points = np.column_stack((new_points[0].ravel(), new_points[1].ravel(), new_points[2].ravel()))
-    Bx_out, By_out, Bz_out = np.zeros_like(new_points).T
-    hull =  (new_points[:, 0] <= points[:, 0].max()) & \
-            (new_points[:, 1] <= points[:, 1].max()) & \
-            (new_points[:, 2] >= points[:, 2].min()) & (new_points[:, 2] <= points[:, 2].max())
-    tree = cKDTree(points)
-    _, idx = tree.query(new_points[hull], k=1)
-    Bx_out[hull] = B[idx, 0]
-    By_out[hull] = B[idx, 1]
-    Bz_out[hull] = B[idx, 2]
-    new_B = np.column_stack((Bx_out, By_out, Bz_out))
+    axes = (new_points[0][0, :, 0], new_points[1][:, 0, 0], new_points[2][0, 0, :])
+    new_B = nearest_grid_field(points, B, axes, chunk_size, workers).reshape(-1, 3)
     print('Griddind / Interpolation time = {} sec'.format(time() - t1))
-    return new_points, new_B
+    return new_B
+
+def nearest_grid_field(points: np.array, B: np.array, axes: tuple, chunk_size:int = 2**20, workers:int = None):
+    '''Nearest neighbour FEM field on the regular grid with node coordinates axes = (x, y, z), as an (ny, nx, nz, 3) array.
+    Only the nodes inside the bounding box of the FEM points are evaluated, in chunks of about chunk_size nodes, the
+    others are zero.'''
+    x, y, z = (np.asarray(a, dtype=np.float64) for a in axes)
+    new_B = np.zeros((len(y), len(x), len(z), 3))
+    p_min, p_max = points.min(axis=0).astype(np.float64), points.max(axis=0).astype(np.float64)
+    nx, ny = np.searchsorted(x, p_max[0], side='right'), np.searchsorted(y, p_max[1], side='right')
+    k0, k1 = np.searchsorted(z, p_min[2], side='left'), np.searchsorted(z, p_max[2], side='right')
+    if nx == 0 or ny == 0 or k1 <= k0: return new_B
+    evaluate = nearest_field(points, B, workers, chunk_size)
+    rows = max(1, chunk_size // (nx*(k1 - k0)))
+    for j in range(0, ny, rows):
+        Y, X, Z = np.meshgrid(y[j:j + rows], x[:nx], z[k0:k1], indexing='ij')
+        new_B[j:j + rows, :nx, k0:k1] = evaluate(np.column_stack((X.ravel(), Y.ravel(), Z.ravel()))).reshape(*X.shape, 3)
+    return new_B
+
+_MESH_LOCATORS = {}
+
+def _nearest_node(axis: np.array, values: np.array):
+    if len(axis) == 1: return np.zeros(len(values), dtype=np.int64)
+    j = np.clip(np.searchsorted(axis, values), 1, len(axis) - 1)
+    return np.where(values - axis[j - 1] <= axis[j] - values, j - 1, j)
+
+def mesh_locator(points: np.array):
+    '''Returns a function (new_points, workers) -> index of the nearest FEM point. A rectilinear FEM mesh is binned directly
+    along its axes, otherwise a cKDTree is built. The last locator is kept and reused for the same mesh.'''
+    key = (points.shape, points.dtype.str, hashlib.sha1(np.ascontiguousarray(points).tobytes()).hexdigest())
+    if key in _MESH_LOCATORS: return _MESH_LOCATORS[key]
+    _MESH_LOCATORS.clear()
+    axes = [np.unique(points[:, a]).astype(np.float64) for a in range(3)]
+    n = [len(a) for a in axes]
+    locate = None
+    if n[0]*n[1]*n[2] == len(points):
+        flat = (np.searchsorted(axes[0], points[:, 0].astype(np.float64))*n[1]
+                + np.searchsorted(axes[1], points[:, 1].astype(np.float64)))*n[2] + np.searchsorted(axes[2], points[:, 2].astype(np.float64))
+        lut = np.full(len(points), -1, dtype=np.int64)
+        lut[flat] = np.arange(len(points))
+        if (lut >= 0).all(): #every node of the mesh present once
+            def locate(new_points: np.array, workers:int = 1):
+                i = [_nearest_node(axes[a], new_points[:, a]) for a in range(3)]
+                return lut[(i[0]*n[1] + i[1])*n[2] + i[2]]
+    if locate is None:
+        tree = cKDTree(points)
+        def locate(new_points: np.array, workers:int = 1):
+            return tree.query(new_points, k=1, workers=workers)[1]
+    _MESH_LOCATORS[key] = locate
+    return locate
+
+def nearest_field(points: np.array, B: np.array, workers:int = None, chunk_size:int = 2**20):
+    '''Returns a function evaluating the FEM field at new points (N,3) by nearest neighbour, zero outside the FEM domain.
+    Points are looked up in chunks of chunk_size with workers threads (default: all cores, one inside a process pool).'''
+    locate = mesh_locator(points)
+    p_min, p_max = points.min(axis=0), points.max(axis=0)
+    if workers is None: workers = 1 if mp.current_process().daemon else -1
+    def evaluate(new_points: np.array):
+        new_B = np.zeros_like(new_points, dtype=np.float64)
+        for start in range(0, len(new_points), chunk_size):
+            p = new_points[start:start + chunk_size]
+            hull =  (p[:, 0] <= p_max[0]) & \
+                    (p[:, 1] <= p_max[1]) & \
+                    (p[:, 2] >= p_min[2]) & (p[:, 2] <= p_max[2])
+            new_B[start:start + chunk_size][hull] = B[locate(p[hull], workers)]
+        return new_B
+    return evaluate
+
+def get_octree_data(fem_fields: list, limits: tuple, tol:float = 0.02, max_depth:int = 10, min_depth:int = 3,
+                    chunk_size:int = 100000):
+    '''Builds an adaptive octree field map of the box limits ((x0,y0,z0),(x1,y1,z1)) from the FEM point clouds
+    (list of dicts with 'points' and 'B', superposed). A cell is split while the trilinear interpolation from its corners
+    differs from the FEM field by more than tol (T) at any corner, edge midpoint, face centre or centre of the cell,
+    from min_depth down to max_depth.
+    Returns a dict with the field at the leaf corners 'B' (n_nodes, 3) and the 'octree' table: one entry per cell,
+    either the id of its first child (the 8 children are consecutive, ordered (dy, dx, dz)) or -(leaf+1),
+    followed by the 8 corner node ids of every leaf.'''
+    t1 = time()
+    evaluators = [nearest_field(f['points'], f['B']) for f in fem_fields]
+    field = lambda p: sum(evaluate(p) for evaluate in evaluators)
+    lo = np.asarray(limits[0], dtype=np.float64)
+    size = np.asarray(limits[1], dtype=np.float64) - lo
+    N = 2**max_depth
+    # offsets (x, y, z) of the 8 children/corners, ordered (dy, dx, dz), and of the 27 test points in half cells
+    corner_offsets = np.array([[(c >> 1) & 1, (c >> 2) & 1, c & 1] for c in range(8)], dtype=np.int64)
+    test_offsets = np.stack(np.meshgrid(*3*[np.arange(3)], indexing='ij'), -1).reshape(-1, 3)
+    weights = np.prod(np.where(corner_offsets[None] == 1, test_offsets[:, None]/2, 1 - test_offsets[:, None]/2), axis=-1)
+    corner_tests = [np.flatnonzero((test_offsets == 2*c).all(axis=1))[0] for c in corner_offsets]
+
+    def cell_error(origins, s):
+        err = np.empty(len(origins))
+        for n in range(0, len(origins), chunk_size):
+            o = origins[n:n+chunk_size]
+            B = field((lo + (o[:, None, :] + test_offsets[None]*(s//2))/N*size).reshape(-1, 3)).reshape(len(o), 27, 3)
+            pred = np.einsum('tc,ncv->ntv', weights, B[:, corner_tests])
+            err[n:n+chunk_size] = np.linalg.norm(pred - B, axis=-1).max(axis=1)
+        return err
+
+    tree, leaves = [], []
+    cells = np.zeros((1, 3), dtype=np.int64)
+    n_nodes = n_leaves = depth = 0
+    while len(cells):
+        s = N >> depth
+        split = np.full(len(cells), depth < min_depth)
+        if min_depth <= depth < max_depth:
+            split = cell_error(cells, s) > tol
+        first_child = n_nodes + len(cells) + 8*(np.cumsum(split) - split)
+        leaf = n_leaves + np.cumsum(~split) - (~split)
+        tree.append(np.where(split, first_child, -(leaf + 1)))
+        leaves.append(cells[~split][:, None, :] + s*corner_offsets[None])
+        n_nodes += len(cells)
+        n_leaves += int((~split).sum())
+        cells = (cells[split][:, None, :] + (s//2)*corner_offsets[None]).reshape(-1, 3)
+        depth += 1
+    corners = np.concatenate(leaves).reshape(-1, 3)
+    nodes, corners = np.unique((corners[:, 0]*(N + 1) + corners[:, 1])*(N + 1) + corners[:, 2], return_inverse=True)
+    nodes = np.column_stack((nodes//(N + 1)**2, nodes//(N + 1) % (N + 1), nodes % (N + 1)))
+    B = field(lo + nodes/N*size)
+    print('Octree field map: {} cells, {} leaves, {} nodes (depth {}) in {} sec'.format(n_nodes, n_leaves, len(nodes), depth - 1, time() - t1))
+    return {'B': B, 'octree': np.concatenate(tree + [corners.ravel()]).astype(np.int32),
+            'octree_nodes': n_nodes, 'octree_depth': max_depth}
+
+def to_bricks(B: np.array, shape: tuple, brick_size:int = 8, tol:float = 1e-4):
+    '''Splits a dense field grid of shape (ny, nx, nz) into bricks of brick_size^3 nodes. Bricks where every
+    component is below tol are dropped and flagged with -1 in the brick index.
+    Returns the stored bricks as a (n_bricks*brick_size^3, 3) array and the flat brick index (ordered by (bj, bi, bk)).'''
+    B = B.reshape(*shape, 3)
+    n_bricks = [-(-n // brick_size) for n in shape]
+    B = np.pad(B, [(0, nb*brick_size - n) for nb, n in zip(n_bricks, shape)] + [(0, 0)])
+    B = B.reshape(n_bricks[0], brick_size, n_bricks[1], brick_size, n_bricks[2], brick_size, 3)
+    B = B.transpose(0, 2, 4, 1, 3, 5, 6).reshape(-1, brick_size**3, 3)
+    non_empty = np.abs(B).max(axis=(1, 2)) > tol
+    index = np.full(non_empty.size, -1, dtype=np.int32)
+    index[non_empty] = np.arange(non_empty.sum(), dtype=np.int32)
+    print('Field map bricks: {} stored out of {}'.format(non_empty.sum(), non_empty.size))
+    return B[non_empty].reshape(-1, 3), index
+
+def from_bricks(bricks: np.array, index: np.array, shape: tuple, brick_size:int = 8):
+    '''Inverse of to_bricks: rebuilds the dense (ny*nx*nz, 3) field grid.'''
+    n_bricks = [-(-n // brick_size) for n in shape]
+    B = np.zeros((index.size, brick_size**3, 3), dtype=bricks.dtype)
+    B[index >= 0] = bricks.reshape(-1, brick_size**3, 3)[index[index >= 0]]
+    B = B.reshape(*n_bricks, brick_size, brick_size, brick_size, 3).transpose(0, 3, 1, 4, 2, 5, 6)
+    B = B.reshape(*[nb*brick_size for nb in n_bricks], 3)[:shape[0], :shape[1], :shape[2]]
+    return B.reshape(-1, 3)
+
+def to_z_planes(B: np.array, shape: tuple, tol:float = 0.01):
+    '''Factorizes a dense field grid of shape (ny, nx, nz) along z: keeps the (x, y) cross-sections at a subset of the z
+    planes such that linear interpolation in z between consecutive kept planes reproduces every dropped plane within tol (T).
+    Along the body of the magnets few planes remain, while the end regions stay fully resolved.
+    Returns the kept planes as a (n_planes*ny*nx, 3) array ordered (plane, j, i) and their z node indices.'''
+    B = B.reshape(*shape, 3).transpose(2, 0, 1, 3)
+    def span_error(a, b):
+        f = ((np.arange(a + 1, b) - a)/(b - a))[:, None, None, None]
+        return np.abs(B[a + 1:b] - ((1 - f)*B[a] + f*B[b])).max(initial = 0.)
+    planes = [0]
+    while planes[-1] < shape[2] - 1:
+        #longest span from plane a: doubling, then bisection between the last good and the first bad end
+        a = planes[-1]
+        d = 1
+        while a + 2*d < shape[2] and span_error(a, a + 2*d) <= tol: d *= 2
+        lo, hi = a + d, min(a + 2*d, shape[2])
+        while hi - lo > 1:
+            mid = (lo + hi)//2
+            if span_error(a, mid) <= tol: lo = mid
+            else: hi = mid
+        planes.append(lo)
+    planes = np.array(planes, dtype=np.int32)
+    print('Field map z planes: {} stored out of {}'.format(len(planes), shape[2]))
+    return np.ascontiguousarray(B[planes]).reshape(-1, 3), planes
+
+def from_z_planes(B_planes: np.array, planes: np.array, shape: tuple):
+    '''Inverse of to_z_planes: rebuilds the dense (ny*nx*nz, 3) field grid, interpolating linearly in z.'''
+    B_planes = B_planes.reshape(len(planes), shape[0], shape[1], 3)
+    k = np.arange(shape[2])
+    p = np.minimum(np.searchsorted(planes, k, side='right') - 1, len(planes) - 2)
+    f = ((k - planes[p])/(planes[p + 1] - planes[p]))[:, None, None, None]
+    B = (1 - f)*B_planes[p] + f*B_planes[p + 1]
+    return B.transpose(1, 2, 0, 3).reshape(-1, 3)
+
+def field_design(params, Z_init = 0, fSC_mag:bool = True, z_gap = 0.1, NI_from_B_goal:bool = True, use_diluted = False,
+                 magnets:list = None, sampling_tol:float = None, field_backend:str = 'snoopy', rom_dir:str = None,
+                 rom_tol:float = 0.01, **kwargs):
+    '''Design parameters and simulation options of simulate_field, stored with the field map.'''
+    options = {'Z_init': float(Z_init), 'fSC_mag': bool(fSC_mag), 'z_gap': float(z_gap),
+               'NI_from_B_goal': bool(NI_from_B_goal), 'use_diluted': bool(use_diluted)}
+    if magnets is not None: options['magnets'] = sorted(magnets)
+    if sampling_tol is not None: options['sampling_tol'] = float(sampling_tol)
+    if field_backend != 'snoopy': options['field_backend'] = field_backend
+    if rom_dir is not None: options['rom_tol'] = float(rom_tol)
+    return {'params': np.round(np.asarray(params, dtype=np.float64), 2).tolist(), 'options': options}
+
+def field_design_hash(params, **kwargs):
+    '''Hash identifying the design simulated by simulate_field, stored with the field map.'''
+    design = field_design(params, **kwargs)
+    return field_map_io.design_hash(design['params'], **design['options'])
 
 def get_vector_field(magn_params,materials_dir,  use_diluted = False):
     if 'Mag2' in magn_params['yoke_type']:
@@ -272,26 +469,254 @@ def get_vector_field(magn_params,materials_dir,  use_diluted = False):
     else: raise ValueError(f'Invalid yoke type - Received yoke_type {magn_params["yoke_type"][0]}')
     return points.round(4).astype(np.float16), B.round(4).astype(np.float16), M_i, M_c, Q, J
 
+def snoopy_field(magn_params, materials_dir, use_diluted = False):
+    '''FEM field of the snoopy solvers (see get_vector_field), with the iron, coil and power costs (CHF) of the solved
+    masses and power (snoopy.compute_prices).'''
+    points, B, M_i, M_c, Q, J = get_vector_field(magn_params, materials_dir, use_diluted=use_diluted)
+    C_i, C_c, C_edf = snoopy.compute_prices(magn_params, 0, M_i, M_c, Q,materials_directory = materials_dir)
+    return {'points': points, 'B': B, 'cost': {'iron': float(C_i), 'coil': float(C_c), 'power': float(C_edf)}}
+
+def analytic_fields(magn_params, materials_dir, use_diluted = False):
+    points, B = analytic_field.get_vector_field(magn_params, materials_dir, use_diluted)
+    return {'points': points, 'B': B}
+
+#field backends: (magn_params, materials_dir, use_diluted) -> {'points', 'B'} over the FEM domain of the magnets, and
+#'cost' (see snoopy_field) if the backend computes it
+FIELD_BACKENDS = {'snoopy': snoopy_field,
+                  'analytic': analytic_fields}
+
 def run_fem(magn_params:dict,
-            materials_dir = None, use_diluted = False):
+            materials_dir = None, use_diluted = False, backend:str = 'snoopy'):
     """Runs the finite element method to compute the magnetic field.
     Parameters:
     magn_params (dict): Dictionary containing the magnets parameters.
     materials_dir (str, optional): Directory containing the materials. Defaults is None, returning the data dir in tha parent dir.
+    backend (str, optional): Field backend in FIELD_BACKENDS, 'snoopy' (FEM, default) or 'analytic' (see analytic_field).
     Returns:
-    dict: A dictionary containing the position points and the computed magnetic field 'B'.
+    dict: A dictionary containing the position points, the computed magnetic field 'B' and the 'cost' components of the magnets
+    if the backend computes them.
     """
+    if backend not in FIELD_BACKENDS:
+        raise ValueError('Invalid field backend: {}, valid ones are {}.'.format(backend, list(FIELD_BACKENDS)))
     materials_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(__file__))), 'data/materials')
     start = time()
-    points, B, M_i, M_c, Q, J = get_vector_field(magn_params, materials_dir, use_diluted=use_diluted)
-    C_i, C_c, C_edf = snoopy.compute_prices(magn_params, 0, M_i, M_c, Q,materials_directory = materials_dir)
-    cost = C_i + C_c + C_edf
+    fields = FIELD_BACKENDS[backend](magn_params, materials_dir, use_diluted=use_diluted)
     end = time()
-    print('FEM Computation time = {} sec'.format(end - start))
-    return {'points':points, 'B':B}
+    print('FEM Computation time ({}) = {} sec'.format(backend, end - start))
+    return fields
 
-def simulate_and_grid(params, points, use_diluted = False):
-    return get_grid_data(**run_fem(params, use_diluted = use_diluted), new_points=points)[1]
+def simulate_and_grid(params, points, use_diluted = False, field_backend:str = 'snoopy'):
+    return get_grid_data(**run_fem(params, use_diluted = use_diluted, backend = field_backend), new_points=points)
+
+def upsample_block(B:np.array, factors):
+    '''Block B of shape (ny, nx, nz, 3) sampled every factors = (fy, fx, fz) grid nodes, interpolated linearly (trilinear)
+    on every grid node: (ny - 1)*fy + 1 nodes along y, and so on.'''
+    B = np.asarray(B, dtype=np.float32)
+    for axis, f in enumerate(factors):
+        n = B.shape[axis]
+        if f == 1 or n == 1: continue
+        t = np.arange((n - 1)*f + 1)/f
+        i = np.minimum(t.astype(int), n - 2)
+        w = (t - i).astype(np.float32).reshape([-1 if a == axis else 1 for a in range(4)])
+        B = (1 - w)*np.take(B, i, axis=axis) + w*np.take(B, i + 1, axis=axis)
+    return B
+
+def grid_factors(block:dict, resol):
+    '''Node spacing (fy, fx, fz) of a local block in grid steps: 1 unless its 'sampling_resol' was chosen by adaptive_sampling.'''
+    if 'sampling_resol' not in block: return (1, 1, 1)
+    f = [int(round(r/g)) for r, g in zip(block['sampling_resol'], resol)]
+    return (f[1], f[0], f[2])
+
+def adaptive_sampling(B:np.array, resol, tol:float, levels:int = 3):
+    '''Adaptive sampling of a local block B (ny, nx, nz, 3) gridded with resol: the node spacing along z, then x, then y
+    is coarsened to the largest of 2**(levels - 1), ..., 2 grid steps for which the block, interpolated back on every
+    grid node (see upsample_block), differs from B by less than tol (T, rms over the nodes of B). The rms and not the
+    maximum: at the iron edges the field jumps by the whole step at any spacing. Long uniform return yokes keep few
+    nodes along z, compact coils stay at resol. The field is solved once, only its sampling changes.
+    Returns the sampled block and its resolution (x, y, z).'''
+    B = np.asarray(B)
+    reference = B.astype(np.float32)
+    def sample(factors):
+        #coarse nodes on every factors-th grid node, the nodes past the block (outside the FEM domain) are zero
+        pad = [(0, -(-(n - 1)//f)*f + 1 - n) for n, f in zip(B.shape[:3], factors)] + [(0, 0)]
+        return np.pad(B, pad)[::factors[0], ::factors[1], ::factors[2]]
+    def error(factors):
+        B_up = upsample_block(sample(factors), factors)[:B.shape[0], :B.shape[1], :B.shape[2]]
+        return np.sqrt(np.mean(np.sum((B_up - reference)**2, axis=-1)))
+    factors = [1, 1, 1]
+    for axis in (2, 1, 0):
+        for level in reversed(range(1, levels)):
+            trial = list(factors)
+            trial[axis] = 2**level
+            if error(trial) < tol:
+                factors = trial
+                break
+    sampling_resol = (resol[0]*factors[1], resol[1]*factors[0], resol[2]*factors[2])
+    B_sampled = sample(factors)
+    print('Sampling resolution {}: {} of {} nodes, field change {:.2e} T rms'.format(
+        tuple(np.round(sampling_resol, 6).tolist()), np.prod(B_sampled.shape[:3]), np.prod(B.shape[:3]), error(factors)))
+    return B_sampled, tuple(np.round(sampling_resol, 6).tolist())
+
+def simulate_local_block(params, z_phase:float, resol, use_diluted = False, sampling_tol:float = None, field_backend:str = 'snoopy'):
+    '''Runs the FEM for one entry of the magnet parameters and grids its field on a local block covering the FEM domain:
+    x and y nodes from 0, z nodes at z_phase + m*resol[2] from the (first) magnet Z_pos, for m from 'm0'. If sampling_tol
+    is given, the block keeps only the nodes chosen by adaptive_sampling, with their resolution as 'sampling_resol'
+    (see upsample_block). field_backend is passed to run_fem.
+    Returns a dict with the block 'B' of shape (ny, nx, nz, 3), 'm0', the solve and regrid times (s) and the FEM 'cost'
+    components if computed (see run_fem).'''
+    t1 = time()
+    fields = run_fem(params, use_diluted = use_diluted, backend = field_backend)
+    t2 = time()
+    points = fields['points'].astype(np.float64)
+    points[:, 2] -= params['Z_pos(m)'][0]
+    p_min, p_max = points.min(axis=0), points.max(axis=0)
+    nx = int(np.floor(p_max[0]/resol[0] + 1e-6)) + 1
+    ny = int(np.floor(p_max[1]/resol[1] + 1e-6)) + 1
+    m0 = int(np.ceil((p_min[2] - z_phase)/resol[2] - 1e-6))
+    m1 = int(np.floor((p_max[2] - z_phase)/resol[2] + 1e-6))
+    B = nearest_grid_field(points, fields['B'], (np.arange(nx)*resol[0], np.arange(ny)*resol[1], z_phase + np.arange(m0, m1 + 1)*resol[2]))
+    block = {'m0': m0, 'fem_time': t2 - t1}
+    if sampling_tol is not None: B, block['sampling_resol'] = adaptive_sampling(B, resol, sampling_tol)
+    block.update(B = B.astype(fields['B'].dtype), grid_time = time() - t2)
+    if 'cost' in fields: block['cost'] = fields['cost']
+    return block
+
+def full_resolution_block(block:dict, resol):
+    '''Local block on every node of the grid of resolution resol, interpolated if it was sampled coarser (see adaptive_sampling).'''
+    factors = grid_factors(block, resol)
+    if factors == (1, 1, 1): return block
+    return dict(block, B = upsample_block(block['B'], factors).astype(block['B'].dtype))
+
+def get_z_phase(params:dict, z_min:float, resol):
+    '''Offset of the grid z nodes from the magnet position, in [0, resol[2]).'''
+    return round((z_min - params['Z_pos(m)'][0]) % resol[2], 6) % resol[2]
+
+def get_field_blocks(params_split:list, z_min:float, resol, cores:int = 1, use_diluted = False, cache_dir:str = None, cache_size:float = 10.,
+                     sampling_tol:float = None, field_backend:str = 'snoopy', rom_dir:str = None, rom_tol:float = 0.01):
+    '''Local field blocks (see simulate_local_block) of params_split for a grid starting at z_min, taken from the cache in
+    cache_dir if given (see fem_cache), running the FEM in parallel for the others. If rom_dir is given, the blocks
+    missing from the cache are first predicted by the reduced-order model trained there (see field_rom), kept if the
+    estimated rms error is below rom_tol (T), and the FEM blocks are added to its samples.'''
+    z_phases = [get_z_phase(p, z_min, resol) for p in params_split]
+    keys = [fem_cache.magnet_key(p, z, resol, use_diluted, sampling_tol, field_backend) for p, z in zip(params_split, z_phases)]
+    blocks = [fem_cache.load_block(cache_dir, key) if cache_dir is not None else None for key in keys]
+    missing = [i for i, b in enumerate(blocks) if b is None]
+    if cache_dir is not None: print('FEM cache: {} of {} magnet fields cached'.format(len(blocks) - len(missing), len(blocks)))
+    rom_names = [field_rom.model_key(p, use_diluted, field_backend) for p in params_split]
+    predicted = []
+    if rom_dir is not None:
+        for i in missing:
+            block, error = field_rom.predict_block(rom_dir, params_split[i], z_phases[i], resol, rom_names[i])
+            if error < rom_tol: blocks[i] = block; predicted.append(i)
+        print('Field ROM: {} of {} magnet fields predicted'.format(len(predicted), len(missing)))
+    missing = [i for i in missing if i not in predicted]
+    if missing:
+        new_blocks = schedule_fem(simulate_local_block, [params_split[i] for i in missing],
+                                  [(params_split[i], z_phases[i], resol, use_diluted, sampling_tol, field_backend) for i in missing], cores)
+        for i, block in zip(missing, new_blocks):
+            if cache_dir is not None: fem_cache.store_block(cache_dir, keys[i], block, cache_size)
+            blocks[i] = block
+    if rom_dir is not None:
+        for i in range(len(blocks)):
+            if i not in predicted: field_rom.store_sample(rom_dir, keys[i], params_split[i], full_resolution_block(blocks[i], resol),
+                                                          z_phases[i], resol, rom_names[i])
+    return blocks
+
+def add_field_block(B:np.array, block:dict, params:dict, z_min:float, resol, sign:float = 1.):
+    '''Adds (sign = 1) or subtracts (sign = -1) in place the local field block of params to the (ny, nx, nz, 3) grid B
+    starting at z_min, cropped to the grid. A block sampled coarser than resol is interpolated on the grid nodes first.'''
+    b = full_resolution_block(block, resol)['B']
+    k0 = int(round((params['Z_pos(m)'][0] + get_z_phase(params, z_min, resol) - z_min)/resol[2])) + block['m0']
+    k_start, k_end = max(k0, 0), min(k0 + b.shape[2], B.shape[2])
+    if k_end <= k_start: return
+    ny, nx = min(B.shape[0], b.shape[0]), min(B.shape[1], b.shape[1])
+    B[:ny, :nx, k_start:k_end] += sign*b[:ny, :nx, k_start - k0:k_end - k0].astype(np.float64)
+
+def get_cached_grid_data(params_split:list, points:tuple, resol, cores:int = 1, use_diluted = False,
+                         cache_dir:str = 'data/fem_cache', cache_size:float = 10., sampling_tol:float = None,
+                         field_backend:str = 'snoopy', rom_dir:str = None, rom_tol:float = 0.01):
+    '''Superposes the fields of params_split on the grid points of construct_grid (as simulate_and_grid summed over the magnets),
+    adding the local block of every magnet (see simulate_local_block) to a single global array. If cache_dir is given,
+    the FEM only runs for the magnets missing from the cache (see fem_cache), cached blocks are shifted along z to the
+    magnet position. Returns the (ny*nx*nz, 3) field and, for every run, a dict with its FEM 'cost' components and
+    'sampling_resol' when known.'''
+    z_min = points[2][0, 0, 0]
+    blocks = get_field_blocks(params_split, z_min, resol, cores, use_diluted, cache_dir, cache_size, sampling_tol, field_backend,
+                              rom_dir, rom_tol)
+    B = np.zeros((*points[0].shape, 3))
+    for p, block in zip(params_split, blocks):
+        add_field_block(B, block, p, z_min, resol)
+    return B.reshape(-1, 3), [{k: block[k] for k in ('cost', 'sampling_resol') if k in block} for block in blocks]
+
+def estimate_fem_cost(params:dict):
+    '''Relative cost of the FEM run of params (dict of lists, see split_magnet_params): the number of field nodes in the
+    FEM domain of every magnet, weighted by SC_COST_FACTOR for the superconducting magnet.'''
+    cost = 0.
+    for i, yoke_type in enumerate(params['yoke_type']):
+        dx = max(params['Xyoke1(m)'][i], params['Xyoke2(m)'][i]) + params['delta_x(m)'][i]
+        dy = max(params['Yyoke1(m)'][i], params['Yyoke2(m)'][i]) + params['delta_y(m)'][i]
+        dz = params['Z_len(m)'][i] + 2*params['delta_z(m)'][i]
+        nodes = dx*dy*dz/(params['resol_x(m)'][i]*params['resol_y(m)'][i]*params['resol_z(m)'][i])
+        cost += nodes*(SC_COST_FACTOR if yoke_type == 'Mag2' else 1.)
+    return cost
+
+def _run_with_threads(func, threads:int, args:tuple):
+    '''Runs func(*args) with the native thread pools of the process (BLAS, OpenMP) limited to threads. Returns the
+    result, the elapsed time and the threads of the largest pool loaded during the run.'''
+    from threadpoolctl import threadpool_limits, threadpool_info
+    t1 = time()
+    with threadpool_limits(limits = threads):
+        result = func(*args)
+        applied = max([p['num_threads'] for p in threadpool_info()], default = 1)
+    return result, time() - t1, applied
+
+def fem_threads(cost:float, starting_costs:list, free:int):
+    '''Threads of a FEM run of the given cost started with free cores, while the runs of starting_costs start with it:
+    its share of the cores proportional to the costs, leaving at least one core to each of the other runs.'''
+    return max(1, min(free - len(starting_costs), int(free*cost/(cost + sum(starting_costs)))))
+
+def schedule_fem(func, params_split:list, args:list, cores:int = 1):
+    '''Runs func(*args[i]) for the FEM runs params_split[i] on a pool of processes, the largest estimated cost first (see
+    estimate_fem_cost). Every run is started with a share of the free cores as threads (see fem_threads), applied with
+    threadpoolctl to the thread pools loaded in the worker. The thread count of a run is fixed when it starts:
+    cores freed by finished runs only go to the runs not started yet, not to the solves still running, so the largest
+    first order keeps the tail of a single long solve short. The time and the threads of every run are printed. Returns
+    the results in the order of params_split.'''
+    try: import threadpoolctl
+    except ImportError: raise ImportError('threadpoolctl is needed to set the threads of the FEM runs (see requirements.txt).')
+    costs = [estimate_fem_cost(p) for p in params_split]
+    pending = sorted(range(len(params_split)), key = lambda i: -costs[i])
+    results, threads = [None]*len(params_split), [0]*len(params_split)
+    done = queue.Queue()
+    free = cores
+    with mp.Pool(max(1, min(cores, len(params_split)))) as pool:
+        while pending or free < cores:
+            while pending and free > 0:
+                i = pending.pop(0)
+                threads[i] = fem_threads(costs[i], [costs[j] for j in pending[:free - 1]], free) #the others start with one core each
+                free -= threads[i]
+                pool.apply_async(_run_with_threads, (func, threads[i], args[i]),
+                                 callback = lambda r, i = i: done.put((i, r, None)),
+                                 error_callback = lambda e, i = i: done.put((i, None, e)))
+            i, r, error = done.get()
+            if error is not None: raise error
+            results[i], elapsed, applied = r
+            free += threads[i]
+            times = ' (solve {:.1f} sec, regrid {:.1f} sec)'.format(results[i]['fem_time'], results[i]['grid_time']) if 'fem_time' in results[i] else ''
+            print('FEM run {} [{} at z = {:.2f} m]: {:.1f} sec{} with {} thread(s){}, estimated cost {:.2e}'.format(
+                i, '+'.join(params_split[i]['yoke_type']), params_split[i]['Z_pos(m)'][0], elapsed, times, applied,
+                '' if applied == threads[i] else ' of {} assigned'.format(threads[i]), costs[i]))
+    return results
+
+def split_magnet_params(magn_params:dict):
+    '''Splits the parameters of all magnets (dict of lists) into one dict per FEM run. The SC magnet (Mag2) is solved
+    together with the magnet before it.'''
+    params_split = [{k: [v[i]] for k, v in magn_params.items()} for i in range(0, len(magn_params['yoke_type']))]
+    if len(params_split) > 1 and params_split[1]['yoke_type'][0] == 'Mag2':
+        for k in magn_params.keys():
+            params_split[0][k] += params_split[1][k]
+        params_split.pop(1)
+    return params_split
 
 def run(magn_params:dict,
         resol = RESOL_DEF,
@@ -301,7 +726,17 @@ def run(magn_params:dict,
         output_file:str = './outputs',
         apply_symmetry:bool = False,
         cores:int = 1,
-        use_diluted =  False
+        use_diluted =  False,
+        brick_size:int = None,
+        octree_tol:float = None,
+        octree_depth:int = 10,
+        z_planes_tol:float = None,
+        fem_cache_dir:str = None,
+        fem_cache_size:float = 10.,
+        sampling_tol:float = None,
+        field_backend:str = 'snoopy',
+        rom_dir:str = None,
+        rom_tol:float = 0.01
         ):
     """Simulates the magnetic field based on given parameters and performs various operations such as applying symmetry,
     plotting results, and saving results.
@@ -314,6 +749,19 @@ def run(magn_params:dict,
     resol (tuple, optional): Resolution of the grid. Defaults to (0.05, 0.05, 0.05).
     d_space (tuple, optional): Dimensions of the space returned. Since the problem is symmetric, it must be in the form (dx,dy,(-z_i,z_f)).
     Defaults to ((3.5, 4.5, (-15., 15.))).
+    brick_size (int, optional): If given, 'B' is returned block-sparse (see to_bricks), with the 'brick_index' and 'brick_size'.
+    octree_tol (float, optional): If given, an adaptive octree map with this error bound (T) is built from the FEM point clouds
+    instead of the regular grid (see get_octree_data). octree_depth sets the finest level.
+    z_planes_tol (float, optional): If given, 'B' is returned factorized along z (see to_z_planes), with the kept 'z_planes'.
+    fem_cache_dir (str, optional): If given, the gridded field of every magnet is taken from / added to this cache (see
+    get_cached_grid_data), limited to fem_cache_size GB. Otherwise every FEM run is gridded on its local block.
+    sampling_tol (float, optional): If given, the field of every FEM run is kept at the coarsest node spacing (multiples of
+    resol) that reproduces it within this (T rms) (see adaptive_sampling), the chosen ones are returned as 'sampling_resol'.
+    Each magnet is solved once; its block is interpolated on the grid (resol) when added.
+    The FEM cost components of every run (see run_fem) are returned as 'cost', None where unknown.
+    field_backend (str, optional): Backend computing the field of every magnet (see run_fem). Defaults to 'snoopy'.
+    rom_dir (str, optional): If given, the fields are predicted by the reduced-order model trained in this directory when
+    its estimated rms error is below rom_tol (T), the others are simulated and added to its samples (see field_rom).
     Returns:
     dict: A dictionary containing the computed points and magnetic field 'B'.
     """
@@ -321,28 +769,44 @@ def run(magn_params:dict,
     n_magnets = len(magn_params['yoke_type'])
     print('Starting simulation for {} magnets'.format(n_magnets))
     limits_quadrant = ((0., 0., d_space[2][0]), (d_space[0],d_space[1], d_space[2][1]))
-    points = construct_grid(limits=limits_quadrant, resol=resol)
-    params_split = [({k: [v[i]] for k, v in magn_params.items()}, points, use_diluted) for i in range(0, n_magnets)]
-    if params_split[1][0]['yoke_type'][0] == 'Mag2':
-        for k in magn_params.keys():
-            params_split[0][0][k] += params_split[1][0][k]
-        params_split.pop(1)
-
-    with mp.Pool(cores) as pool:
-      B = pool.starmap(simulate_and_grid, params_split)
+    params_split = split_magnet_params(magn_params)
+
+    if octree_tol is not None:
+        fem_fields = schedule_fem(run_fem, params_split, [(p, None, use_diluted, field_backend) for p in params_split], cores)
+        fields = get_octree_data(fem_fields, limits_quadrant, tol = octree_tol, max_depth = octree_depth)
+        fields['cost'] = [f.get('cost') for f in fem_fields]
+        if save_results:
+            with gzip.open(output_file, 'wb') as f:
+                pickle.dump(fields, f)
+            print('Results saved to', output_file)
+        return fields
 
-    B = np.sum(B, axis=0)
+    points = construct_grid(limits=limits_quadrant, resol=resol)
+    #each worker returns the block around its magnet only, accumulated here into the global grid
+    B, fem_runs = get_cached_grid_data(params_split, points, resol, cores, use_diluted, fem_cache_dir, fem_cache_size, sampling_tol, field_backend,
+                                        rom_dir, rom_tol)
 
 
+    shape = points[0].shape
     points = np.column_stack([points[i].ravel() for i in range(3)])
     if apply_symmetry:
         points,B = get_symmetry(points, B, reorder = True)
+    fields = {'points':points, 'B':B}
+    if sampling_tol is not None: fields['sampling_resol'] = [r.get('sampling_resol') for r in fem_runs]
+    fields['cost'] = [r.get('cost') for r in fem_runs]
+    if brick_size is not None:
+        assert not apply_symmetry, 'Block-sparse field maps are only defined on the first quadrant grid'
+        fields['B'], fields['brick_index'] = to_bricks(B, shape, brick_size)
+        fields['brick_size'] = brick_size
+    elif z_planes_tol is not None:
+        assert not apply_symmetry, 'z-factorized field maps are only defined on the first quadrant grid'
+        fields['B'], fields['z_planes'] = to_z_planes(B, shape, z_planes_tol)
 
     if save_results:
         with gzip.open(output_file, 'wb') as f:
-            pickle.dump({'points':points, 'B':B}, f)
+            pickle.dump(fields, f)
         print('Results saved to', output_file)
-    return {'points':points, 'B':B}
+    return fields
     
 def simulate_field(params,
               Z_init = 0,
@@ -353,10 +817,54 @@ def simulate_field(params,
               NI_from_B_goal:bool = True,
               file_name = 'data/outputs/fields.pkl',
               cores = 1,
-              use_diluted = False ):
+              use_diluted = False,
+              brick_size:int = None,
+              octree_tol:float = None,
+              octree_depth:int = 10,
+              z_planes_tol:float = None,
+              field_encoding:str = 'float16',
+              field_compression:str = None,
+              fem_cache_dir:str = None,
+              magnets:list = None,
+              sampling_tol:float = None,
+              field_backend:str = 'snoopy',
+              rom_dir:str = None,
+              rom_tol:float = 0.01):
     
-    '''Simulates the magnetic field for the given parameters. If save_fields is True, the fields are saved to data/outputs/fields.pkl'''
+    '''Simulates the magnetic field for the given parameters. If file_name is given, the field map is saved there (see field_map_io),
+    with the given encoding (float16, float32 or int16) and compression (None, zstd or blosc). If magnets (names in
+    new_parametrization) is given, only the field of these magnets is simulated. sampling_tol selects the
+    node spacing of the field of every magnet (see run), the chosen ones are stored with the design, as the FEM cost of every run. field_backend selects the solver
+    (see run_fem), 'analytic' for a fast approximate map. With rom_dir, the reduced-order model stands in for the FEM
+    within rom_tol (see run).'''
     t1 = time()
+    all_params = get_all_magnet_params(params, fSC_mag, z_gap, resol, use_diluted, magnets)
+    try: all_params.to_csv(os.path.join(os.environ.get('PROJECTS_DIR', '../'), 'MuonsAndMatter/data/magnet_params.csv'), index=False)
+    except: pass
+    run_magnets = fem_run_magnets(all_params)
+    all_params = all_params.to_dict(orient='list')
+    fields = run(all_params, d_space=d_space, resol=resol, apply_symmetry=False, cores=cores, use_diluted = use_diluted, brick_size = brick_size,
+                 octree_tol = octree_tol, octree_depth = octree_depth, z_planes_tol = z_planes_tol,
+                 fem_cache_dir = fem_cache_dir, sampling_tol = sampling_tol, field_backend = field_backend,
+                 rom_dir = rom_dir, rom_tol = rom_tol)
+    if 'points' in fields: fields['points'][:,2] += Z_init/100
+    print('Magnetic field simulation took', time()-t1, 'seconds')
+    if file_name is not None:
+        design = field_design(params, Z_init, fSC_mag, z_gap, NI_from_B_goal, use_diluted, magnets, sampling_tol, field_backend,
+                              rom_dir, rom_tol)
+        if 'sampling_resol' in fields: design['sampling_resol'] = fields['sampling_resol']
+        design['cost'] = [dict(c, magnets = m) if c is not None else None for c, m in zip(fields['cost'], run_magnets)]
+        field_map_io.save_field_map(file_name, field_map_io.field_map_dict(fields, d_space, resol), d_space, resol,
+                                    design_hash = field_map_io.design_hash(design['params'], **design['options']), design = design,
+                                    encoding = field_encoding, compression = field_compression)
+        print('Fields saved to', file_name)
+    return fields
+
+def get_all_magnet_params(params, fSC_mag:bool = True, z_gap = 0.1, resol = RESOL_DEF, use_diluted = False, magnets:list = None):
+    '''Parameters of every simulated magnet (one row per magnet indexed by its name, with its Z_pos(m)) from the design parameters.
+    If magnets (names in new_parametrization) is given, the other magnets are left out, keeping the positions of the rest.'''
+    if magnets is not None and not set(magnets) <= set(new_parametrization):
+        raise ValueError('Unknown magnets {}, valid names are {}.'.format(sorted(set(magnets) - set(new_parametrization)), list(new_parametrization)))
     all_params = pd.DataFrame()
     Z_pos = 0.
     for i, (mag,idx) in enumerate(new_parametrization.items()):
@@ -378,23 +886,81 @@ def simulate_field(params,
               Ymgap = SC_Ymgap; yoke_type = 'Mag2'; mag_params[-1] = 3.2e6; B_goal = None
         p = get_magnet_params(mag_params, Ymgap=Ymgap, z_gap=z_gap, B_goal = B_goal, yoke_type=yoke_type, resol = resol, use_diluted = use_diluted)
         p['Z_pos(m)'] = Z_pos
-        all_params = pd.concat([all_params, pd.DataFrame([p])], ignore_index=True)
+        if magnets is None or mag in magnets:
+            all_params = pd.concat([all_params, pd.DataFrame([p], index=[mag])])
         Z_pos += p['Z_len(m)'] + z_gap
         if mag == 'M2': Z_pos += z_gap
-    try: all_params.to_csv(os.path.join(os.environ.get('PROJECTS_DIR', '../'), 'MuonsAndMatter/data/magnet_params.csv'), index=False)
-    except: pass
-    all_params = all_params.to_dict(orient='list')
-    fields = run(all_params, d_space=d_space, resol=resol, apply_symmetry=False, cores=cores, use_diluted = use_diluted)
-    fields['points'][:,2] += Z_init/100
-    print('Magnetic field simulation took', time()-t1, 'seconds')
-    if file_name is not None:
-        #with open(file_name, 'wb') as f:
-        #    pickle.dump(fields, f)
-        np.save(file_name, fields['B'].astype(np.float16))
-        print('Fields saved to', file_name)
-        file_name = file_name.replace('fields', 'points')
-        np.save(file_name, fields['points'].astype(np.float16))
-    return fields
+    return all_params
+
+def fem_run_magnets(all_params:pd.DataFrame):
+    '''Names of the magnets of every FEM run (see split_magnet_params) of the rows of get_all_magnet_params.'''
+    return [p['name'] for p in split_magnet_params({'yoke_type': list(all_params['yoke_type']), 'name': list(all_params.index)})]
+
+UPDATABLE_ENCODINGS = ('float32',) #encodings of the maps update_field_map changes in place
+
+def field_map_updatable(file_name:str, params, d_space = None, resol = RESOL_DEF, brick_size:int = None, octree_tol:float = None,
+                        z_planes_tol:float = None, field_encoding:str = 'float16', field_compression:str = None, **kwargs):
+    '''True if the field map in file_name can be brought to the design params by update_field_map: a dense, uncompressed
+    float32 map simulated with the same options, d_space and resolution, storing its design.'''
+    if not (os.path.exists(file_name) and field_map_io.is_field_map(file_name)): return False
+    header = field_map_io.read_header(file_name)
+    return (set(header['arrays']) == {'B'} and header.get('compression') is None and header.get('design') is not None
+            and header['encoding']['type'] == field_encoding and field_encoding in UPDATABLE_ENCODINGS
+            and brick_size is None and octree_tol is None and z_planes_tol is None and field_compression is None
+            and header['design']['options'] == field_design(params, **kwargs)['options']
+            and (d_space is None or np.allclose(np.hstack(header['d_space']).astype(float), np.hstack(d_space).astype(float)))
+            and np.allclose(header['resol'], resol))
+
+def update_field_map(file_name:str, old_params, new_params, fSC_mag:bool = True, z_gap = 0.1, resol = RESOL_DEF, cores:int = 1,
+                     use_diluted = False, fem_cache_dir:str = None, fem_cache_size:float = 10., Z_init = 0, NI_from_B_goal:bool = True,
+                     magnets:list = None, sampling_tol:float = None, field_backend:str = 'snoopy', rom_dir:str = None,
+                     rom_tol:float = 0.01, **kwargs):
+    '''Brings the dense field map saved in file_name from the design old_params to new_params in place. By superposition,
+    only the magnets whose parameters changed are simulated: their old field is subtracted and the new one added to the
+    memory-mapped grid. old_params defaults to the design stored with the map. Only float32 maps are updated: each update
+    rounds the changed region again to the stored precision, which float16 (about 1 mT at 2 T) would accumulate over a
+    chain of updates.
+    Returns the indices of the updated FEM runs (see split_magnet_params).'''
+    t1 = time()
+    header = field_map_io.read_header(file_name)
+    if set(header['arrays']) != {'B'} or header.get('compression') is not None or header['encoding']['type'] not in UPDATABLE_ENCODINGS:
+        raise ValueError('Field map {} is not a dense uncompressed float32 map and cannot be updated in place.'.format(file_name))
+    if old_params is None:
+        if header.get('design') is None: raise ValueError('Field map {} does not store its design.'.format(file_name))
+        old_params = header['design']['params']
+    old_split = split_magnet_params(get_all_magnet_params(np.array(old_params, dtype=float), fSC_mag, z_gap, resol, use_diluted, magnets).to_dict(orient='list'))
+    new_params_all = get_all_magnet_params(np.array(new_params, dtype=float), fSC_mag, z_gap, resol, use_diluted, magnets)
+    new_split = split_magnet_params(new_params_all.to_dict(orient='list'))
+    if len(old_split) != len(new_split):
+        raise ValueError('The number of simulated magnets changed, the field map has to be simulated again.')
+    changed = [i for i, (p_old, p_new) in enumerate(zip(old_split, new_split))
+               if json.dumps(p_old, sort_keys=True, default=float) != json.dumps(p_new, sort_keys=True, default=float)]
+    if changed:
+        z_min = header['range_z'][0]
+        shape = [int(round((header[k][1] - header[k][0])/header[k][2])) + 1 for k in ('range_y', 'range_x', 'range_z')]
+        blocks = get_field_blocks([old_split[i] for i in changed] + [new_split[i] for i in changed], z_min, resol,
+                                  cores, use_diluted, fem_cache_dir, fem_cache_size, sampling_tol, field_backend,
+                                  rom_dir, rom_tol)
+        a = header['arrays']['B']
+        B = np.memmap(file_name, dtype=np.dtype(a['dtype']), mode='r+', offset=a['offset'], shape=tuple(a['shape'])).reshape(*shape, 3)
+        for n, i in enumerate(changed):
+            add_field_block(B, blocks[n], old_split[i], z_min, resol, sign = -1.)
+            add_field_block(B, blocks[len(changed) + n], new_split[i], z_min, resol)
+        B.flush()
+        del B
+    design = field_design(new_params, Z_init, fSC_mag, z_gap, NI_from_B_goal, use_diluted, magnets, sampling_tol, field_backend,
+                          rom_dir, rom_tol)
+    if sampling_tol is not None and 'sampling_resol' in (header.get('design') or {}):
+        design['sampling_resol'] = list(header['design']['sampling_resol'])
+        for n, i in enumerate(changed): design['sampling_resol'][i] = blocks[len(changed) + n].get('sampling_resol')
+    design['cost'] = list((header.get('design') or {}).get('cost') or [None]*len(new_split))
+    run_magnets = fem_run_magnets(new_params_all)
+    for n, i in enumerate(changed):
+        cost = blocks[len(changed) + n].get('cost')
+        design['cost'][i] = dict(cost, magnets = run_magnets[i]) if cost is not None else None
+    field_map_io.update_header(file_name, design = design, design_hash = field_map_io.design_hash(design['params'], **design['options']))
+    print('Field map updated for {} of {} magnets in {:.1f} sec'.format(len(changed), len(new_split), time() - t1))
+    return changed
    
 
 
@@ -0,0 +1,64 @@
+'''Persistent memo of the NI(A) solves of get_magnet_params (snoopy.get_NI).
+
+The key hashes the magnet parameters the solve depends on (geometry, yoke type and coil) and the contents of the yoke
+and coil material files, without NI(A), the resolution and the position. Each entry keeps the B_goal (T) and NI(A) points solved for that magnet, so a B_goal
+between known points and within a tolerance of one of them is served by monotone (PCHIP) interpolation instead of a
+new solve. Entries are small JSON files, written atomically, shared by the workers and across runs.'''
+import os
+import json
+import hashlib
+import numpy as np
+from scipy.interpolate import PchipInterpolator
+
+IGNORED_KEYS = ('NI(A)', 'resol_x(m)', 'resol_y(m)', 'resol_z(m)', 'Z_pos(m)')
+MATERIAL_KEYS = ('material', 'coil_material')
+
+_MEMO = {}
+
+
+def ni_key(magn_params:dict, materials_directory:str):
+    '''Key of the NI solve of magn_params (dict of one magnet, see get_magnet_params).'''
+    key = {k: (round(float(v), 6) if isinstance(v, (float, np.floating)) else v)
+           for k, v in magn_params.items() if k not in IGNORED_KEYS}
+    for k in MATERIAL_KEYS:
+        #the file contents, so edited BH curves or costs do not reuse stale solves
+        with open(os.path.join(materials_directory, magn_params[k]), 'rb') as f:
+            key[k] = hashlib.sha1(f.read()).hexdigest()
+    return hashlib.sha1(json.dumps(key, sort_keys=True, default=str).encode()).hexdigest()
+
+def _points(cache_dir:str, key:str):
+    if key in _MEMO: return _MEMO[key]
+    points = {}
+    if cache_dir:
+        try:
+            with open(os.path.join(cache_dir, key + '.json')) as f:
+                points = {float(b): float(ni) for b, ni in zip(*json.load(f))}
+        except (OSError, ValueError):
+            pass #no entry yet, or being written by another process
+    _MEMO[key] = points
+    return points
+
+def lookup(cache_dir:str, key:str, B_goal:float, tol:float = 0.05):
+    '''NI(A) for B_goal from the known points of key: exact, or interpolated if B_goal lies between known points and
+    within tol (T) of the nearest one. None otherwise.'''
+    points = _points(cache_dir, key)
+    B_goal = float(B_goal)
+    if B_goal in points: return points[B_goal]
+    if len(points) < 2: return None
+    B = np.array(sorted(points))
+    if not B[0] < B_goal < B[-1] or np.abs(B - B_goal).min() > tol: return None
+    return float(PchipInterpolator(B, [points[b] for b in B])(B_goal))
+
+def store(cache_dir:str, key:str, B_goal:float, NI:float):
+    '''Adds a solved point to key, merged with the points written meanwhile by other processes.'''
+    points = _points(cache_dir, key)
+    points[float(B_goal)] = float(NI)
+    if not cache_dir: return
+    os.makedirs(cache_dir, exist_ok=True)
+    _MEMO.pop(key)
+    points = _MEMO[key] = {**_points(cache_dir, key), **points}
+    B = sorted(points)
+    tmp_file = os.path.join(cache_dir, '{}.{}.tmp'.format(key, os.getpid()))
+    with open(tmp_file, 'w') as f:
+        json.dump([B, [points[b] for b in B]], f)
+    os.replace(tmp_file, os.path.join(cache_dir, key + '.json'))
@@ -3,9 +3,10 @@ from os import getenv, environ
 environ["OMP_NUM_THREADS"] = "1"
 import numpy as np
 import pickle
-from lib import magnet_simulations
+from lib import magnet_simulations, field_map_io
+from lib.reference_designs.params import new_parametrization
 from time import time
-from muon_slabs import initialize
+from muon_slabs import initialize, attach_field_map as attach_field_map_geant4
 import json
 
 from snoopy import RacetrackCoil, compute_prices, get_NI
@@ -35,7 +36,8 @@ def estimate_electrical_cost(params,
     '''
     print('The yoke type is = {}'.format(yoke_type))
     # In case of diluted the cost are estimated considering the yoke type always as Mag1
-    mag_params = magnet_simulations.get_magnet_params(params,Ymgap=Ymgap,yoke_type=yoke_type if not use_diluted else 'Mag1', B_goal = params[13], materials_directory=materials_directory, z_gap=z_gap, use_diluted = use_diluted)
+    # z_gap is in cm here and in m in get_magnet_params, as in the field simulation (same Z_len(m) and NI solve)
+    mag_params = magnet_simulations.get_magnet_params(params,Ymgap=Ymgap,yoke_type=yoke_type if not use_diluted else 'Mag1', B_goal = params[13], materials_directory=materials_directory, z_gap=z_gap/100, use_diluted = use_diluted)
     mag_params['yoke_type'] = yoke_type ## To reset to original yoke type in case of diluted
     coil_material = mag_params['coil_material']
     with open(join(materials_directory, coil_material)) as f:
@@ -276,30 +278,37 @@ def get_field(resimulate_fields = False,
             file_name = 'data/outputs/fields.pkl',
             only_grid_params = False,
             **kwargs_field):
-    '''Returns the field map for the given parameters. If from_file is True, the field map is loaded from the file_name.'''
+    '''Returns the field map for the given parameters. If resimulate_fields is False, the field map is loaded from file_name,
+    checked against the requested d_space and resolution. If it is True and file_name holds a dense map of another design
+    with the same options, only the changed magnets are simulated (see update_field_map). If the map stores the design of
+    params, the FEM cost of its runs (see simulate_field) is returned as 'fem_cost'.'''
+    if resimulate_fields and magnet_simulations.field_map_updatable(file_name, params, **kwargs_field):
+        try:
+            magnet_simulations.update_field_map(file_name, None, params, **kwargs_field)
+            resimulate_fields = False
+        except ValueError as e:
+            print('Field map {} cannot be updated ({}), simulating the whole map.'.format(file_name, e))
     if resimulate_fields:
-        fields = magnet_simulations.simulate_field(params, file_name = file_name,**kwargs_field)['B']
-        d_space = kwargs_field['d_space']
-        with open(file_name.replace('fields', 'd_space'), 'wb') as f:
-            pickle.dump(d_space, f)
+        fields = magnet_simulations.simulate_field(params, file_name = file_name,**kwargs_field)
+        fields = field_map_io.field_map_dict(fields, kwargs_field['d_space'], kwargs_field['resol'])
+    elif exists(file_name) and field_map_io.is_field_map(file_name):
+        print('Using field map from file', file_name)
+        fields = field_map_io.load_field_map(file_name, kwargs_field.get('d_space'), kwargs_field.get('resol'),
+                                             magnet_simulations.field_design_hash(params, **kwargs_field) if params is not None else None)
     elif exists(file_name):
+        #plain .npy map with its d_space pickle, from before the field map container
         print('Using field map from file', file_name)
-        fields = np.load(file_name).astype(np.float16)
         with open(file_name.replace('fields', 'd_space'), 'rb') as f:
             d_space = pickle.load(f)
-        #TODO: FIX THIS
-        #assert d_space == kwargs_field['d_space'], "{} not equal to {}".format(d_space, kwargs_field['d_space'])
-        #with open(file_name, 'rb') as f:
-        #    fields = pickle.load(f)
-    if only_grid_params: 
-        d_space = d_space#kwargs_field['d_space']
-        resol = kwargs_field['resol']
-        #cost = fields.pop('cost')
-        fields= {'B': fields,#.pop('B'),
-                'range_x': [0,d_space[0], resol[0]],
-                'range_y': [0,d_space[1], resol[1]],
-                'range_z': [d_space[2][0],d_space[2][1], resol[2]]}
-    return fields
+        if kwargs_field.get('d_space') is not None and not np.allclose(np.hstack(d_space), np.hstack(kwargs_field['d_space'])):
+            print('WARNING: field map {} covers d_space {}, {} was requested.'.format(file_name, d_space, kwargs_field['d_space']))
+        fields = field_map_io.field_map_dict({'B': np.load(file_name).astype(np.float16)}, d_space, kwargs_field['resol'])
+    if params is not None and file_name is not None and exists(file_name) and field_map_io.is_field_map(file_name):
+        header = field_map_io.read_header(file_name)
+        if header.get('design_hash') == magnet_simulations.field_design_hash(params, **kwargs_field):
+            fields['fem_cost'] = (header.get('design') or {}).get('cost')
+    if only_grid_params: return fields
+    return fields['B']
 
 def CreateArb8(arbName, medium, dZ, corners, magField, field_profile,
                tShield, x_translation, y_translation, z_translation, stepGeo):
@@ -573,8 +582,35 @@ def construct_block(medium, tShield,field_profile, stepGeo):
     tShield['magnets'].append(Block)
 
 
-def design_muon_shield(params,fSC_mag = True, simulate_fields = False, field_map_file = None, cores_field:int = 1,extra_magnet = False, NI_from_B = True, use_diluted = False):
-
+def local_field_map(field_map:dict, z_min:float, z_max:float):
+    '''Part of a dense field map (see field_map_io.field_map_dict) between z_min and z_max (m), as the field of the
+    'local' profile. B is a (ny, nx, nz, 3) view of the map in its stored dtype, not a copy: Geant4 reads a float32 or
+    float16 slice in place when the storage has the same precision (see pack_geometry), so a memory-mapped map is
+    shared instead of copied.'''
+    ranges = [field_map[k] for k in ('range_y', 'range_x', 'range_z')]
+    shape = [int(round((r[1] - r[0])/r[2])) + 1 for r in ranges]
+    z0, _, dz = field_map['range_z']
+    k0 = max(int(np.floor((z_min - z0)/dz)), 0)
+    k1 = min(int(np.ceil((z_max - z0)/dz)), shape[2] - 1)
+    B = np.asarray(field_map['B']).reshape(*shape, 3)[:, :, k0:k1 + 1]
+    return {'B': B,
+            'range_x': list(field_map['range_x']), 'range_y': list(field_map['range_y']),
+            'range_z': [z0 + k0*dz, z0 + k1*dz, dz]}
+
+def design_muon_shield(params,fSC_mag = True, simulate_fields = False, field_map_file = None, cores_field:int = 1,extra_magnet = False, NI_from_B = True, use_diluted = False, brick_size:int = None, octree_tol:float = None, z_planes_tol:float = None,
+                       field_encoding:str = 'float16', field_compression:str = None, fem_cache_dir:str = None, fem_magnets:list = None,
+                       defer_field_map:bool = False, sampling_tol:float = None, field_backend:str = 'snoopy',
+                       field_rom_dir:str = None, field_rom_tol:float = 0.01):
+    '''Muon shield geometry for the given parameters. With a field map (simulate_fields or field_map_file), the magnets
+    named in fem_magnets (keys of new_parametrization, all if None) take their field from the FEM map, which only covers
+    them, and the others get the uniform fields. A dense map of selected magnets is split into one local map per magnet
+    over its FEM domain along z (see local_field_map), so the gaps between the domains, where the field has decayed,
+    are not kept in memory; block-sparse, octree, z-factorized and deferred maps stay global. If defer_field_map is True, the map is neither simulated nor loaded:
+    'global_field_map' only describes it, to be attached to Geant4 later by attach_field_map. sampling_tol selects the
+    node spacing of the field of every magnet (see magnet_simulations.run) and field_backend the solver (see magnet_simulations.run_fem).
+    With field_rom_dir, magnet fields are predicted by the reduced-order model trained there within field_rom_tol (see field_rom).
+    The cost of the magnets solved by the FEM is taken from the masses and power of the solves, the others are estimated
+    (all of them with a deferred map, until deferred_design_cost).'''
     
     n_magnets = 7 + int(extra_magnet)
     cm = 1
@@ -671,21 +707,57 @@ def design_muon_shield(params,fSC_mag = True, simulate_fields = False, field_map
         'magnets':[],
         'global_field_map': {'B': np.array([])},
     }
-    if field_map_file is not None or simulate_fields: 
+    #the extra magnet continues the last one
+    fem = np.array([fem_magnets is None or list(new_parametrization)[min(nM, 6)] in fem_magnets for nM in range(n_magnets)])
+    fem &= (dZf >= 1) & (dXIn >= 1)
+    if fSC_mag: fem[[1,3]] = False
+    if (field_map_file is not None or simulate_fields) and fem.any(): 
         simulate_fields = (not exists(field_map_file)) or simulate_fields
-        max_x = max(np.max(dXIn + dXIn * ratio_yokesIn + gapIn+midGapIn), np.max(dXOut + dXOut * ratio_yokesOut+gapOut+midGapOut))/100
-        max_y = max(np.max(dYIn + dY_yokeIn), np.max(dYOut + dY_yokeOut))/100
+        if fem_magnets is None:
+            max_x = max(np.max(dXIn + dXIn * ratio_yokesIn + gapIn+midGapIn), np.max(dXOut + dXOut * ratio_yokesOut+gapOut+midGapOut))/100
+            max_y = max(np.max(dYIn + dY_yokeIn), np.max(dYOut + dY_yokeOut))/100
+            z_range = (-0.5, np.ceil((Z[-1]+dZf[-1]+50+10)/100).item())
+        else:
+            max_x = max(np.max((dXIn + dXIn * ratio_yokesIn + gapIn+midGapIn)[fem]), np.max((dXOut + dXOut * ratio_yokesOut+gapOut+midGapOut)[fem]))/100
+            max_y = max(np.max((dYIn + dY_yokeIn)[fem]), np.max((dYOut + dY_yokeOut)[fem]))/100
+            z_range = (np.floor(np.min((Z-dZf)[fem]-50)/10).item()/10, np.ceil(np.max((Z+dZf)[fem]+50+10)/100).item())
         max_x = np.round(max_x,decimals=1).item()
         max_y = np.round(max_y,decimals=1).item()
-        d_space = (max_x+0.3, max_y+0.3, (-0.5, np.ceil((Z[-1]+dZf[-1]+50+10)/100).item()))
+        d_space = (max_x+0.3, max_y+0.3, z_range)
         resol = RESOL_DEF
-        field_map = get_field(simulate_fields,np.asarray(params),Z_init = (Z[0] - dZf[0]), fSC_mag=fSC_mag, 
-                              resol = resol, d_space = d_space,
-                              file_name=field_map_file, only_grid_params=True, NI_from_B_goal = NI_from_B, z_gap=zgap/100,
-                              cores = min(cores_field,n_magnets), use_diluted = use_diluted)
-        tShield['global_field_map'] = field_map
+        if defer_field_map:
+            design_hash = magnet_simulations.field_design_hash(np.asarray(params), Z_init = (Z[0] - dZf[0]), fSC_mag = fSC_mag, z_gap = zgap/100,
+                                                               NI_from_B_goal = NI_from_B, use_diluted = use_diluted, magnets = fem_magnets,
+                                                               sampling_tol = sampling_tol, field_backend = field_backend,
+                                                               rom_dir = field_rom_dir, rom_tol = field_rom_tol)
+            tShield['global_field_map'] = {'B': np.array([]), 'deferred': True, 'file_name': field_map_file,
+                                           'd_space': d_space, 'resol': resol, 'design_hash': design_hash}
+        else:
+            tShield['global_field_map'] = get_field(simulate_fields,np.asarray(params),Z_init = (Z[0] - dZf[0]), fSC_mag=fSC_mag, 
+                                  resol = resol, d_space = d_space,
+                                  file_name=field_map_file, only_grid_params=True, NI_from_B_goal = NI_from_B, z_gap=zgap/100,
+                                  cores = min(cores_field,n_magnets), use_diluted = use_diluted, brick_size = brick_size, octree_tol = octree_tol, z_planes_tol = z_planes_tol,
+                                  field_encoding = field_encoding, field_compression = field_compression, fem_cache_dir = fem_cache_dir,
+                                  magnets = fem_magnets, sampling_tol = sampling_tol, field_backend = field_backend,
+                                  rom_dir = field_rom_dir, rom_tol = field_rom_tol)
         #tShield['cost'] = cost
-    cost = 0
+    #FEM costs of the runs stored with the field map: iron, coil and power of all the magnets solved together
+    fem_cost = [c for c in tShield['global_field_map'].pop('fem_cost', None) or [] if c is not None]
+    fem_costed = {name for c in fem_cost for name in c['magnets']}
+    cost = sum(c['iron'] + c['coil'] + c['power'] for c in fem_cost)
+    estimated_costs = {}
+    local_maps = {}
+    global_map = tShield['global_field_map']
+    if fem_magnets is not None and (global_map['B'].size or 'deferred' in global_map):
+        if global_map.get('deferred') or any(k in global_map for k in ('brick_index', 'octree', 'z_planes')):
+            print('Local field maps need a dense map loaded now, the selected magnets use the global map.')
+        else:
+            #one local map per FEM magnet over its FEM domain along z, instead of one map over the span of the selection;
+            #Geant4 also gives their field to the world around the magnets, so the fringe field is kept
+            for nM in np.flatnonzero(fem):
+                margin = 100*magnet_simulations.get_fixed_params('Mag2' if fSC_mag and nM == 2 else 'Mag1')['delta_z(m)']
+                local_maps[nM] = local_field_map(global_map, (Z[nM] - dZf[nM] - margin)/100, (Z[nM] + dZf[nM] + margin)/100)
+            tShield['global_field_map'] = {'B': np.array([])}
     for nM in range(0,n_magnets):
         if dZf[nM] < 1 or dXIn[nM] < 1: continue
         if fSC_mag and (nM in [1,3]):
@@ -700,7 +772,10 @@ def design_muon_shield(params,fSC_mag = True, simulate_fields = False, field_map
             Ymgap = 0
             ironField_s = 1.9 * tesla
 
-        if simulate_fields or field_map_file is not  None:
+        if nM in local_maps:
+            field_profile = 'local'
+            fields_s = local_maps[nM]
+        elif (tShield['global_field_map']['B'].size or 'deferred' in tShield['global_field_map']) and fem[nM]:
             field_profile = 'global'
             fields_s = [[],[],[]]
         else:
@@ -719,11 +794,18 @@ def design_muon_shield(params,fSC_mag = True, simulate_fields = False, field_map
               dY_yokeIn[nM], dY_yokeOut[nM], gapIn[nM], gapOut[nM], Z[nM], False, Ymgap=Ymgap)
         yoke_type = 'Mag1' if nM in [0,1,2,3] else 'Mag3'
         if fSC_mag and nM==2: yoke_type = 'Mag2'
-        cost += get_iron_cost([dZf[nM]+zgap/2, dXIn[nM], dXOut[nM], dYIn[nM], dYOut[nM], gapIn[nM], gapOut[nM], ratio_yokesIn[nM], ratio_yokesOut[nM], dY_yokeIn[nM], dY_yokeOut[nM], midGapIn[nM], midGapOut[nM]], Ymgap=Ymgap, zGap=zgap)        
-        cost += estimate_electrical_cost(np.array([dZf[nM]+zgap/2, dXIn[nM], dXOut[nM], dYIn[nM], dYOut[nM], gapIn[nM], gapOut[nM], ratio_yokesIn[nM], ratio_yokesOut[nM], dY_yokeIn[nM], dY_yokeOut[nM], midGapIn[nM], midGapOut[nM], NI[nM]]), Ymgap=Ymgap, z_gap=zgap, yoke_type=yoke_type, NI_from_B=NI_from_B, use_diluted=use_diluted)
+        name = list(new_parametrization)[nM] if nM < len(new_parametrization) else magnetName[nM]
+        if name in fem_costed: continue
+        magnet_cost = get_iron_cost([dZf[nM]+zgap/2, dXIn[nM], dXOut[nM], dYIn[nM], dYOut[nM], gapIn[nM], gapOut[nM], ratio_yokesIn[nM], ratio_yokesOut[nM], dY_yokeIn[nM], dY_yokeOut[nM], midGapIn[nM], midGapOut[nM]], Ymgap=Ymgap, zGap=zgap)        
+        magnet_cost += estimate_electrical_cost(np.array([dZf[nM]+zgap/2, dXIn[nM], dXOut[nM], dYIn[nM], dYOut[nM], gapIn[nM], gapOut[nM], ratio_yokesIn[nM], ratio_yokesOut[nM], dY_yokeIn[nM], dY_yokeOut[nM], midGapIn[nM], midGapOut[nM], NI[nM]]), Ymgap=Ymgap, z_gap=zgap, yoke_type=yoke_type, NI_from_B=NI_from_B, use_diluted=use_diluted)
+        estimated_costs[name] = float(magnet_cost)
+        cost += magnet_cost
     tShield['cost'] = cost
+    #the FEM cost of a deferred map is only known once it is simulated, see deferred_design_cost
+    if 'deferred' in tShield['global_field_map']: tShield['global_field_map']['estimated_costs'] = estimated_costs
     print('TOTAL COST', cost)
-    field_profile = 'global' if simulate_fields else 'uniform'
+    has_global_map = tShield['global_field_map']['B'].size or 'deferred' in tShield['global_field_map']
+    field_profile = 'global' if simulate_fields and has_global_map else 'uniform'
     construct_block("G4_Fe", tShield, field_profile, False)
     return tShield
 
@@ -742,9 +824,25 @@ def get_design_from_params(params,
                            cores_field:int = 1,
                            extra_magnet = False,
                            NI_from_B = True, 
-                           use_diluted = False):
+                           use_diluted = False,
+                           field_storage:str = 'float32_aos',
+                           field_interpolation:str = 'nearest',
+                           field_brick_size:int = None,
+                           field_octree_tol:float = None,
+                           field_z_planes_tol:float = None,
+                           field_encoding:str = 'float16',
+                           field_compression:str = None,
+                           fem_cache_dir:str = None,
+                           fem_magnets:list = None,
+                           defer_field_map:bool = False,
+                           sampling_tol:float = None,
+                           field_backend:str = 'snoopy',
+                           field_rom_dir:str = None,
+                           field_rom_tol:float = 0.01):
     params = np.round(params, 2)
-    shield = design_muon_shield(params, fSC_mag, simulate_fields = simulate_fields, field_map_file = field_map_file, cores_field=cores_field, extra_magnet = extra_magnet, NI_from_B = NI_from_B, use_diluted=use_diluted)
+    shield = design_muon_shield(params, fSC_mag, simulate_fields = simulate_fields, field_map_file = field_map_file, cores_field=cores_field, extra_magnet = extra_magnet, NI_from_B = NI_from_B, use_diluted=use_diluted, brick_size = field_brick_size, octree_tol = field_octree_tol, z_planes_tol = field_z_planes_tol, field_encoding = field_encoding, field_compression = field_compression, fem_cache_dir = fem_cache_dir, fem_magnets = fem_magnets, defer_field_map = defer_field_map, sampling_tol = sampling_tol, field_backend = field_backend, field_rom_dir = field_rom_dir, field_rom_tol = field_rom_tol)
+    shield['global_field_map']['storage'] = field_storage #float32_aos, float32_soa, float16_aos or float16_soa
+    shield['global_field_map']['interpolation'] = field_interpolation #nearest or linear
     shift = -2.345
     cavern_transition = 20.518+shift #m
     World_dZ = 200 #m
@@ -761,8 +859,8 @@ def get_design_from_params(params,
             if force_remove_magnetic_field:
                 x['field'] = (0.0, 0.0, 0.0)
                 x['field_profile'] = 'uniform'
-            elif x['field_profile'] not in ['uniform','global']: 
-                x['field']['B'] = x['field']['B'].tolist()
+            elif x['field_profile'] == 'local':
+                x['field'].update(storage = field_storage, interpolation = field_interpolation)
             #if add_cavern: x['corners'] = contraints_cavern_intersection(np.array(x['corners']), x['dz'], x['z_center'], cavern_transition).tolist()
         mag['material'] = 'G4_Fe'
         if mag['dz'] + mag['z_center'] > max_z:
@@ -785,15 +883,79 @@ def get_design_from_params(params,
             "dy": sensitive_film_params['dy']}})
     return shield
 
+FIELD_PROFILES = {'uniform': 0, 'global': 1} #any other profile is a local field map (2), the cavern has none (-1)
+
+def pack_geometry(detector:dict):
+    '''Solids of a detector of type 1 (cavern blocks and magnet components) as flat numpy arrays, in the layout of
+    ShieldGeometry (cpp/ShieldGeometry.hh), so they are passed to initialize without going through the detector JSON.
+    The local field maps are passed as they are (see local_field_map), one array per map.'''
+    materials, rows, local_maps, local_index = [], [], [], {}
+    def material_index(name):
+        if name not in materials: materials.append(name)
+        return materials.index(name)
+    for cavern in detector.get('cavern', []):
+        for corners in cavern['components']:
+            rows.append((corners, cavern['dz'], cavern['z_center'], material_index(cavern['material']), -1, (0., 0., 0.), -1))
+    for mag in detector.get('magnets', []):
+        for x in mag['components']:
+            profile = FIELD_PROFILES.get(x['field_profile'], 2)
+            field = x['field'] if profile == 0 else (0., 0., 0.)
+            #the components of a magnet share its local map
+            if profile == 2 and id(x['field']) not in local_index:
+                local_index[id(x['field'])] = len(local_maps)
+                local_maps.append(x['field'])
+            rows.append((x['corners'], mag['dz'], mag['z_center'], material_index(mag['material']), profile, field,
+                         local_index[id(x['field'])] if profile == 2 else -1))
+    corners, dz, z_center, material, field_profile, field, local_field = zip(*rows) if rows else [()]*7
+    return {'materials': materials,
+            'corners': np.asarray(corners, dtype=np.float64).reshape(-1, 16),
+            'dz': np.asarray(dz, dtype=np.float64),
+            'z_center': np.asarray(z_center, dtype=np.float64),
+            'material': np.asarray(material, dtype=np.int32),
+            'field_profile': np.asarray(field_profile, dtype=np.int32),
+            'field': np.asarray(field, dtype=np.float64).reshape(-1, 3),
+            'local_field': np.asarray(local_field, dtype=np.int32),
+            'local_ranges': np.array([[*f['range_x'], *f['range_y'], *f['range_z']] for f in local_maps], dtype=np.float64).reshape(-1, 9),
+            'local_B': [np.asarray(f['B']) for f in local_maps],
+            'local_interpolation': [f.get('interpolation', 'nearest') for f in local_maps],
+            'local_storage': [f.get('storage', 'float32_aos') for f in local_maps]}
+
 def initialize_geant4(detector, seed = None):
     B = detector['global_field_map'].pop('B')
     B = np.asarray(B).flatten()
+    B_index = [detector['global_field_map'].pop(k) for k in ('brick_index', 'octree', 'z_planes') if k in detector['global_field_map']]
+    B_index = np.asarray(B_index[0] if B_index else [], dtype=np.int32)
     if seed is None: seeds = (np.random.randint(256), np.random.randint(256), np.random.randint(256), np.random.randint(256))
     else: seeds = (seed, seed, seed, seed)
-    # Save detector configuration to JSON file
-    output_data = initialize(*seeds,json.dumps(detector,default=lambda o: float(o) if isinstance(o, np.float32) else o), B) #
+    #the solids of a GDetectorConstruction go as arrays, the JSON only keeps the settings
+    geometry = pack_geometry(detector) if detector.get('type') == 1 else None
+    detector_specs = {k: v for k, v in detector.items() if geometry is None or k not in ('cavern', 'magnets')}
+    output_data = initialize(*seeds,json.dumps(detector_specs,default=lambda o: float(o) if isinstance(o, np.float32) else o), B, B_index, geometry) #
     return output_data
 
+def attach_field_map(field_map_specs:dict):
+    '''Loads the field map described by the 'global_field_map' of a detector initialized with a deferred map (see
+    design_muon_shield) and attaches it to Geant4.'''
+    field_map = field_map_io.load_field_map(field_map_specs['file_name'], field_map_specs['d_space'], field_map_specs['resol'],
+                                            field_map_specs['design_hash'])
+    #a view of the memory-mapped file, used in place by a Geant4 storage of the same precision (float32_aos for a float32
+    #map, float16_aos for a float16 one), so the workers share its pages instead of each holding a copy
+    B = np.asarray(field_map.pop('B')).reshape(-1)
+    B_index = [field_map.pop(k) for k in ('brick_index', 'octree', 'z_planes') if k in field_map]
+    B_index = np.asarray(B_index[0] if B_index else [], dtype=np.int32)
+    field_map.update({k: field_map_specs[k] for k in ('storage', 'interpolation') if k in field_map_specs})
+    attach_field_map_geant4(json.dumps(field_map), B, B_index)
+
+def deferred_design_cost(field_map_specs:dict):
+    '''Cost of a design built with a deferred field map (see design_muon_shield), once the map is simulated: the FEM
+    cost stored with the map replaces the estimates of the magnets it covers, as for a map loaded up front.'''
+    header = field_map_io.read_header(field_map_specs['file_name'])
+    fem_cost = (header.get('design') or {}).get('cost') if header.get('design_hash') == field_map_specs['design_hash'] else None
+    fem_cost = [c for c in fem_cost or [] if c is not None]
+    fem_costed = {name for c in fem_cost for name in c['magnets']}
+    return (sum(c['iron'] + c['coil'] + c['power'] for c in fem_cost)
+            + sum(cost for name, cost in field_map_specs['estimated_costs'].items() if name not in fem_costed))
+
 if __name__ == '__main__':
     import json
     import numpy as np
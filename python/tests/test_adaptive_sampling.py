@@ -0,0 +1,35 @@
+'''Per-magnet node spacing of the local field blocks (adaptive_sampling), with the analytic field backend.'''
+import numpy as np
+from lib import magnet_simulations
+
+RESOL = (0.05, 0.05, 0.1)
+
+
+def magnet_params(half_length = 250.):
+    '''FEM run parameters (dict of lists) of a long warm magnet with the same cross-section at both ends.'''
+    p = np.array([half_length, 50., 50., 119., 119., 2., 2., 1., 1., 50., 50., 0., 0., 3e4])
+    return {k: [v] for k, v in magnet_simulations.get_magnet_params(p, z_gap = 0.1, resol = RESOL).items()}
+
+def test_uniform_block_has_fewer_nodes(monkeypatch):
+    solves = []
+    backend = magnet_simulations.FIELD_BACKENDS['analytic']
+    monkeypatch.setitem(magnet_simulations.FIELD_BACKENDS, 'analytic', lambda *args, **kwargs: solves.append(1) or backend(*args, **kwargs))
+    params = magnet_params()
+    tol = 0.2
+    full = magnet_simulations.simulate_local_block(params, 0., RESOL, field_backend = 'analytic')
+    sampled = magnet_simulations.simulate_local_block(params, 0., RESOL, sampling_tol = tol, field_backend = 'analytic')
+    assert len(solves) == 2 #one solve per block, whatever the levels tried
+    assert sampled['sampling_resol'][2] > RESOL[2]
+    assert sampled['B'].size < full['B'].size/2
+    z_min, shape = -1., (full['B'].shape[0], full['B'].shape[1], 80)
+    B_full, B_sampled = np.zeros((*shape, 3)), np.zeros((*shape, 3))
+    magnet_simulations.add_field_block(B_full, full, params, z_min, RESOL)
+    magnet_simulations.add_field_block(B_sampled, sampled, params, z_min, RESOL)
+    assert np.sqrt(np.mean(np.sum((B_sampled - B_full)**2, axis=-1))) < tol
+
+def test_upsample_block():
+    '''Linear fields are reproduced exactly, the sampled nodes are kept.'''
+    y, x, z = np.meshgrid(np.arange(5.), np.arange(3.), np.arange(9.), indexing='ij')
+    B = np.stack([x + 2*y, z, x*0. + 1.], -1)
+    B_up = magnet_simulations.upsample_block(B[::2, ::1, ::4], (2, 1, 4))
+    np.testing.assert_allclose(B_up, B, atol=1e-6)
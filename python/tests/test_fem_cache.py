@@ -0,0 +1,56 @@
+'''Per-magnet FEM field cache (fem_cache), with the analytic field backend.'''
+import os
+import numpy as np
+from lib import magnet_simulations, fem_cache
+
+RESOL = (0.05, 0.05, 0.125) #binary fractions, so shifting the magnet does not round its node positions
+Z_MIN = -0.5
+SHAPE = (40, 40, 96) #(ny, nx, nz) of the global grid
+
+
+def magnet_params(z_pos = 1., NI = 3e4):
+    '''FEM run parameters (dict of lists) of a warm magnet starting at z_pos (m).'''
+    p = np.array([150., 50., 40., 60., 50., 2., 2., 1., 1., 50., 40., 0., 0., NI])
+    params = {k: [v] for k, v in magnet_simulations.get_magnet_params(p, z_gap = 0.1, resol = RESOL).items()}
+    params['Z_pos(m)'] = [z_pos]
+    return params
+
+def grid_field(blocks, params):
+    B = np.zeros((*SHAPE, 3))
+    for block, p in zip(blocks, params): magnet_simulations.add_field_block(B, block, p, Z_MIN, RESOL)
+    return B
+
+def test_key_ignores_z_pos():
+    key = fem_cache.magnet_key(magnet_params(1.), 0., RESOL)
+    assert fem_cache.magnet_key(magnet_params(3.7), 0., RESOL) == key
+    assert fem_cache.magnet_key(magnet_params(1., NI = 3.1e4), 0., RESOL) != key
+    assert fem_cache.magnet_key(magnet_params(1.), 0.05, RESOL) != key
+    assert fem_cache.magnet_key(magnet_params(1.), 0., RESOL, field_backend = 'analytic') != key
+
+def test_shifted_block_matches_fresh(tmp_path, monkeypatch):
+    runs = []
+    schedule_fem = magnet_simulations.schedule_fem
+    monkeypatch.setattr(magnet_simulations, 'schedule_fem', lambda func, params_split, *args: runs.append(len(params_split)) or schedule_fem(func, params_split, *args))
+    cache_dir = str(tmp_path)
+    params = magnet_params(1.)
+    magnet_simulations.get_field_blocks([params], Z_MIN, RESOL, cache_dir = cache_dir, field_backend = 'analytic')
+    moved = magnet_params(1. + 30*RESOL[2]) #whole grid steps, so the cached nodes fall on the grid
+    cached = magnet_simulations.get_field_blocks([moved], Z_MIN, RESOL, cache_dir = cache_dir, field_backend = 'analytic')
+    assert runs == [1]
+    fresh = magnet_simulations.get_field_blocks([moved], Z_MIN, RESOL, field_backend = 'analytic')
+    B_cached, B_fresh = grid_field(cached, [moved]), grid_field(fresh, [moved])
+    assert np.abs(B_fresh).max() > 0.5
+    np.testing.assert_allclose(B_cached, B_fresh, atol=1e-6)
+    assert not np.allclose(grid_field(cached, [params]), B_fresh)
+
+def test_evict_oldest(tmp_path):
+    cache_dir = str(tmp_path)
+    block = {'B': np.zeros((32, 32, 32, 3), dtype=np.float32), 'm0': 0}
+    for n in range(5):
+        fem_cache.store_block(cache_dir, 'key{}'.format(n), block)
+        os.utime(os.path.join(cache_dir, 'key{}.npz'.format(n)), (1000. + n, 1000. + n))
+    size = os.path.getsize(os.path.join(cache_dir, 'key0.npz'))
+    assert fem_cache.load_block(cache_dir, 'key0') is not None #a hit makes it the most recently used
+    fem_cache.evict(cache_dir, 3.5*size/1024**3)
+    assert sorted(os.listdir(cache_dir)) == ['key0.npz', 'key3.npz', 'key4.npz']
+    assert fem_cache.load_block(cache_dir, 'key1') is None
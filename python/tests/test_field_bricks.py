@@ -0,0 +1,28 @@
+'''Round trip of the block-sparse brick field maps (to_bricks / from_bricks).'''
+import numpy as np
+from lib.magnet_simulations import to_bricks, from_bricks
+
+
+def dense_map(shape, seed = 0):
+    '''Field grid of shape (ny, nx, nz) that is zero outside a box, so whole bricks are empty.'''
+    rng = np.random.default_rng(seed)
+    B = np.zeros((*shape, 3), dtype=np.float32)
+    B[2:9, 3:14, 5:17] = rng.normal(size=(7, 11, 12, 3))
+    return B.reshape(-1, 3)
+
+def test_round_trip():
+    shape = (13, 21, 30) #not multiples of the brick size
+    B = dense_map(shape)
+    bricks, index = to_bricks(B, shape, brick_size=8)
+    assert index.size == 2*3*4
+    assert 0 < (index >= 0).sum() < index.size
+    assert bricks.shape == ((index >= 0).sum()*8**3, 3)
+    np.testing.assert_array_equal(from_bricks(bricks, index, shape, brick_size=8), B)
+
+def test_small_values_dropped():
+    shape = (8, 8, 16)
+    B = np.zeros((*shape, 3), dtype=np.float32)
+    B[:, :, 8:] = 1e-5
+    bricks, index = to_bricks(B.reshape(-1, 3), shape, brick_size=8, tol=1e-4)
+    assert (index == -1).all() and bricks.size == 0
+    np.testing.assert_array_equal(from_bricks(bricks, index, shape, brick_size=8), 0.)
@@ -0,0 +1,65 @@
+'''Round trip of the field map container (save_field_map / load_field_map) and of its encodings.'''
+import numpy as np
+import pytest
+from lib import field_map_io
+
+D_SPACE = (1., 0.6, (-1., 2.))
+RESOL = (0.05, 0.05, 0.1)
+
+
+def dense_map():
+    n = [int(round(d/r)) + 1 for d, r in zip((D_SPACE[1], D_SPACE[0], D_SPACE[2][1] - D_SPACE[2][0]), (RESOL[1], RESOL[0], RESOL[2]))]
+    B = np.random.default_rng(0).normal(size=(np.prod(n), 3)).astype(np.float32)
+    return field_map_io.field_map_dict({'B': B}, D_SPACE, RESOL)
+
+def test_round_trip(tmp_path):
+    field_map = dense_map()
+    file_name = str(tmp_path/'fields.npz')
+    field_map_io.save_field_map(file_name, field_map, D_SPACE, RESOL, design_hash='abc', encoding='float32',
+                                design={'params': [1., 2.]})
+    assert field_map_io.is_field_map(file_name)
+    loaded = field_map_io.load_field_map(file_name, D_SPACE, RESOL, 'abc')
+    assert isinstance(loaded['B'], np.memmap)
+    np.testing.assert_array_equal(loaded['B'], field_map['B'])
+    for k in ('range_x', 'range_y', 'range_z'):
+        np.testing.assert_allclose(loaded[k], field_map[k])
+    header = field_map_io.read_header(file_name)
+    assert header['design_hash'] == 'abc' and header['design'] == {'params': [1., 2.]}
+    field_map_io.update_header(file_name, design_hash='def')
+    assert field_map_io.read_header(file_name)['design_hash'] == 'def'
+    np.testing.assert_array_equal(field_map_io.load_field_map(file_name)['B'], field_map['B'])
+
+def test_layout_arrays(tmp_path):
+    field_map = dense_map()
+    field_map.update(brick_size=8, brick_index=np.array([0, -1, 1, -1], dtype=np.int32))
+    file_name = str(tmp_path/'bricks.npz')
+    field_map_io.save_field_map(file_name, field_map, D_SPACE, RESOL, encoding='float32')
+    loaded = field_map_io.load_field_map(file_name)
+    assert loaded['brick_size'] == 8
+    np.testing.assert_array_equal(loaded['brick_index'], field_map['brick_index'])
+
+def test_wrong_resolution(tmp_path):
+    file_name = str(tmp_path/'fields.npz')
+    field_map_io.save_field_map(file_name, dense_map(), D_SPACE, RESOL, encoding='float32')
+    with pytest.raises(ValueError):
+        field_map_io.load_field_map(file_name, resol=(0.1, 0.1, 0.1))
+
+def test_quantize_error_bound():
+    B = dense_map()['B']
+    B = B*np.linspace(0.01, 5., len(B))[:, None] #blocks of different ranges
+    q, scale, offset = field_map_io.quantize(B, block_nodes=256)
+    assert q.dtype == np.int16 and scale.shape == offset.shape == (-(-len(B)//256), 3)
+    error = np.abs(field_map_io.dequantize(q, scale, offset, block_nodes=256) - B)
+    assert (error <= np.repeat(scale, 256, axis=0)[:len(B)]/2 + 1e-6).all()
+
+@pytest.mark.parametrize('encoding, compression', [('float16', None), ('int16', None), ('float16', 'zstd'), ('int16', 'blosc')])
+def test_encodings(tmp_path, encoding, compression):
+    if compression is not None: pytest.importorskip({'zstd': 'zstandard', 'blosc': 'blosc'}[compression])
+    field_map = dense_map()
+    file_name = str(tmp_path/'fields.npz')
+    field_map_io.save_field_map(file_name, field_map, D_SPACE, RESOL, encoding=encoding, compression=compression)
+    max_error = field_map_io.read_header(file_name)['encoding']['max_error']
+    loaded = field_map_io.load_field_map(file_name)
+    assert loaded['B'].shape == field_map['B'].shape
+    assert np.abs(loaded['B'].astype(np.float32) - field_map['B']).max() <= max_error
+    assert max_error <= 5e-3*np.abs(field_map['B']).max()
@@ -0,0 +1,57 @@
+'''Octree field maps (get_octree_data) against the dense map lookup of field_sampler.'''
+import numpy as np
+from lib.magnet_simulations import get_octree_data
+from lib.field_sampler import sample_field
+
+N = 16 #cells of the finest octree level along every axis, nodes of the dense map minus one
+LO = np.array([0., 0., -1.])
+SIZE = np.array([1.6, 0.8, 3.2])
+
+
+def dense_map():
+    '''Smooth field on the (N+1)^3 nodes of the box, as a dense field map dict (nodes ordered (y, x, z)).'''
+    y, x, z = np.meshgrid(*[LO[c] + SIZE[c]/N*np.arange(N + 1) for c in (1, 0, 2)], indexing='ij')
+    B = np.stack([0.1*x*y, 1.5*np.exp(-((x - 0.4)**2 + z**2)/0.3), 0.2*np.sin(z)], -1).reshape(-1, 3)
+    field_map = {k: [LO[c], LO[c] + SIZE[c], SIZE[c]/N] for c, k in enumerate(('range_x', 'range_y', 'range_z'))}
+    field_map['B'] = B
+    return field_map, np.column_stack((x.ravel(), y.ravel(), z.ravel()))
+
+def octree_lookup(octree, points):
+    '''Trilinear field in the leaves of the octree at points, descending the table as CustomMagneticField does.'''
+    table, cells, depth = octree['octree'], octree['octree_nodes'], octree['octree_depth']
+    n = 1 << depth
+    B = np.zeros((len(points), 3))
+    for m, p in enumerate(points):
+        t = (p - LO)/SIZE*n
+        i = np.minimum(t.astype(int), n - 1)
+        level, entry = 0, table[0]
+        while entry >= 0:
+            level += 1
+            s = depth - level
+            entry = table[entry + ((((i[1] >> s) & 1) << 2) | (((i[0] >> s) & 1) << 1) | ((i[2] >> s) & 1))]
+        leaf, s = -entry - 1, depth - level
+        f = (t - ((i >> s) << s))/(1 << s)
+        #corners ordered (dy, dx, dz)
+        w = [(f[1] if c & 4 else 1 - f[1])*(f[0] if c & 2 else 1 - f[0])*(f[2] if c & 1 else 1 - f[2]) for c in range(8)]
+        B[m] = np.dot(w, octree['B'][table[cells + 8*leaf:cells + 8*leaf + 8]])
+    return B
+
+def random_points(n = 5000, seed = 0):
+    return LO + np.random.default_rng(seed).random((n, 3))*SIZE
+
+def test_octree_within_tol():
+    field_map, nodes = dense_map()
+    tol = 0.02
+    octree = get_octree_data([{'points': nodes, 'B': field_map['B']}], (LO, LO + SIZE), tol=tol, max_depth=4, min_depth=1)
+    assert len(octree['B']) < len(nodes)
+    points = random_points()
+    error = np.linalg.norm(octree_lookup(octree, points) - sample_field(field_map, points, 'linear'), axis=1)
+    assert error.max() <= tol
+
+def test_full_depth_matches_dense():
+    '''With every cell split down to the dense grid, the octree is the dense trilinear map.'''
+    field_map, nodes = dense_map()
+    octree = get_octree_data([{'points': nodes, 'B': field_map['B']}], (LO, LO + SIZE), tol=0., max_depth=4, min_depth=4)
+    assert len(octree['B']) == len(nodes)
+    points = random_points()
+    np.testing.assert_allclose(octree_lookup(octree, points), sample_field(field_map, points, 'linear'), atol=1e-5)
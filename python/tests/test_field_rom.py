@@ -0,0 +1,60 @@
+'''Reduced-order model of the magnet fields (field_rom), trained on blocks of the analytic field backend.'''
+import numpy as np
+import pytest
+from lib import magnet_simulations, field_rom
+
+RESOL = (0.05, 0.05, 0.125)
+Z_PHASE = 0.
+NAME = 'Mag1_analytic'
+
+
+@pytest.fixture(autouse=True)
+def small_model(monkeypatch):
+    monkeypatch.setattr(field_rom, 'ROM_SHAPE', (24, 24, 40))
+    monkeypatch.setattr(field_rom, '_MODELS', {})
+
+def magnet_params(Z_len, NI):
+    '''FEM run parameters (dict of lists) of a warm magnet of length Z_len (m) at z = 0.'''
+    p = np.array([100*Z_len, 50., 40., 60., 50., 2., 2., 1., 1., 50., 40., 0., 0., NI])
+    params = {k: [v] for k, v in magnet_simulations.get_magnet_params(p, z_gap = 0.1, resol = RESOL).items()}
+    params['Z_pos(m)'] = [0.]
+    return params
+
+def fem_block(params):
+    return magnet_simulations.simulate_local_block(params, Z_PHASE, RESOL, field_backend = 'analytic')
+
+def train(rom_dir, samples):
+    for n, (Z_len, NI) in enumerate(samples):
+        params = magnet_params(Z_len, NI)
+        field_rom.store_sample(rom_dir, 'sample{}'.format(n), params, fem_block(params), Z_PHASE, RESOL, NAME)
+
+def rms_difference(block, reference):
+    '''rms difference (T) of two local blocks on their common nodes.'''
+    n = [min(s1, s2) for s1, s2 in zip(block['B'].shape[:2], reference['B'].shape[:2])]
+    k0 = max(block['m0'], reference['m0'])
+    k1 = min(block['m0'] + block['B'].shape[2], reference['m0'] + reference['B'].shape[2])
+    d = (block['B'][:n[0], :n[1], k0 - block['m0']:k1 - block['m0']].astype(np.float32)
+         - reference['B'][:n[0], :n[1], k0 - reference['m0']:k1 - reference['m0']].astype(np.float32))
+    return float(np.sqrt(np.mean(np.square(d, dtype=np.float64))))
+
+def test_held_out_within_error(tmp_path):
+    rom_dir = str(tmp_path)
+    train(rom_dir, [(Z_len, NI) for Z_len in (2., 2.5, 3., 3.5) for NI in (2e4, 3e4, 4e4)])
+    params = magnet_params(2.75, 3.5e4)
+    block, error = field_rom.predict_block(rom_dir, params, Z_PHASE, RESOL, NAME)
+    assert block is not None and np.isfinite(error)
+    reference = fem_block(params)
+    assert np.abs(reference['B']).max() > 0.5
+    assert rms_difference(block, reference) <= error
+
+def test_too_few_samples(tmp_path):
+    '''Two parameters vary, a thin plate spline with a linear term needs at least four samples.'''
+    rom_dir = str(tmp_path)
+    train(rom_dir, [(2., 2e4), (3., 2e4), (3., 4e4)])
+    block, error = field_rom.predict_block(rom_dir, magnet_params(2.5, 3e4), Z_PHASE, RESOL, NAME)
+    assert block is None and error >= 0.01
+
+def test_outside_samples(tmp_path):
+    rom_dir = str(tmp_path)
+    train(rom_dir, [(Z_len, NI) for Z_len in (2., 3.) for NI in (2e4, 3e4, 4e4)])
+    assert field_rom.predict_block(rom_dir, magnet_params(2.5, 5e4), Z_PHASE, RESOL, NAME) == (None, np.inf)
@@ -0,0 +1,36 @@
+'''Field map sampler (sample_field): grid bounds as in CustomMagneticField::initializeGrid.'''
+import numpy as np
+from lib import field_map_io
+from lib.field_sampler import sample_field
+
+#the step does not divide the z range: 4 nodes at 0, 0.3, 0.6 and 0.9 m, the map ends at 1 m
+RANGES = {'range_x': [0., 0.1, 0.1], 'range_y': [0., 0.1, 0.1], 'range_z': [0., 1., 0.3]}
+
+
+def field_map():
+    B = np.random.default_rng(0).normal(size=(2*2*4, 3)).astype(np.float32)
+    return dict(RANGES, B = B)
+
+def node(B, k):
+    '''Field of the node (0, 0, k).'''
+    return B[k].astype(np.float64)
+
+def test_nearest_up_to_range_max():
+    fields = field_map()
+    points = [[0., 0., 0.95], [0., 0., 1.], [0., 0., 1.01]]
+    B = sample_field(fields, points, 'nearest')
+    np.testing.assert_array_equal(B[:2], [node(fields['B'], 3)]*2)
+    np.testing.assert_array_equal(B[2], 0.)
+
+def test_linear_up_to_range_max():
+    '''Past the last node the last cell is extrapolated, as Geant4 does.'''
+    fields = field_map()
+    B = sample_field(fields, [[0., 0., 0.95], [0., 0., 1.01]], 'linear')
+    fz = 0.95/0.3 - 2
+    np.testing.assert_allclose(B[0], node(fields['B'], 2) + fz*(node(fields['B'], 3) - node(fields['B'], 2)), rtol=1e-6)
+    np.testing.assert_array_equal(B[1], 0.)
+
+def test_field_map_dict_ranges():
+    '''Maps built by field_map_dict end on their last node, so the range max and the last node agree.'''
+    fields = field_map_io.field_map_dict({'B': np.ones((2*2*4, 3), dtype=np.float32)}, (0.1, 0.1, (0., 0.9)), (0.1, 0.1, 0.3))
+    np.testing.assert_array_equal(sample_field(fields, [[0.1, 0.1, 0.9], [0.1, 0.1, 0.91]]), [[1., 1., 1.], [0., 0., 0.]])
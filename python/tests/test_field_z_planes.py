@@ -0,0 +1,30 @@
+'''Round trip of the z-factorized field maps (to_z_planes / from_z_planes).'''
+import numpy as np
+from lib.magnet_simulations import to_z_planes, from_z_planes
+
+
+def magnet_map(shape):
+    '''Field grid of shape (ny, nx, nz) of a long magnet: constant body along z, fringe fields at both ends.'''
+    ny, nx, nz = shape
+    z = np.linspace(-1., 1., nz)
+    profile = 1/(1 + np.exp((np.abs(z) - 0.8)/0.02))
+    xy = np.random.default_rng(0).normal(size=(ny, nx, 1, 3))
+    return (xy*profile[None, None, :, None]).reshape(-1, 3)
+
+def test_round_trip_within_tol():
+    shape = (5, 7, 201)
+    B = magnet_map(shape)
+    tol = 0.01
+    B_planes, planes = to_z_planes(B, shape, tol=tol)
+    assert planes[0] == 0 and planes[-1] == shape[2] - 1
+    assert (np.diff(planes) > 0).all()
+    assert len(planes) < shape[2]//2
+    assert B_planes.shape == (len(planes)*shape[0]*shape[1], 3)
+    assert np.abs(from_z_planes(B_planes, planes, shape) - B).max() <= tol
+
+def test_all_planes_exact():
+    shape = (3, 4, 20)
+    B = np.random.default_rng(1).normal(size=(np.prod(shape), 3))
+    B_planes, planes = to_z_planes(B, shape, tol=0.)
+    np.testing.assert_array_equal(planes, np.arange(shape[2]))
+    np.testing.assert_allclose(from_z_planes(B_planes, planes, shape), B)
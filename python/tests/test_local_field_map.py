@@ -0,0 +1,45 @@
+'''Local field maps (local_field_map): z slabs of a dense map, read by Geant4 in place.'''
+import os
+import numpy as np
+import pytest
+from lib import field_map_io
+from lib.field_sampler import sample_field
+
+pytest.importorskip('muon_slabs') #the Geant4 bindings, imported by the geometry module
+os.environ.setdefault('PROJECTS_DIR', os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from lib.ship_muon_shield_customfield import local_field_map
+
+D_SPACE = (0.8, 0.6, (-1., 4.))
+RESOL = (0.1, 0.1, 0.05)
+
+
+def dense_map(dtype = np.float32):
+    n = [int(round(d/r)) + 1 for d, r in zip((D_SPACE[1], D_SPACE[0], D_SPACE[2][1] - D_SPACE[2][0]), (RESOL[1], RESOL[0], RESOL[2]))]
+    B = np.random.default_rng(0).normal(size=(np.prod(n), 3)).astype(dtype)
+    return field_map_io.field_map_dict({'B': B}, D_SPACE, RESOL)
+
+@pytest.mark.parametrize('interpolation', ['nearest', 'linear'])
+def test_matches_full_map(interpolation):
+    field_map = dense_map()
+    local = local_field_map(field_map, 0.93, 2.51)
+    z_min, z_max = local['range_z'][:2]
+    assert z_min <= 0.93 and z_max >= 2.51 and z_max - z_min < 1.7
+    rng = np.random.default_rng(1)
+    points = np.column_stack([rng.uniform(-1., 1., 20000), rng.uniform(-0.8, 0.8, 20000), rng.uniform(z_min, z_max, 20000)])
+    np.testing.assert_allclose(sample_field(local, points, interpolation), sample_field(field_map, points, interpolation), atol=1e-6)
+
+@pytest.mark.parametrize('dtype', [np.float32, np.float16])
+def test_view_in_stored_dtype(dtype):
+    field_map = dense_map(dtype)
+    local = local_field_map(field_map, 0.5, 1.)
+    assert local['B'].dtype == dtype and local['B'].ndim == 4
+    assert np.shares_memory(local['B'], field_map['B'])
+    #(j, i) rows of the local map are nz nodes long, one row of the full map apart (see local_field_view in MuonSlabs.cc)
+    assert local['B'].strides[2:] == (3*local['B'].itemsize, local['B'].itemsize)
+    assert local['B'].strides[1] == 3*local['B'].itemsize*int(round((D_SPACE[2][1] - D_SPACE[2][0])/RESOL[2]) + 1)
+
+def test_clipped_to_map():
+    field_map = dense_map()
+    local = local_field_map(field_map, -3., 10.)
+    assert local['range_z'] == pytest.approx([D_SPACE[2][0], D_SPACE[2][1], RESOL[2]])
+    np.testing.assert_array_equal(local['B'].reshape(-1, 3), field_map['B'])
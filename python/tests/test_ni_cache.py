@@ -0,0 +1,54 @@
+'''Persistent memo of the NI solves (ni_cache): exact hits, interpolation within tolerance and merging across processes.'''
+import json
+import pytest
+from lib import ni_cache
+
+KEY = 'magnet'
+POINTS = {1.0: 10000., 1.5: 16000., 2.0: 24000.} #B_goal (T): NI (A), convex as with saturating iron
+
+
+@pytest.fixture(autouse=True)
+def empty_memo(monkeypatch):
+    monkeypatch.setattr(ni_cache, '_MEMO', {})
+
+def stored(cache_dir):
+    for B, NI in POINTS.items(): ni_cache.store(cache_dir, KEY, B, NI)
+    ni_cache._MEMO.clear() #read back from the file, as a new process
+    return cache_dir
+
+def test_exact_hit(tmp_path):
+    cache_dir = stored(str(tmp_path))
+    for B, NI in POINTS.items(): assert ni_cache.lookup(cache_dir, KEY, B) == NI
+
+def test_interpolated_within_tol(tmp_path):
+    cache_dir = stored(str(tmp_path))
+    NI = ni_cache.lookup(cache_dir, KEY, 1.53, tol=0.05)
+    assert POINTS[1.5] < NI < POINTS[2.0]
+    NI = ni_cache.lookup(cache_dir, KEY, 1.97, tol=0.05)
+    assert POINTS[1.5] < NI < POINTS[2.0]
+
+@pytest.mark.parametrize('B_goal', [1.25, 0.99, 2.01, 3.])
+def test_none_outside_tol_or_range(tmp_path, B_goal):
+    '''1.25 T is 0.25 T away from the known points, the others are outside the solved range.'''
+    assert ni_cache.lookup(stored(str(tmp_path)), KEY, B_goal, tol=0.05) is None
+
+def test_none_without_points(tmp_path):
+    assert ni_cache.lookup(str(tmp_path), KEY, 1.5) is None
+    ni_cache.store(str(tmp_path), KEY, 1.0, 10000.)
+    assert ni_cache.lookup(str(tmp_path), KEY, 1.01, tol=0.05) is None #one point, nothing to interpolate
+
+def test_store_merges_other_process(tmp_path):
+    cache_dir = str(tmp_path)
+    ni_cache.store(cache_dir, KEY, 1.0, POINTS[1.0])
+    #another process adds its points to the file meanwhile, this one still has only its own in memory
+    with open(tmp_path/(KEY + '.json'), 'w') as f: json.dump([[1.0, 1.5], [POINTS[1.0], POINTS[1.5]]], f)
+    ni_cache.store(cache_dir, KEY, 2.0, POINTS[2.0])
+    with open(tmp_path/(KEY + '.json')) as f: B, NI = json.load(f)
+    assert dict(zip(B, NI)) == POINTS
+    assert ni_cache.lookup(cache_dir, KEY, 1.5) == POINTS[1.5]
+    assert not list(tmp_path.glob('*.tmp'))
+
+def test_memo_without_cache_dir():
+    '''Without NI_CACHE_DIR the solves are only memoized in the process.'''
+    ni_cache.store('', KEY, 1.0, POINTS[1.0])
+    assert ni_cache.lookup('', KEY, 1.0) == POINTS[1.0]
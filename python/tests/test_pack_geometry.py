@@ -0,0 +1,77 @@
+'''Solids passed to initialize as arrays (pack_geometry): the same solids as the detector JSON read by ShieldGeometry::FromJson.'''
+import json
+import os
+import numpy as np
+import pytest
+from lib import field_map_io
+
+pytest.importorskip('muon_slabs') #the Geant4 bindings, imported by the geometry module
+os.environ.setdefault('PROJECTS_DIR', os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from lib.ship_muon_shield_customfield import pack_geometry, local_field_map, CreateCavern
+
+D_SPACE = (0.8, 0.6, (-1., 4.))
+RESOL = (0.1, 0.1, 0.05)
+
+
+def corners(n, dx = 0.):
+    '''8 (x, y) corners of a component, distinct per n.'''
+    rng = np.random.default_rng(n)
+    return (np.array([-1., -1., -1., 1., 1., 1., 1., -1.]*2) + dx + rng.uniform(-0.1, 0.1, 16)).tolist()
+
+def magnet(z_center, profile, field, n_components = 3):
+    return {'dz': 0.5, 'z_center': z_center, 'material': 'G4_Fe',
+            'components': [{'corners': corners(int(10*z_center) + c, dx = c), 'field_profile': profile, 'field': field}
+                           for c in range(n_components)]}
+
+def detector():
+    n = [int(round(d/r)) + 1 for d, r in zip((D_SPACE[1], D_SPACE[0], D_SPACE[2][1] - D_SPACE[2][0]), (RESOL[1], RESOL[0], RESOL[2]))]
+    field_map = field_map_io.field_map_dict({'B': np.random.default_rng(0).normal(size=(np.prod(n), 3)).astype(np.float32)}, D_SPACE, RESOL)
+    local = [dict(local_field_map(field_map, z - 0.6, z + 0.6), interpolation = 'linear') for z in (1., 2.5)]
+    return {'type': 1, 'cavern': CreateCavern(18.),
+            'magnets': [magnet(0., 'uniform', (0., 1.7, 0.)), magnet(1., 'local', local[0]), magnet(2.5, 'local', local[1]),
+                        magnet(4., 'global', (0., 0., 0.))]}
+
+def json_geometry(detector):
+    '''Solids as ShieldGeometry::FromJson reads them from the detector JSON of initialize_geant4 before the arrays, with
+    the local maps as (N, 3) lists: one row per solid of (corners, dz, z_center, material, profile, field, local map or None).'''
+    data = json.loads(json.dumps(detector, default = lambda o: o.reshape(-1, 3).tolist() if isinstance(o, np.ndarray) else float(o)))
+    rows = []
+    for cavern in data['cavern']:
+        rows += [(block, cavern['dz'], cavern['z_center'], cavern['material'], -1, [0., 0., 0.], None) for block in cavern['components']]
+    for mag in data['magnets']:
+        for x in mag['components']:
+            profile = {'global': 1, 'uniform': 0}.get(x['field_profile'], 2)
+            rows.append((x['corners'], mag['dz'], mag['z_center'], mag['material'], profile,
+                         x['field'] if profile == 0 else [0., 0., 0.], x['field'] if profile == 2 else None))
+    return rows
+
+def test_same_solids_as_json():
+    det = detector()
+    geometry = pack_geometry(det)
+    rows = json_geometry(det)
+    assert len(geometry['dz']) == len(rows) > 0
+    corners, dz, z_center, material, profile, field, local = zip(*rows)
+    np.testing.assert_array_equal(geometry['corners'], corners)
+    np.testing.assert_array_equal(geometry['dz'], dz)
+    np.testing.assert_array_equal(geometry['z_center'], z_center)
+    assert [geometry['materials'][m] for m in geometry['material']] == list(material)
+    np.testing.assert_array_equal(geometry['field_profile'], profile)
+    np.testing.assert_array_equal(geometry['field'], field)
+    assert set(profile) == {-1, 0, 1, 2}
+    for n, f in enumerate(local):
+        k = geometry['local_field'][n]
+        if f is None:
+            assert k == -1
+            continue
+        np.testing.assert_array_equal(geometry['local_ranges'][k], [*f['range_x'], *f['range_y'], *f['range_z']])
+        np.testing.assert_array_equal(np.asarray(geometry['local_B'][k], dtype=np.float64).reshape(-1, 3), f['B'])
+        assert (geometry['local_interpolation'][k], geometry['local_storage'][k]) == ('linear', 'float32_aos')
+
+def test_local_maps_shared():
+    '''The components of a magnet share one local map, passed as the view of the global map.'''
+    det = detector()
+    geometry = pack_geometry(det)
+    assert len(geometry['local_B']) == len(geometry['local_ranges']) == 2
+    np.testing.assert_array_equal(geometry['local_field'][geometry['field_profile'] == 2], [0]*3 + [1]*3)
+    for B, mag in zip(geometry['local_B'], det['magnets'][1:3]):
+        assert B is mag['components'][0]['field']['B'] or np.shares_memory(B, mag['components'][0]['field']['B'])
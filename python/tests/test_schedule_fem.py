@@ -0,0 +1,38 @@
+'''Largest-first scheduling of the FEM runs and their thread shares (schedule_fem), with a stub solve.'''
+import time
+import numpy as np
+import pytest
+from lib import magnet_simulations
+
+pytest.importorskip('threadpoolctl')
+
+
+def stub_solve(i:int):
+    '''Start time of the run and threads of the BLAS of numpy (loaded in the worker) while it runs.'''
+    from threadpoolctl import threadpool_info
+    start = time.time()
+    np.dot(np.ones((64, 64)), np.ones((64, 64)))
+    time.sleep(0.05)
+    return {'run': i, 'start': start, 'threads': max(p['num_threads'] for p in threadpool_info())}
+
+def stub_runs(costs:list, monkeypatch):
+    monkeypatch.setattr(magnet_simulations, 'estimate_fem_cost', lambda p: p['cost'][0])
+    return [{'cost': [c], 'yoke_type': ['Mag1'], 'Z_pos(m)': [float(i)]} for i, c in enumerate(costs)]
+
+def test_largest_first(monkeypatch):
+    costs = [1., 5., 3., 4., 2.]
+    results = magnet_simulations.schedule_fem(stub_solve, stub_runs(costs, monkeypatch), [(i,) for i in range(len(costs))], cores=1)
+    assert [r['run'] for r in results] == list(range(len(costs)))
+    assert list(np.argsort([r['start'] for r in results])) == list(np.argsort(costs)[::-1])
+    assert all(r['threads'] == 1 for r in results)
+
+def test_thread_shares(monkeypatch):
+    '''The run of cost 3 starts with 3 of 4 cores, the one of cost 1 with the last core; the limits reach the BLAS pool.'''
+    results = magnet_simulations.schedule_fem(stub_solve, stub_runs([1., 3.], monkeypatch), [(0,), (1,)], cores=4)
+    assert [r['threads'] for r in results] == [1, 3]
+
+def test_fem_threads():
+    assert magnet_simulations.fem_threads(3., [1.], 4) == 3
+    assert magnet_simulations.fem_threads(1., [], 1) == 1
+    assert magnet_simulations.fem_threads(1., [1., 1., 1.], 4) == 1 #every run gets a core
+    assert magnet_simulations.fem_threads(10., [1., 1.], 8) == 6
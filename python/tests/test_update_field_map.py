@@ -0,0 +1,61 @@
+'''In-place updates of field maps (update_field_map, add_field_block), with the analytic field backend.'''
+import numpy as np
+import pytest
+from lib import magnet_simulations, field_map_io
+from lib.reference_designs.params import optimal_oliver, new_parametrization
+
+PARAMS = np.array(optimal_oliver, dtype=float)
+RESOL = (0.1, 0.1, 0.2)
+D_SPACE = (2.5, 3., (3., 14.6))
+KWARGS = dict(fSC_mag = False, resol = RESOL, d_space = D_SPACE, magnets = ['M1', 'M2'], field_backend = 'analytic')
+
+
+@pytest.fixture(autouse=True)
+def fixed_NI(monkeypatch):
+    '''NI of every magnet is its last parameter, without solving for the field.'''
+    monkeypatch.setattr(magnet_simulations, 'solve_NI', lambda B_goal, magn_params, materials_directory: B_goal)
+
+def changed(params, mag, i, factor):
+    params = np.array(params, dtype=float)
+    params[new_parametrization[mag][i]] *= factor
+    return params
+
+def simulate(params, file_name, field_encoding = 'float32'):
+    magnet_simulations.simulate_field(params, file_name = file_name, field_encoding = field_encoding, **KWARGS)
+    return np.array(field_map_io.load_field_map(file_name)['B'])
+
+def test_update_chain_matches_simulation(tmp_path):
+    file_name = str(tmp_path/'fields.npz')
+    params = PARAMS
+    simulate(params, file_name)
+    for mag, i, factor in [('M2', 13, 1.05), ('M1', 1, 0.9), ('M2', 3, 1.1), ('M1', 0, 1.02), ('M2', 13, 0.97)]:
+        params = changed(params, mag, i, factor)
+        assert magnet_simulations.field_map_updatable(file_name, params, **KWARGS, field_encoding = 'float32')
+        assert magnet_simulations.update_field_map(file_name, None, params, **KWARGS)
+    B_updated = np.array(field_map_io.load_field_map(file_name)['B'])
+    B = simulate(params, str(tmp_path/'fields_new.npz'))
+    assert np.abs(B).max() > 0.5
+    np.testing.assert_allclose(B_updated, B, atol=1e-5)
+    assert field_map_io.read_header(file_name)['design_hash'] == field_map_io.read_header(str(tmp_path/'fields_new.npz'))['design_hash']
+
+def test_float16_not_updated(tmp_path):
+    file_name = str(tmp_path/'fields.npz')
+    simulate(PARAMS, file_name, field_encoding = 'float16')
+    params = changed(PARAMS, 'M2', 13, 1.05)
+    assert not magnet_simulations.field_map_updatable(file_name, params, **KWARGS, field_encoding = 'float16')
+    with pytest.raises(ValueError):
+        magnet_simulations.update_field_map(file_name, None, params, **KWARGS)
+
+def test_add_subtract_cancels():
+    all_params = magnet_simulations.get_all_magnet_params(PARAMS, False, 0.1, RESOL, magnets = ['M2'])
+    params = magnet_simulations.split_magnet_params(all_params.to_dict(orient='list'))[0]
+    z_min = D_SPACE[2][0]
+    shape = [int(round(d/r)) + 1 for d, r in zip((D_SPACE[1], D_SPACE[0], D_SPACE[2][1] - z_min), (RESOL[1], RESOL[0], RESOL[2]))]
+    block = magnet_simulations.simulate_local_block(params, magnet_simulations.get_z_phase(params, z_min, RESOL), RESOL,
+                                                    field_backend = 'analytic')
+    B0 = np.random.default_rng(0).normal(size=(*shape, 3)).astype(np.float32)
+    B = B0.copy()
+    magnet_simulations.add_field_block(B, block, params, z_min, RESOL)
+    assert np.abs(B - B0).max() > 0.5
+    magnet_simulations.add_field_block(B, block, params, z_min, RESOL, sign = -1.)
+    np.testing.assert_allclose(B, B0, atol=1e-6)